@@ -0,0 +1,326 @@
+"""
+aionetwork.py fetches uris on an asyncio event loop, for code that can't
+use eventlet's monkey patching. It mirrors network.event_network: the same
+timeouts, headers, gzip handling, size limits, cache keys and JSON decoding,
+as coroutines. It is written against trollius, the asyncio API for python 2.
+
+>>> loop = asyncio.new_event_loop()
+>>> loop.run_until_complete(event_network(["http://127.0.0.1:1/"], loop=loop))
+{}
+>>> loop.close()
+"""
+
+# Universe imports
+import httplib
+import json
+import socket
+import ssl
+import urlparse
+import zlib
+
+# Thirdparty imports
+import trollius as asyncio
+from trollius import From, Return
+
+# Retickr imports
+from retickrtools.dns_cache import default_dns_cache
+from retickrtools.network import ResponseTooLarge, ZLIB_WBITS, decompress_chunks, md5
+
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class HTTPStatusError(Exception):
+    """
+    Raised for a response with an error status, the status is its code
+    """
+
+    def __init__(self, uri, code, reason):
+        Exception.__init__(self, uri, code, reason)
+        self.uri = uri
+        self.code = code
+        self.reason = reason
+
+
+# Lookups under way, so that coroutines after the same host wait on one
+_resolving = {}
+
+
+@asyncio.coroutine
+def _resolve(host, port, dns_cache, loop=None):
+    """
+    The addresses of host from dns_cache, asking the loop's resolver and
+    filling the cache in if it doesn't have them
+    """
+    addresses = dns_cache.lookup(host, port, 0, socket.SOCK_STREAM)
+    if addresses is not None:
+        raise Return(addresses)
+
+    loop = loop or asyncio.get_event_loop()
+    key = (id(loop), id(dns_cache), host.lower(), port)
+    lookup = _resolving.get(key)
+    if lookup is None:
+        lookup = _resolving[key] = asyncio.async(
+            loop.getaddrinfo(host, port, type=socket.SOCK_STREAM), loop=loop)
+
+        def done(lookup):
+            del _resolving[key]
+            if lookup.cancelled():
+                return
+            error = lookup.exception()
+            if error is None:
+                dns_cache.store(lookup.result(), host, port, 0, socket.SOCK_STREAM)
+            elif isinstance(error, socket.gaierror):
+                dns_cache.store_error(error, host, port, 0, socket.SOCK_STREAM)
+
+        lookup.add_done_callback(done)
+
+    # Shielded so that one caller timing out doesn't cancel it for the rest
+    addresses = yield From(asyncio.shield(lookup, loop=loop))
+    raise Return(addresses)
+
+
+@asyncio.coroutine
+def _connect(host, port, ssl_context, dns_cache, loop=None):
+    """
+    asyncio.open_connection to host, trying each of its addresses in
+    dns_cache in turn
+    """
+    addresses = yield From(_resolve(host, port, dns_cache, loop))
+    error = None
+    for family, socktype, proto, canonname, sockaddr in addresses:
+        try:
+            connection = yield From(asyncio.open_connection(
+                sockaddr[0], port, ssl=ssl_context,
+                server_hostname=host if ssl_context else None,
+                family=family, loop=loop))
+        except socket.error, error:
+            continue
+        raise Return(connection)
+    raise error or socket.error("getaddrinfo returns an empty list")
+
+
+@asyncio.coroutine
+def _read_head(reader):
+    """
+    Read the status line and headers of a response, returns (status,
+    reason, headers) with the header names in lower case
+    """
+    status_line = yield From(reader.readline())
+    parts = status_line.split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/") or not parts[1].isdigit():
+        raise httplib.BadStatusLine(status_line)
+    status = int(parts[1])
+    reason = parts[2].strip() if len(parts) > 2 else ""
+
+    headers = {}
+    while True:
+        line = yield From(reader.readline())
+        if line in ("\r\n", "\n", ""):
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    raise Return((status, reason, headers))
+
+
+@asyncio.coroutine
+def _read_body(reader, headers, max_bytes=None, chunk_size=64 * 1024):
+    """
+    Read a response body as framed by its headers, returns a list of the
+    chunks it arrived in. ResponseTooLarge is raised as soon as it is
+    clear that more than max_bytes are coming.
+    """
+    chunks = []
+    size = 0
+
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            line = yield From(reader.readline())
+            chunk_length = int(line.split(";", 1)[0].strip() or "0", 16)
+            if not chunk_length:
+                # Skip any trailers
+                while (yield From(reader.readline())) not in ("\r\n", "\n", ""):
+                    pass
+                break
+            size += chunk_length
+            if max_bytes is not None and size > max_bytes:
+                raise ResponseTooLarge("more than {0} bytes".format(max_bytes))
+            chunks.append((yield From(reader.readexactly(chunk_length))))
+            yield From(reader.readline())
+
+    elif headers.get("content-length", "").isdigit():
+        length = int(headers["content-length"])
+        if max_bytes is not None and length > max_bytes:
+            raise ResponseTooLarge("Content-Length of {0} bytes".format(length))
+        if length:
+            chunks.append((yield From(reader.readexactly(length))))
+
+    else:
+        # The body runs until the server closes the connection
+        while True:
+            chunk = yield From(reader.read(chunk_size))
+            if not chunk:
+                break
+            size += len(chunk)
+            if max_bytes is not None and size > max_bytes:
+                raise ResponseTooLarge("more than {0} bytes".format(max_bytes))
+            chunks.append(chunk)
+
+    raise Return(chunks)
+
+
+@asyncio.coroutine
+def fetch(uri, headers=None, max_bytes=None, max_compressed_bytes=None,
+          max_redirects=10, dns_cache=None, loop=None):
+    """
+    GET uri, following redirects, and return (status, headers, data)
+    with the body decompressed if it arrived gzip or deflate encoded.
+    Hosts are looked up through dns_cache (default_dns_cache if None).
+    Error statuses raise HTTPStatusError and bodies larger than
+    max_compressed_bytes over the wire or max_bytes decompressed raise
+    ResponseTooLarge. Wrap it in asyncio.wait_for to give it a timeout.
+    """
+    if dns_cache is None:
+        dns_cache = default_dns_cache
+
+    for redirect in xrange(max_redirects + 1):
+        parts = urlparse.urlsplit(uri)
+        if parts.scheme not in DEFAULT_PORTS:
+            raise ValueError("can't fetch {0}".format(uri))
+        host = parts.hostname
+        port = parts.port or DEFAULT_PORTS[parts.scheme]
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        context = ssl.create_default_context() if parts.scheme == "https" else None
+        reader, writer = yield From(_connect(host, port, context, dns_cache, loop))
+        try:
+            request_headers = {
+                "Host": parts.netloc,
+                "Accept-Encoding": "gzip",
+                "Connection": "close",
+                }
+            if headers:
+                request_headers.update(headers)
+            writer.write("GET {0} HTTP/1.1\r\n".format(path))
+            for name, value in request_headers.items():
+                writer.write("{0}: {1}\r\n".format(name, value))
+            writer.write("\r\n")
+
+            status, reason, response_headers = yield From(_read_head(reader))
+
+            if status in REDIRECT_CODES and "location" in response_headers:
+                uri = urlparse.urljoin(uri, response_headers["location"])
+                continue
+
+            if status >= 400:
+                raise HTTPStatusError(uri, status, reason)
+
+            # Nothing to decompress, so the tighter limit applies on the wire
+            encoding = response_headers.get("content-encoding")
+            limit = max_compressed_bytes
+            if encoding not in ZLIB_WBITS:
+                limits = [l for l in (max_bytes, max_compressed_bytes) if l is not None]
+                limit = min(limits) if limits else None
+
+            chunks = yield From(_read_body(reader, response_headers, limit))
+        finally:
+            writer.close()
+
+        if encoding in ZLIB_WBITS:
+            data = "".join(decompress_chunks(chunks, encoding, max_bytes))
+        else:
+            data = "".join(chunks)
+
+        raise Return((status, response_headers, data))
+
+    raise HTTPStatusError(uri, status, "too many redirects")
+
+
+@asyncio.coroutine
+def event_network(
+    uris,
+    timeout=15,
+    concurrency=1000,
+    headers=None,
+    treat_results_as_json=False,
+    default_value="",
+    filter_out_empty_responses=True,
+    cache=None,
+    cache_prefix="event_network",
+    cache_length=300,
+    max_bytes=None,
+    max_compressed_bytes=None,
+    errors=None,
+    dns_cache=None,
+    loop=None
+):
+    """
+    Given a list of uris to pull over network pull them and then
+    return a dictionary of their responses keyed on the uri which was
+    originally requested. The arguments are those of
+    network.event_network, with no more than concurrency uris fetched at
+    once, and responses are cached under the same keys so the two can
+    share a cache.
+    """
+    semaphore = asyncio.Semaphore(concurrency, loop=loop)
+
+    @asyncio.coroutine
+    def pull_link(link):
+        if cache is not None:
+            # Check for the response in cache
+            cache_key = "{0}::{1}".format(cache_prefix, md5(link))
+            response = cache.get(cache_key)
+            if response is not None:
+                raise Return((link, response))
+
+        with (yield From(semaphore)):
+            try:
+                status, response_headers, data = yield From(asyncio.wait_for(
+                    fetch(link, headers, max_bytes, max_compressed_bytes,
+                          dns_cache=dns_cache, loop=loop),
+                    timeout,
+                    loop=loop
+                    ))
+            except (asyncio.TimeoutError, HTTPStatusError, httplib.HTTPException,
+                    ResponseTooLarge, socket.error, EnvironmentError,
+                    ValueError, zlib.error), e:
+                # ValueError covers uris that can't be fetched and bad chunk
+                # lengths, zlib.error bodies that don't decompress
+                if errors is not None:
+                    errors[link] = e
+                raise Return((link, default_value))
+
+        if cache is not None:
+            cache.set(cache_key, data, cache_length)
+
+        raise Return((link, data))
+
+    results = yield From(asyncio.gather(
+        *[pull_link(link) for link in set(uris)],
+        loop=loop
+        ))
+
+    if filter_out_empty_responses:
+        results = [
+            (link, data)
+            for link, data
+            in results
+            if data is not None and len(data) > 0
+            ]
+
+    results = dict(results)
+
+    # Is this JSON?  If so, try to parse it.
+    if treat_results_as_json:
+        for k, v in results.items():
+            try:
+                results[k] = json.loads(v)
+            except ValueError:
+                results[k] = None
+
+    raise Return(results)
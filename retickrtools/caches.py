@@ -0,0 +1,217 @@
+# Universe imports
+import collections
+import cPickle
+import shelve
+import sqlite3
+import time
+
+
+class LRUCache(object):
+    """
+    A small in-process cache which forgets the least recently used key once
+    it holds more than max_entries keys. It has the same get / set
+    interface as django's cache so it can be handed to anything that
+    accepts one, such as event_network.
+
+    >>> cache = LRUCache(max_entries=2)
+    >>> cache.set("a", 1)
+    >>> cache.set("b", 2)
+    >>> cache.get("a")
+    1
+    >>> cache.set("c", 3)
+    >>> cache.get("b") is None
+    True
+    >>> cache.get("a"), cache.get("c")
+    (1, 3)
+
+    Values can be given a lifetime in seconds
+
+    >>> cache.set("d", 4, -1)
+    >>> cache.get("d", "expired")
+    'expired'
+
+    The cache can also be bounded by the total size of its values, as
+    measured by sizeof (len by default)
+
+    >>> cache = LRUCache(max_entries=None, max_bytes=10)
+    >>> cache.set("a", "12345")
+    >>> cache.set("b", "12345")
+    >>> cache.set("c", "1")
+    >>> cache.get("a") is None, cache.size
+    (True, 6)
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=None, sizeof=len):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.size = 0
+        self._data = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value, expires, size = self._data.pop(key)
+        except KeyError:
+            return default
+
+        if expires is not None and expires <= time.time():
+            self.size -= size
+            return default
+
+        # Re-insert the key so that it is now the most recently used
+        self._data[key] = (value, expires, size)
+        return value
+
+    def set(self, key, value, timeout=None):
+        self.delete(key)
+
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        self._data[key] = (
+            value,
+            None if timeout is None else time.time() + timeout,
+            size
+            )
+        self.size += size
+
+        while self._data and (
+            (self.max_entries is not None and len(self._data) > self.max_entries)
+            or (self.max_bytes is not None and self.size > self.max_bytes)
+            ):
+            self.size -= self._data.popitem(last=False)[1][2]
+
+    def delete(self, key):
+        try:
+            self.size -= self._data.pop(key)[2]
+        except KeyError:
+            pass
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ShelveCache(object):
+    """
+    A cache kept in a local dbm file through the shelve module, so that
+    it survives restarts of the process. Values must be picklable.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "cache")
+    >>> cache = ShelveCache(path)
+    >>> cache.set("a", {"etag": "xyz"})
+    >>> cache.close()
+    >>> ShelveCache(path).get("a")
+    {'etag': 'xyz'}
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._shelf = shelve.open(path, flag="c", protocol=2)
+
+    def _key(self, key):
+        # dbm keys have to be byte strings
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        return key
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self._shelf[self._key(key)]
+        except KeyError:
+            return default
+
+        if expires is not None and expires <= time.time():
+            self.delete(key)
+            return default
+
+        return value
+
+    def set(self, key, value, timeout=None):
+        self._shelf[self._key(key)] = (
+            value,
+            None if timeout is None else time.time() + timeout
+            )
+
+    def delete(self, key):
+        try:
+            del self._shelf[self._key(key)]
+        except KeyError:
+            pass
+
+    def sync(self):
+        self._shelf.sync()
+
+    def close(self):
+        self._shelf.close()
+
+
+class SqliteCache(object):
+    """
+    A cache kept in a local sqlite database, so that it survives restarts
+    of the process and can be shared by several processes on one machine.
+    Values must be picklable.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "cache.db")
+    >>> cache = SqliteCache(path)
+    >>> cache.set("a", {"etag": "xyz"})
+    >>> cache.set("b", 1, -1)
+    >>> cache.close()
+    >>> cache = SqliteCache(path)
+    >>> cache.get("a"), cache.get("b")
+    ({'etag': 'xyz'}, None)
+    """
+
+    def __init__(self, path, table="cache"):
+        self.path = path
+        self.table = table
+        # Autocommit, every set is a transaction of its own
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS {0} "
+            "(key TEXT PRIMARY KEY, value BLOB, expires REAL)".format(table))
+
+    def _key(self, key):
+        # sqlite wants text keys as unicode
+        if isinstance(key, str):
+            key = key.decode("utf-8")
+        return key
+
+    def get(self, key, default=None):
+        row = self._db.execute(
+            "SELECT value, expires FROM {0} WHERE key = ?".format(self.table),
+            (self._key(key),)).fetchone()
+        if row is None:
+            return default
+
+        value, expires = row
+        if expires is not None and expires <= time.time():
+            self.delete(key)
+            return default
+
+        return cPickle.loads(str(value))
+
+    def set(self, key, value, timeout=None):
+        self._db.execute(
+            "INSERT OR REPLACE INTO {0} (key, value, expires) "
+            "VALUES (?, ?, ?)".format(self.table),
+            (
+                self._key(key),
+                sqlite3.Binary(cPickle.dumps(value, 2)),
+                None if timeout is None else time.time() + timeout
+                ))
+
+    def delete(self, key):
+        self._db.execute(
+            "DELETE FROM {0} WHERE key = ?".format(self.table),
+            (self._key(key),))
+
+    def prune(self):
+        """
+        Drop every expired value
+        """
+        self._db.execute(
+            "DELETE FROM {0} WHERE expires <= ?".format(self.table),
+            (time.time(),))
+
+    def close(self):
+        self._db.close()
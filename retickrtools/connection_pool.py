@@ -0,0 +1,308 @@
+# Universe imports
+import functools
+import socket
+import time
+import urllib
+
+# Thirdparty imports
+from eventlet.green import urllib2, httplib
+from eventlet.green import socket as green_socket
+
+# Retickr imports
+from retickrtools.dns_cache import default_dns_cache
+
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+class ConnectionPool(object):
+    """
+    Idle HTTP keep-alive connections keyed on (scheme, host, port), so
+    that consecutive requests to the same host skip the TCP and TLS
+    handshakes. At most max_per_host idle connections are kept for any
+    one host and a connection that has sat idle for longer than
+    idle_timeout seconds is closed rather than reused.
+
+    >>> pool = ConnectionPool(max_per_host=1)
+    >>> class Conn(object):
+    ...     def close(self):
+    ...         print "closed"
+    >>> key = ("http", "example.com", 80)
+    >>> first, second = Conn(), Conn()
+    >>> pool.put(key, first)
+    >>> pool.put(key, second)
+    closed
+    >>> pool.get(key) is first
+    True
+    >>> pool.get(key) is None
+    True
+    """
+
+    def __init__(self, max_per_host=8, idle_timeout=30):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._last_prune = time.time()
+
+    def get(self, key):
+        """
+        Take an idle connection for key out of the pool, or None if there
+        is no usable one
+        """
+        idle = self._idle.get(key)
+        now = time.time()
+        while idle:
+            conn, since = idle.pop()
+            if now - since < self.idle_timeout:
+                return conn
+            conn.close()
+        return None
+
+    def put(self, key, conn):
+        """
+        Hand a connection whose response has been read back to the pool
+        """
+        idle = self._idle.setdefault(key, [])
+        if len(idle) >= self.max_per_host:
+            conn.close()
+        else:
+            idle.append((conn, time.time()))
+
+        if time.time() - self._last_prune > self.idle_timeout:
+            self.prune()
+
+    def prune(self):
+        """
+        Close every connection that has been idle for too long
+        """
+        now = time.time()
+        for key, idle in self._idle.items():
+            for conn, since in idle:
+                if now - since >= self.idle_timeout:
+                    conn.close()
+            idle[:] = [
+                (conn, since)
+                for conn, since
+                in idle
+                if now - since < self.idle_timeout
+                ]
+            if not idle:
+                del self._idle[key]
+        self._last_prune = now
+
+    def close(self):
+        """
+        Close every idle connection
+        """
+        for idle in self._idle.values():
+            for conn, since in idle:
+                conn.close()
+        self._idle = {}
+
+    def __len__(self):
+        return sum(len(idle) for idle in self._idle.values())
+
+
+# The pool shared by event_network and feedparser unless they are handed
+# one of their own
+default_pool = ConnectionPool()
+
+
+def create_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                      source_address=None, trace=None, dns_cache=None):
+    """
+    socket.create_connection, except that the host is looked up through
+    dns_cache (default_dns_cache if None) and the time taken to look up
+    the host and to connect to it are put in the trace dict (if one is
+    given) under "dns" and "connect"
+    """
+    if dns_cache is None:
+        dns_cache = default_dns_cache
+
+    host, port = address
+    start = time.time()
+    addresses = dns_cache.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    resolved = time.time()
+
+    err = None
+    for family, socktype, proto, canonname, sockaddr in addresses:
+        sock = None
+        try:
+            sock = green_socket.socket(family, socktype, proto)
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            break
+        except socket.error, err:
+            if sock is not None:
+                sock.close()
+            sock = None
+
+    if trace is not None:
+        trace["dns"] = resolved - start
+        trace["connect"] = time.time() - resolved
+
+    if sock is None:
+        raise err or socket.error("getaddrinfo returns an empty list")
+    return sock
+
+
+class _PooledResponse(object):
+    """
+    Wraps an httplib response and returns its connection to the pool as
+    soon as the body has been read to the end. A response which is closed
+    before then takes its connection down with it since the unread part
+    of the body is still on the wire.
+    """
+
+    def __init__(self, response, conn, pool, key):
+        self._response = response
+        self._conn = conn
+        self._pool = pool
+        self._key = key
+
+    def _release(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool.put(self._key, conn)
+        else:
+            conn.close()
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    # socket._fileobject reads through recv
+    recv = read
+
+    def close(self):
+        self._release()
+        self._response.close()
+
+    def fileno(self):
+        return self._response.fileno()
+
+
+class KeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+    """
+    A urllib2 handler for http and https which takes its connections
+    from a ConnectionPool instead of opening and closing one for every
+    request, and looks hosts up through a DNSCache. It replaces the
+    default handlers when given to urllib2.build_opener.
+    """
+
+    def __init__(self, pool=None, debuglevel=0, dns_cache=None):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool if pool is not None else default_pool
+        self.dns_cache = dns_cache
+
+    def http_open(self, req):
+        return self._open(req, "http", httplib.HTTPConnection)
+
+    def https_open(self, req):
+        return self._open(req, "https", httplib.HTTPSConnection)
+
+    http_request = urllib2.AbstractHTTPHandler.do_request_
+    https_request = urllib2.AbstractHTTPHandler.do_request_
+
+    def _open(self, req, scheme, connection_class):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError("no host given")
+
+        hostname, port = urllib.splitport(host)
+        port = int(port) if port else DEFAULT_PORTS[scheme]
+        key = (scheme, hostname.lower(), port, req._tunnel_host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict(
+            (k, v)
+            for k, v
+            in req.headers.items()
+            if k not in headers
+            ))
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        tunnel_headers = {}
+        if req._tunnel_host and "Proxy-Authorization" in headers:
+            tunnel_headers["Proxy-Authorization"] = headers.pop("Proxy-Authorization")
+
+        # A dict for timings and the like can be hung on the request
+        trace = getattr(req, "trace", None)
+
+        conn = self.pool.get(key)
+        while True:
+            reused = conn is not None
+            if not reused:
+                conn = connection_class(hostname, port, timeout=req.timeout)
+                conn.set_debuglevel(self._debuglevel)
+                conn._create_connection = functools.partial(
+                    create_connection, trace=trace, dns_cache=self.dns_cache)
+                if req._tunnel_host:
+                    conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+            else:
+                # The socket still has the timeout of the request it was
+                # opened for
+                conn.timeout = req.timeout
+                if req.timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+                    conn.sock.settimeout(socket.getdefaulttimeout())
+                else:
+                    conn.sock.settimeout(req.timeout)
+
+            try:
+                start = time.time()
+                if not reused:
+                    conn.connect()
+                    if trace is not None and scheme == "https":
+                        trace["tls"] = time.time() - start - trace["dns"] - trace["connect"]
+
+                sent = time.time()
+                conn.request(req.get_method(), req.get_selector(), req.data, headers)
+                response = conn.getresponse(buffering=True)
+                break
+            except (socket.error, httplib.HTTPException), err:
+                conn.close()
+                # The server may have dropped a connection while it sat
+                # in the pool, in which case try once more on a fresh one
+                if reused:
+                    conn = None
+                elif isinstance(err, socket.error):
+                    raise urllib2.URLError(err)
+                else:
+                    raise
+
+        if trace is not None:
+            trace["reused"] = reused
+            trace["ttfb"] = time.time() - sent
+            trace["status"] = response.status
+
+        fp = socket._fileobject(
+            _PooledResponse(response, conn, self.pool, key),
+            close=True
+            )
+
+        resp = urllib2.addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+
+def build_opener(*handlers, **kwargs):
+    """
+    A urllib2 opener whose http and https requests go through
+    KeepAliveHandler and reuse the connections in pool (default_pool
+    unless one is given), looking hosts up through dns_cache
+    (default_dns_cache unless one is given)
+    """
+    pool = kwargs.pop("pool", None)
+    dns_cache = kwargs.pop("dns_cache", None)
+    return urllib2.build_opener(
+        KeepAliveHandler(pool, dns_cache=dns_cache),
+        *handlers
+        )
@@ -0,0 +1,170 @@
+# Universe imports
+import collections
+import socket
+import time
+
+# Thirdparty imports
+import eventlet
+from eventlet.green import socket as green_socket
+
+# Retickr imports
+from retickrtools.singleflight import SingleFlight
+
+try:
+    # Only used to learn the TTL of the records behind an answer
+    dns_resolver = eventlet.import_patched("dns.resolver")
+except ImportError:
+    dns_resolver = None
+
+
+def _is_address(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except socket.error:
+            pass
+    return False
+
+
+class DNSCache(object):
+    """
+    Remembers the answers to getaddrinfo so that fetching many uris from
+    the same hosts doesn't ask the resolver about each host over and over.
+
+    An answer is kept for the TTL of its DNS records when dnspython is
+    installed to tell what that is (at the cost of one more query, given
+    half a second), otherwise for ttl seconds, and in
+    either case for no less than min_ttl and no more than max_ttl seconds.
+    Lookups that fail are remembered for negative_ttl seconds so that a
+    batch of uris on a dead domain only asks once. At most max_entries
+    answers are kept, the least recently used are forgotten first.
+
+    >>> cache = DNSCache(max_entries=2)
+    >>> addresses = cache.getaddrinfo("127.0.0.1", 80, 0, socket.SOCK_STREAM)
+    >>> addresses[0][4]
+    ('127.0.0.1', 80)
+    >>> cache.lookup("127.0.0.1", 80, 0, socket.SOCK_STREAM) == addresses
+    True
+    >>> cache.store_error(socket.gaierror(socket.EAI_NONAME, "not known"),
+    ...                   "nowhere.invalid", 80)
+    >>> cache.getaddrinfo("nowhere.invalid", 80)
+    Traceback (most recent call last):
+    ...
+    gaierror: [Errno -2] not known
+    >>> cache.store([], "a", 80)
+    >>> cache.store([], "b", 80)
+    >>> len(cache)
+    2
+    """
+
+    def __init__(self, max_entries=10000, ttl=300, negative_ttl=30,
+                 min_ttl=5, max_ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self._entries = collections.OrderedDict()
+        self._flight = SingleFlight()
+        self._resolver = None
+        if dns_resolver is not None:
+            # A TTL isn't worth holding the fetch up for long
+            self._resolver = dns_resolver.Resolver()
+            self._resolver.lifetime = 0.5
+
+    def _key(self, host, port, family=0, socktype=0, proto=0, flags=0):
+        return (host.lower(), port, family, socktype, proto, flags)
+
+    def _set(self, key, entry, ttl):
+        self._entries.pop(key, None)
+        self._entries[key] = entry + (time.time() + ttl,)
+        while self.max_entries is not None and len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def lookup(self, host, port, family=0, socktype=0, proto=0, flags=0):
+        """
+        The cached answer to getaddrinfo with these arguments, or None if
+        there isn't one. A cached failure is raised again.
+        """
+        key = self._key(host, port, family, socktype, proto, flags)
+        try:
+            addresses, error, expires = self._entries.pop(key)
+        except KeyError:
+            return None
+
+        if expires <= time.time():
+            return None
+
+        # Re-insert the key so that it is now the most recently used
+        self._entries[key] = (addresses, error, expires)
+        if error is not None:
+            raise error
+        return addresses
+
+    def store(self, addresses, host, port, family=0, socktype=0, proto=0,
+              flags=0, ttl=None):
+        """
+        Remember the answer getaddrinfo gave for ttl seconds (the cache's
+        default ttl if None)
+        """
+        ttl = self.ttl if ttl is None else ttl
+        ttl = min(self.max_ttl, max(self.min_ttl, ttl))
+        key = self._key(host, port, family, socktype, proto, flags)
+        self._set(key, (addresses, None), ttl)
+
+    def store_error(self, error, host, port, family=0, socktype=0, proto=0,
+                    flags=0):
+        """
+        Remember that getaddrinfo raised error for negative_ttl seconds
+        """
+        key = self._key(host, port, family, socktype, proto, flags)
+        self._set(key, (None, error), self.negative_ttl)
+
+    def _record_ttl(self, host, addresses):
+        # The TTL of the address records for host, None if it can't be told.
+        # One query is made, for the records of the family getaddrinfo
+        # answered with first
+        if self._resolver is None or not addresses or _is_address(host):
+            return None
+        rdtype = "AAAA" if addresses[0][0] == socket.AF_INET6 else "A"
+        try:
+            return self._resolver.query(host, rdtype).rrset.ttl
+        except Exception:
+            return None
+
+    def _resolve(self, host, port, family, socktype, proto, flags):
+        try:
+            addresses = green_socket.getaddrinfo(host, port, family, socktype, proto, flags)
+        except socket.gaierror, e:
+            self.store_error(e, host, port, family, socktype, proto, flags)
+            raise
+
+        self.store(addresses, host, port, family, socktype, proto, flags,
+                   ttl=self._record_ttl(host, addresses))
+        return addresses
+
+    def getaddrinfo(self, host, port, family=0, socktype=0, proto=0, flags=0):
+        """
+        socket.getaddrinfo, answered from the cache where it can be.
+        Green threads after the same host at once share one lookup.
+        """
+        addresses = self.lookup(host, port, family, socktype, proto, flags)
+        if addresses is not None:
+            return addresses
+
+        return self._flight.do(
+            self._key(host, port, family, socktype, proto, flags),
+            self._resolve, host, port, family, socktype, proto, flags
+            )
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# The cache shared by every fetch in the process unless one is handed a
+# cache of its own
+default_dns_cache = DNSCache()
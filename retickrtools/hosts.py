@@ -0,0 +1,329 @@
+# Universe imports
+import collections
+import heapq
+import math
+import time
+import urlparse
+
+# Thirdparty imports
+import eventlet
+import eventlet.queue
+
+
+def host_key(uri):
+    """
+    The (scheme, host) a uri is fetched from
+
+    >>> host_key("http://Example.com:8080/a?b=c")
+    ('http', 'example.com:8080')
+    """
+    parts = urlparse.urlsplit(uri)
+    return parts.scheme, parts.netloc.lower()
+
+
+class HostScheduler(object):
+    """
+    Runs a function over uris in a GreenPool while being polite to the
+    hosts they point at. No more than max_per_host uris (None for no
+    limit) are in flight against a host at once and consecutive requests
+    to a host are started at least min_delay seconds apart.
+
+    Uris are only handed to the pool once their host is free to take
+    them, round robin across hosts, so that a batch dominated by one
+    host does not fill the pool with green threads waiting on it while
+    other hosts sit idle.
+
+    >>> scheduler = HostScheduler(max_per_host=1)
+    >>> sorted(scheduler.imap(eventlet.GreenPool(), len, ["http://a/1", "http://a/22", "http://b/1"]))
+    [10, 10, 11]
+    >>> HostScheduler(max_per_host=0)
+    Traceback (most recent call last):
+    ...
+    ValueError: max_per_host must be at least 1, not 0
+    """
+
+    def __init__(self, max_per_host=None, min_delay=0, key=host_key):
+        if max_per_host is not None and max_per_host < 1:
+            raise ValueError("max_per_host must be at least 1, not {0}".format(max_per_host))
+        self.max_per_host = max_per_host
+        self.min_delay = min_delay
+        self.key = key
+
+    def imap(self, pool, func, uris):
+        """
+        Yield func(uri) for each of uris as they complete, which is not
+        necessarily the order they were given in. An exception raised by
+        func is raised here once the uris in flight have finished.
+        """
+        if self.max_per_host is None and not self.min_delay:
+            # Nothing to be polite about, so no reason to look at hosts
+            return self._imap_unlimited(pool, func, uris)
+        return self._imap_polite(pool, func, uris)
+
+    def _imap_unlimited(self, pool, func, uris):
+        done = eventlet.queue.Queue()
+        in_flight = 0
+        error = None
+
+        def run(uri):
+            try:
+                done.put((True, func(uri)))
+            except Exception, e:
+                done.put((False, e))
+
+        uris = iter(uris)
+        while True:
+            # pool.spawn_n would block once the pool is full, leaving
+            # finished results to pile up unread, so only fill free slots
+            while error is None and (pool.free() > 0 or not in_flight):
+                uri = next(uris, None)
+                if uri is None:
+                    break
+                pool.spawn_n(run, uri)
+                in_flight += 1
+
+            if not in_flight:
+                break
+
+            ok, value = done.get()
+            in_flight -= 1
+            if ok:
+                yield value
+            elif error is None:
+                error = value
+
+        if error is not None:
+            raise error
+
+    def _imap_polite(self, pool, func, uris):
+        # Hosts with uris waiting are either in ready, in the order they
+        # will next be given a turn, in delayed, a heap of the hosts
+        # waiting out min_delay, or at max_per_host, in which case they are
+        # put back in ready when one of their uris finishes. So each uri
+        # started or finished only touches its own host.
+        waiting = {}
+        ready = collections.deque()
+        for uri in uris:
+            host = self.key(uri)
+            if host not in waiting:
+                waiting[host] = collections.deque()
+                ready.append(host)
+            waiting[host].append(uri)
+
+        delayed = []
+        scheduled = set(ready)
+        in_flight = collections.defaultdict(int)
+        total_in_flight = 0
+        next_start = {}
+        done = eventlet.queue.Queue()
+        error = None
+
+        def run(host, uri):
+            try:
+                done.put((host, True, func(uri)))
+            except Exception, e:
+                done.put((host, False, e))
+
+        def schedule(host, now):
+            scheduled.add(host)
+            if next_start.get(host, 0) > now:
+                heapq.heappush(delayed, (next_start[host], host))
+            else:
+                ready.append(host)
+
+        while waiting or total_in_flight:
+            now = time.time()
+            while delayed and delayed[0][0] <= now:
+                ready.append(heapq.heappop(delayed)[1])
+
+            # Hand out one uri per host per turn so hosts are interleaved,
+            # for as long as the pool has room
+            while ready and error is None and (pool.free() > 0 or not total_in_flight):
+                host = ready.popleft()
+                queue = waiting[host]
+                in_flight[host] += 1
+                total_in_flight += 1
+                next_start[host] = now + self.min_delay
+                pool.spawn_n(run, host, queue.popleft())
+                scheduled.discard(host)
+                if not queue:
+                    del waiting[host]
+                elif self.max_per_host is None or in_flight[host] < self.max_per_host:
+                    schedule(host, now)
+
+            if not total_in_flight:
+                if error is not None or not waiting:
+                    break
+                # Every host with work left is waiting out its delay
+                eventlet.sleep(max(0, delayed[0][0] - time.time()) if delayed else 0)
+                continue
+
+            try:
+                timeout = max(0, delayed[0][0] - time.time()) if delayed else None
+                host, ok, value = done.get(timeout=timeout)
+            except eventlet.queue.Empty:
+                continue
+
+            in_flight[host] -= 1
+            total_in_flight -= 1
+            if ok:
+                yield value
+            elif error is None:
+                error = value
+                waiting.clear()
+                ready.clear()
+                del delayed[:]
+            if host in waiting and host not in scheduled:
+                schedule(host, time.time())
+
+        if error is not None:
+            raise error
+
+
+class CircuitOpen(Exception):
+    """
+    Raised in place of making a request to a host whose circuit breaker
+    has tripped
+    """
+
+
+class HostHealth(object):
+    """
+    Keeps track of how each host has been answering so that requests to it
+    can be given a timeout to suit, and so that a host which keeps failing
+    is left alone for a while instead of holding green threads for the
+    full timeout every time.
+
+    Once a host has answered min_samples requests its timeout is
+    multiplier times the 95th percentile of its last window response
+    times, kept between min_timeout and the caller's own timeout. A
+    request that times out counts as taking its whole timeout, so the
+    timeout of a host that has slowed down grows back.
+
+    After failure_threshold failures in a row (None to never trip) a host
+    is not tried again for reset_after seconds, then one request is let
+    through to see whether it has recovered.
+
+    >>> health = HostHealth(min_samples=3, min_timeout=0.5)
+    >>> health.timeout("http://a/", 15)
+    15
+    >>> for seconds in (0.1, 0.2, 0.3):
+    ...     health.record_success("http://a/", seconds)
+    >>> health.timeout("http://a/x", 15)
+    0.6
+    >>> health = HostHealth(failure_threshold=2)
+    >>> health.record_failure("http://a/")
+    >>> health.available("http://a/")
+    True
+    >>> health.record_failure("http://a/")
+    >>> health.available("http://a/")
+    False
+    """
+
+    def __init__(self, window=100, min_samples=20, multiplier=2,
+                 min_timeout=1, failure_threshold=5, reset_after=30,
+                 key=host_key):
+        self.window = window
+        self.min_samples = min_samples
+        self.multiplier = multiplier
+        self.min_timeout = min_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.key = key
+        self._latencies = {}
+        self._failures = collections.defaultdict(int)
+        self._opened = {}
+
+    def _samples(self, uri):
+        host = self.key(uri)
+        if host not in self._latencies:
+            self._latencies[host] = collections.deque(maxlen=self.window)
+        return self._latencies[host]
+
+    def percentile(self, uri, percent=95):
+        """
+        The response time within which percent of the recent requests to
+        the host of uri were answered, None if there have been none
+        """
+        samples = sorted(self._samples(uri))
+        if not samples:
+            return None
+        index = int(math.ceil(percent / 100.0 * len(samples))) - 1
+        return samples[max(0, index)]
+
+    def timeout(self, uri, timeout):
+        """
+        The timeout to use for a request to uri, no longer than timeout
+        """
+        if len(self._samples(uri)) < self.min_samples:
+            return timeout
+        adaptive = self.percentile(uri) * self.multiplier
+        return min(timeout, max(self.min_timeout, adaptive))
+
+    def available(self, uri):
+        """
+        False while the circuit breaker for the host of uri is open
+        """
+        host = self.key(uri)
+        opened = self._opened.get(host)
+        if opened is None:
+            return True
+        if time.time() - opened < self.reset_after:
+            return False
+        # Let this request through as a trial, the rest wait for it
+        self._opened[host] = time.time()
+        return True
+
+    def record_success(self, uri, seconds):
+        host = self.key(uri)
+        self._samples(uri).append(seconds)
+        self._failures[host] = 0
+        self._opened.pop(host, None)
+
+    def record_failure(self, uri, seconds=None):
+        """
+        Note a failed request to uri, if it timed out seconds is the
+        timeout it was given
+        """
+        host = self.key(uri)
+        if seconds is not None:
+            self._samples(uri).append(seconds)
+        self._failures[host] += 1
+        if self.failure_threshold is not None and self._failures[host] >= self.failure_threshold:
+            self._opened[host] = time.time()
+
+
+class RetryBudget(object):
+    """
+    Limits retries to a fraction of the requests made, so that retrying
+    can not multiply the load on hosts that are already struggling. Every
+    request deposits ratio of a retry, up to a reserve of at most reserve
+    retries, and every retry withdraws one.
+
+    >>> budget = RetryBudget(ratio=0.5, reserve=1)
+    >>> budget.withdraw(), budget.withdraw()
+    (True, False)
+    >>> budget.deposit(); budget.deposit()
+    >>> budget.withdraw()
+    True
+    """
+
+    def __init__(self, ratio=0.1, reserve=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.balance = float(reserve)
+
+    def deposit(self):
+        self.balance = min(self.reserve, self.balance + self.ratio)
+
+    def withdraw(self):
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
+
+
+# A health and retry budget for the callers of event_network and feedparser
+# that want to share them across the process; neither is used unless given
+default_health = HostHealth()
+default_retry_budget = RetryBudget()
@@ -1,33 +1,233 @@
 # Universe imports
+import collections
 import hashlib
 import json
+import random
+import socket
+import time
+import zlib
 
 # Thirdparty imports
 import eventlet
 from eventlet.green import urllib2, httplib
 
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
-def decompress_data(compressed_data):
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+# Retickr imports
+from retickrtools.connection_pool import build_opener
+from retickrtools.hosts import HostScheduler, CircuitOpen
+from retickrtools.singleflight import default_flight
+from retickrtools.stats import new_trace
+
+
+# The fastest JSON decoder installed, which event_network can be asked to
+# use. Note that simplejson returns str rather than unicode for ascii strings
+if ujson is not None:
+    fast_json_loads = ujson.loads
+elif simplejson is not None:
+    fast_json_loads = simplejson.loads
+else:
+    fast_json_loads = json.loads
+
+
+class ResponseTooLarge(Exception):
+    """
+    Raised when a response body is larger than the caller is willing to
+    hold, either as it came over the wire or once decompressed
+    """
+
+
+class StaleableResponse(collections.namedtuple("StaleableResponse", "data fresh_until")):
+    """
+    What event_network caches with stale_while_revalidate: a response and
+    the time it stops being fresh. Its len is that of the response, so a
+    cache that sizes its values with len, as LRUCache does for max_bytes,
+    counts the response rather than the pair.
+
+    >>> len(StaleableResponse("12345", 0))
+    5
+    """
+    __slots__ = ()
+
+    def __len__(self):
+        return len(self.data)
+
+
+# The wbits zlib needs to take apart each Content-Encoding
+ZLIB_WBITS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": -zlib.MAX_WBITS,
+}
+
+
+def decompress_chunks(chunks, encoding="gzip", max_bytes=None):
+    """
+    Decompress an iterable of gzip (or raw deflate) compressed chunks,
+    yielding the decompressed data as it comes. ResponseTooLarge is raised
+    as soon as the output passes max_bytes, without inflating the rest.
+
+    >>> compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    >>> gzipped = compressor.compress("a" * 1000) + compressor.flush()
+    >>> len("".join(decompress_chunks([gzipped[:10], gzipped[10:]])))
+    1000
+    >>> list(decompress_chunks([gzipped], max_bytes=999))
+    Traceback (most recent call last):
+        ...
+    ResponseTooLarge: more than 999 bytes once decompressed
+    """
+    wbits = ZLIB_WBITS[encoding]
+    decompressor = zlib.decompressobj(wbits)
+    size = 0
+
+    for chunk in chunks:
+        while chunk:
+            # Never inflate more than one byte past the limit
+            limit = max_bytes - size + 1 if max_bytes is not None else 0
+            data = decompressor.decompress(chunk, limit)
+            size += len(data)
+            if max_bytes is not None and size > max_bytes:
+                raise ResponseTooLarge(
+                    "more than {0} bytes once decompressed".format(max_bytes))
+            if data:
+                yield data
+
+            chunk = decompressor.unconsumed_tail
+            if not chunk and decompressor.unused_data:
+                # A gzip stream may hold several members back to back
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(wbits)
+
+    data = decompressor.flush()
+    size += len(data)
+    if max_bytes is not None and size > max_bytes:
+        raise ResponseTooLarge(
+            "more than {0} bytes once decompressed".format(max_bytes))
+    if data:
+        yield data
+
+
+def decompress_data(compressed_data, max_bytes=None):
     """
     Decompress the gzipped data.
     """
-    import StringIO
-    import gzip
+    return "".join(decompress_chunks([compressed_data], max_bytes=max_bytes))
+
+
+def _header(resp, name):
+    # Files and strings opened in place of a url have no headers
+    if not hasattr(resp, "info"):
+        return None
+    return resp.info().getheader(name)
+
+
+def read_chunks(resp, max_bytes=None, chunk_size=64 * 1024):
+    """
+    Yield the body of a urllib2 response chunk by chunk, raising
+    ResponseTooLarge as soon as it is clear that more than max_bytes are
+    coming
+    """
+    length = _header(resp, "Content-Length")
+    if max_bytes is not None and length and length.isdigit() and int(length) > max_bytes:
+        raise ResponseTooLarge("Content-Length of {0} bytes".format(length))
+
+    size = 0
+    while True:
+        chunk = resp.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if max_bytes is not None and size > max_bytes:
+            raise ResponseTooLarge("more than {0} bytes".format(max_bytes))
+        yield chunk
 
-    compressed_stream = StringIO.StringIO(compressed_data)
 
-    gzipper = gzip.GzipFile(fileobj=compressed_stream)
+def _timed_chunks(chunks, trace):
+    """
+    Pass chunks through, adding up the time spent waiting for them and
+    their size in trace["download"] and trace["bytes"]
+    """
+    trace["download"] = 0.0
+    trace["bytes"] = 0
+    while True:
+        start = time.time()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            trace["download"] += time.time() - start
+            return
+        trace["download"] += time.time() - start
+        trace["bytes"] += len(chunk)
+        yield chunk
 
-    return gzipper.read()
 
+def read_body(resp, max_bytes=None, max_compressed_bytes=None, trace=None):
+    """
+    Read the body of a urllib2 response (or a file), decompressing it as
+    it arrives if it was sent gzip or deflate encoded. No more than
+    max_compressed_bytes are read off the wire nor max_bytes held once
+    decompressed, beyond which ResponseTooLarge is raised.
 
-def md5(str_):
-    md5 = hashlib.md5()    
-    md5.update(str_)
+    If trace is a dict the time spent downloading and decompressing the
+    body and its size before and after are put in it
+    """
+    encoding = _header(resp, "Content-Encoding")
+    start = time.time()
+
+    try:
+        if encoding in ZLIB_WBITS:
+            chunks = read_chunks(resp, max_compressed_bytes)
+        else:
+            # Nothing to decompress, so the tighter limit applies on the wire
+            limits = [l for l in (max_bytes, max_compressed_bytes) if l is not None]
+            chunks = read_chunks(resp, min(limits) if limits else None)
+
+        if trace is not None:
+            chunks = _timed_chunks(chunks, trace)
+
+        if encoding in ZLIB_WBITS:
+            data = "".join(decompress_chunks(chunks, encoding, max_bytes))
+        else:
+            data = "".join(chunks)
+
+    except ResponseTooLarge:
+        # Whatever is left of the body is never read, so the connection
+        # can not be reused
+        resp.close()
+        raise
+
+    if trace is not None:
+        if encoding in ZLIB_WBITS:
+            trace["decompress"] = time.time() - start - trace["download"]
+        trace["size"] = len(data)
+    return data
+
+
+def md5(*strs):
+    """
+    The hex md5 digest of one or more strings taken together
+
+    >>> md5("retickr")
+    'a868af2eb0aef111e3f627b1bc4a58f0'
+    >>> md5("ret", "ickr") == md5("retickr")
+    True
+    """
+    md5 = hashlib.md5()
+    for str_ in strs:
+        if isinstance(str_, unicode):
+            str_ = str_.encode("utf-8")
+        md5.update(str_)
     return md5.hexdigest()
 
 
-def event_network(
+def event_network_iter(
     uris,
     timeout=15,
     greenpoolsize=1000,
@@ -38,12 +238,34 @@ def event_network(
     filter_out_empty_responses=True,
     cache=None,
     cache_prefix="event_network",
-    cache_length=300
+    cache_length=300,
+    connection_pool=None,
+    dns_cache=None,
+    max_per_host=None,
+    min_host_delay=0,
+    max_bytes=None,
+    max_compressed_bytes=None,
+    errors=None,
+    stale_while_revalidate=0,
+    single_flight=None,
+    retries=0,
+    retry_backoff=0.5,
+    retry_budget=None,
+    host_health=None,
+    stats=None,
+    json_loads=None,
+    json_pool=None,
+    json_pool_min_bytes=256 * 1024
 ):
     """
-    Given a list of uris to pull over network pull them and then
-    return a dictionary of their responses keyed on the uri which was
-    originally requested
+    Given a list of uris to pull over network pull them and yield a
+    (uri, response) tuple for each as soon as it arrives, so that the
+    responses can be put to work while the slower uris are still being
+    fetched. Takes the same arguments as event_network.
+
+    New fetches are only started while the generator is being iterated,
+    so no more than greenpoolsize responses are ever waiting on a slow
+    consumer
     """
 
     # Now, using eventlet go and fetch all of those links
@@ -52,70 +274,346 @@ def event_network(
     else:
         pool = greenpool
 
+    opener = build_opener(pool=connection_pool, dns_cache=dns_cache)
+    scheduler = HostScheduler(max_per_host, min_host_delay)
+    flight = single_flight if single_flight is not None else default_flight
+    health = host_health
+    budget = retry_budget
+    header_key = tuple(sorted(headers.items())) if headers else ()
+    loads = json_loads if json_loads is not None else json.loads
+
+    def fetch_once(link, link_timeout, trace):
+        """
+        Make a single attempt at pulling link, returns (data, None) or
+        (None, exception) and whether it is worth trying again
+        """
+        start = time.time()
+        timer = eventlet.Timeout(link_timeout)
+        try:
+            req = urllib2.Request(link)
+            req.trace = trace
+
+            if headers:
+                for k, v in headers.items():
+                    req.add_header(k, v)
+
+            # We want it compressed if we can have it that way
+            req.add_header("Accept-encoding", "gzip")
+
+            resp = opener.open(req)
+
+            # Read the body, decompressing it on the way in if it
+            # arrived compressed
+            data = read_body(resp, max_bytes, max_compressed_bytes, trace)
+
+        except eventlet.Timeout, e:
+            if e is not timer:
+                raise
+            if health is not None:
+                health.record_failure(link, link_timeout)
+            return (None, e), True
+
+        except urllib2.HTTPError, e:
+            if trace is not None:
+                trace["status"] = e.code
+            # The host is up, but only a server error might go away
+            if health is None:
+                pass
+            elif e.code >= 500:
+                health.record_failure(link)
+            else:
+                health.record_success(link, time.time() - start)
+            return (None, e), e.code >= 500
+
+        except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+            if health is not None:
+                health.record_failure(link)
+            return (None, e), True
+
+        except (ResponseTooLarge, ValueError, zlib.error), e:
+            # Too big, not a uri urllib2 can open, or a body that claims to
+            # be compressed but isn't; trying again won't help
+            return (None, e), False
+
+        finally:
+            timer.cancel()
+
+        if health is not None:
+            health.record_success(link, time.time() - start)
+        return (data, None), False
+
+    def fetch(link, cache_key=None, trace=None):
+        """
+        Pull link over the network, retrying as allowed, and cache it under
+        cache_key, returns (data, None) or (None, exception) if it can't be
+        had
+        """
+        if budget is not None:
+            budget.deposit()
+        attempt = 0
+        while True:
+            link_timeout = timeout
+            if health is not None:
+                if not health.available(link):
+                    return (None, CircuitOpen(link))
+                link_timeout = health.timeout(link, timeout)
+
+            if trace is not None:
+                trace["attempts"] = attempt + 1
+            (data, error), retry = fetch_once(link, link_timeout, trace)
+            if error is not None:
+                if not retry or attempt >= retries or \
+                        (budget is not None and not budget.withdraw()):
+                    return (None, error)
+                # Back off for a random time, up to twice as long as the
+                # time before, so that retries don't arrive in a herd
+                attempt += 1
+                eventlet.sleep(random.uniform(0, retry_backoff * 2 ** (attempt - 1)))
+                continue
+
+            if cache_key is None:
+                pass
+            elif stale_while_revalidate:
+                # Keep the response past its freshness so that it can
+                # be served while it is refetched
+                cache.set(
+                    cache_key,
+                    StaleableResponse(data, time.time() + cache_length),
+                    cache_length + stale_while_revalidate
+                    )
+            else:
+                cache.set(cache_key, data, cache_length)
+
+            return (data, None)
+
+    def refresh(flight_key, link, cache_key):
+        trace = new_trace(link) if stats is not None else None
+        try:
+            flight.do(flight_key, fetch, link, cache_key, trace, wait=False)
+        except Exception:
+            # The stale copy has been served already and the next request
+            # for it will try again
+            pass
+        if trace is not None and "attempts" in trace:
+            trace["cache"] = "refresh"
+            trace["total"] = time.time() - trace["start"]
+            stats.record(trace)
+
     def pull_link(link):
-        if cache is not None:
+        trace = new_trace(link) if stats is not None else None
+
+        if cache is None:
+            cache_key = None
+            flight_key = ("fetch", link, header_key, max_bytes, max_compressed_bytes)
+
+        else:
             # Check for the response in cache
-            cache_key = "{0}::{1}".format(cache_prefix, md5(link))
+            if stale_while_revalidate:
+                cache_key = "{0}::swr::{1}".format(cache_prefix, md5(link))
+            else:
+                cache_key = "{0}::{1}".format(cache_prefix, md5(link))
+            flight_key = ("cache", id(cache), cache_key)
+
             response = cache.get(cache_key)
+            if response is not None and stale_while_revalidate:
+                response, fresh_until = response
+                if fresh_until <= time.time():
+                    # Serve the stale copy and refresh it in the background
+                    eventlet.spawn_n(refresh, flight_key, link, cache_key)
+                    if trace is not None:
+                        trace["cache"] = "stale"
+
+            if trace is not None:
+                trace.setdefault("cache", "miss" if response is None else "hit")
+                trace["total"] = time.time() - trace["start"]
+
             if response is not None:
-                return link, response
+                return link, response, trace, None
+
+        # Any other green thread after the same uri, in this call or
+        # another, waits for this fetch rather than making its own
+        try:
+            data, error = flight.do(flight_key, fetch, link, cache_key, trace, timeout=timeout)
+        except eventlet.Timeout, e:
+            data, error = None, e
 
-        with eventlet.timeout.Timeout(timeout, False) as timeout_obj:
-            try:
-                req = urllib2.Request(link)
+        if error is not None:
+            data = default_value
+            if errors is not None:
+                errors[link] = error
 
-                if headers:
-                    for k, v in headers.items():
-                        req.add_header(k, v)
+        if trace is not None:
+            if "attempts" not in trace:
+                trace["shared"] = True
+            if error is not None:
+                trace["error"] = error.__class__.__name__
+                trace["timeout"] = isinstance(error, eventlet.Timeout)
+            trace["total"] = time.time() - trace["start"]
+        return (link, data, trace, error)
 
-                # We want it compressed if we can have it that way
-                req.add_header("Accept-encoding", "gzip")
+    def decode(link, data, trace, failed=False):
+        """
+        Decode a JSON response, in json_pool if it is a big one, returns
+        None if it isn't JSON
+        """
+        start = time.time()
+        try:
+            if json_pool is not None and len(data) >= json_pool_min_bytes:
+                decoding = json_pool.apply_async(loads, (data,))
+                # Waiting on the AsyncResult would block every green
+                # thread, so poll it instead
+                while not decoding.ready():
+                    eventlet.sleep(0.005)
+                data = decoding.get()
+            else:
+                data = loads(data)
+        except ValueError, e:
+            # A uri that failed is decoded from default_value, which needn't
+            # be JSON; errors already says why it failed
+            if not failed:
+                if errors is not None:
+                    errors[link] = e
+                if trace is not None:
+                    trace["json_error"] = e.__class__.__name__
+            data = None
+        if trace is not None:
+            trace["json"] = time.time() - start
+        return data
 
-                resp = urllib2.urlopen(req)
+    def pull_and_decode(link):
+        link, data, trace, error = pull_link(link)
+        empty = data is None or len(data) == 0
 
-                data = resp.read()
+        # Is this JSON?  If so, parse it now, while other responses are
+        # still arriving
+        if treat_results_as_json and not (filter_out_empty_responses and empty):
+            data = decode(link, data, trace, failed=error is not None)
 
-                # If the data arrived compressed, decompress it
-                if "gzip" == resp.info().getheader("Content-Encoding"):
-                    data = decompress_data(data)
+        if trace is not None:
+            stats.record(trace)
+        return link, data, empty
 
-                if cache is not None:
-                    cache.set(cache_key, data, cache_length)
+    for link, data, empty in scheduler.imap(pool, pull_and_decode, set(uris)):
+        if filter_out_empty_responses and empty:
+            continue
+        yield link, data
 
-                return (link, data)
-                        
-            except (eventlet.Timeout, urllib2.HTTPError, httplib.BadStatusLine):
-                return (link, default_value)
 
-            finally:
-                timeout_obj.cancel()
+def event_network(
+    uris,
+    timeout=15,
+    greenpoolsize=1000,
+    greenpool=None,
+    headers=None,
+    treat_results_as_json=False,
+    default_value="",
+    filter_out_empty_responses=True,
+    cache=None,
+    cache_prefix="event_network",
+    cache_length=300,
+    connection_pool=None,
+    dns_cache=None,
+    max_per_host=None,
+    min_host_delay=0,
+    max_bytes=None,
+    max_compressed_bytes=None,
+    errors=None,
+    stale_while_revalidate=0,
+    single_flight=None,
+    retries=0,
+    retry_backoff=0.5,
+    retry_budget=None,
+    host_health=None,
+    stats=None,
+    json_loads=None,
+    json_pool=None,
+    json_pool_min_bytes=256 * 1024
+):
+    """
+    Given a list of uris to pull over network pull them and then
+    return a dictionary of their responses keyed on the uri which was
+    originally requested
 
-        return (link, default_value)
+    Connections are kept alive and reused across uris on the same host
+    through connection_pool, a retickrtools.connection_pool.ConnectionPool
+    (the process wide default_pool unless one is given). Hosts are looked
+    up through dns_cache, a retickrtools.dns_cache.DNSCache
+    (default_dns_cache unless one is given), so that each is only
+    resolved again once its DNS records expire
 
-    # Pull html for all of the links return a list of tuples in the
-    # form [(link, html), ...]
-    results = [
-        res
-        for res
-        in pool.imap(pull_link, list(set(uris)))
-        ]
+    Uris are interleaved across their hosts. No more than max_per_host
+    (None for no limit) are fetched from one host at a time, and requests
+    to a host start at least min_host_delay seconds apart
 
-    pool.waitall()
+    Bodies are decompressed as they are read. One that comes to more than
+    max_compressed_bytes over the wire or max_bytes once decompressed is
+    abandoned as soon as that is known. If errors is a dict, the exception
+    behind each uri that got default_value instead of a response is put
+    in it under the uri, a ResponseTooLarge for those that were too big
 
-    if filter_out_empty_responses:
-        results = filter(lambda (link, data): type(data) is not None and len(data) > 0, results)
+    Responses are kept in cache, anything with django's get / set
+    interface such as retickrtools.caches.LRUCache, ShelveCache or
+    SqliteCache, for cache_length seconds. With stale_while_revalidate
+    they are kept that many seconds longer, during which the stale copy
+    is returned straight away while it is refetched in the background.
 
-    results = dict(results)
+    Concurrent fetches of the same uri share one request and its result,
+    across every call in the process, through single_flight (a
+    retickrtools.singleflight.SingleFlight, default_flight unless one is
+    given)
 
-    # Is this JSON?  If so, try to parse it.
-    if treat_results_as_json:
-        tmp_dict = {}
-        for k, v in results.items():
-            try:
-                tmp_dict[k] = json.loads(v)
-            except ValueError:
-                tmp_dict[k] = None
+    If host_health is given, a retickrtools.hosts.HostHealth (pass
+    hosts.default_health to share one with the rest of the process), each
+    host's response times and failures are tracked by it. Requests to a
+    host with a record get a timeout fitted to how fast it usually
+    answers, no longer than timeout, and a host that keeps failing is not
+    tried again for a while; its uris get default_value and a CircuitOpen
+    error. Without it every request gets timeout. Timeouts, connection
+    errors and server errors are retried up to retries times with a
+    jittered exponential backoff starting at retry_backoff seconds, as far
+    as retry_budget (a retickrtools.hosts.RetryBudget, such as
+    hosts.default_retry_budget, if one is given) allows
 
-        results = tmp_dict
+    If stats is given, a retickrtools.stats.FetchStats or anything else
+    with a record method, a trace of each uri (see
+    retickrtools.stats.new_trace) is handed to it with the time spent on
+    each phase of the request, its size, status and how it was served
 
-    return results
+    With treat_results_as_json each response is decoded as soon as it
+    arrives by json_loads (json.loads unless another decoder is given,
+    fast_json_loads is the fastest one installed). If json_pool is a
+    multiprocessing.Pool, responses of json_pool_min_bytes or more are
+    decoded in it so that big ones don't hold up the rest; json_loads must
+    then be picklable. A response that is not JSON comes back as None with
+    its ValueError in errors.
+    """
+    return dict(event_network_iter(
+        uris,
+        timeout=timeout,
+        greenpoolsize=greenpoolsize,
+        greenpool=greenpool,
+        headers=headers,
+        treat_results_as_json=treat_results_as_json,
+        default_value=default_value,
+        filter_out_empty_responses=filter_out_empty_responses,
+        cache=cache,
+        cache_prefix=cache_prefix,
+        cache_length=cache_length,
+        connection_pool=connection_pool,
+        dns_cache=dns_cache,
+        max_per_host=max_per_host,
+        min_host_delay=min_host_delay,
+        max_bytes=max_bytes,
+        max_compressed_bytes=max_compressed_bytes,
+        errors=errors,
+        stale_while_revalidate=stale_while_revalidate,
+        single_flight=single_flight,
+        retries=retries,
+        retry_backoff=retry_backoff,
+        retry_budget=retry_budget,
+        host_health=host_health,
+        stats=stats,
+        json_loads=json_loads,
+        json_pool=json_pool,
+        json_pool_min_bytes=json_pool_min_bytes
+        ))
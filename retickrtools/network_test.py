@@ -0,0 +1,206 @@
+"""
+network_test.py runs event_network against a local HTTP server to check
+that connections are kept alive, hosts are not sent more than they are
+allowed at once, oversized responses are abandoned, stale responses are
+served while they are refreshed, concurrent fetches of a uri are shared,
+failing hosts trip their circuit breaker, retries stop when the budget
+runs out and hosts are looked up once.
+
+Run it from this directory with the top of the repository on the path:
+
+$ PYTHONPATH=.. python -m unittest network_test
+
+:author: Adam Haney
+:organization: Retickr, LLC
+:contact: adam.haney@retickr.com
+:license: Copyright (c) 2011 retickr, LLC
+"""
+
+import BaseHTTPServer
+import SocketServer
+import collections
+import threading
+import time
+import unittest
+
+import eventlet
+
+from retickrtools.caches import LRUCache
+from retickrtools.connection_pool import ConnectionPool
+from retickrtools.dns_cache import DNSCache
+from retickrtools.hosts import CircuitOpen, HostHealth, RetryBudget
+from retickrtools.network import ResponseTooLarge, event_network
+from retickrtools.singleflight import SingleFlight
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers /ok, /count (how many times it has been asked for), /slow
+    (after a fifth of a second), /big (10000 bytes) and /fail (a 503),
+    and keeps track of who asked for what
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split("?")[0]
+        with server.lock:
+            server.hits[path] += 1
+            server.ports.add(self.client_address[1])
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+            hits = server.hits[path]
+        try:
+            if path == "/slow":
+                time.sleep(0.2)
+            if path == "/fail":
+                self.send_error(503)
+                return
+            body = {"/count": str(hits), "/big": "x" * 10000}.get(path, "ok")
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hang up on purpose, on responses that are too big
+        pass
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.hits = collections.defaultdict(int)
+        self.ports = set()
+        self.active = 0
+        self.peak = 0
+
+
+class CountingDNSCache(DNSCache):
+    """
+    A DNSCache which remembers the hosts it had to ask the resolver about
+    """
+
+    def __init__(self, *args, **kwargs):
+        DNSCache.__init__(self, *args, **kwargs)
+        self.resolved = []
+
+    def _resolve(self, host, *args):
+        self.resolved.append(host)
+        return DNSCache._resolve(self, host, *args)
+
+
+class NetworkTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = Server(("127.0.0.1", 0), Handler)
+        cls.server.reset()
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.reset()
+        self.pool = ConnectionPool()
+
+    def tearDown(self):
+        # Hang up, so that the server's threads aren't left waiting on
+        # connections kept alive
+        self.pool.close()
+
+    def uri(self, path, host="127.0.0.1"):
+        return "http://{0}:{1}{2}".format(host, self.server.server_port, path)
+
+    def fetch(self, uris, **kwargs):
+        kwargs.setdefault("connection_pool", self.pool)
+        kwargs.setdefault("single_flight", SingleFlight())
+        kwargs.setdefault("timeout", 5)
+        return event_network(uris, **kwargs)
+
+    def test_keep_alive(self):
+        for i in range(3):
+            self.assertEqual(self.fetch([self.uri("/ok")]), {self.uri("/ok"): "ok"})
+        self.assertEqual(self.server.hits["/ok"], 3)
+        self.assertEqual(len(self.server.ports), 1)
+
+    def test_max_per_host(self):
+        uris = [self.uri("/slow?{0}".format(i)) for i in range(6)]
+        results = self.fetch(uris, max_per_host=2)
+        self.assertEqual(sorted(results), sorted(uris))
+        self.assertEqual(self.server.peak, 2)
+
+    def test_response_too_large(self):
+        errors = {}
+        results = self.fetch([self.uri("/big")], max_bytes=100, errors=errors)
+        self.assertEqual(results, {})
+        self.assertTrue(isinstance(errors[self.uri("/big")], ResponseTooLarge))
+
+    def test_stale_while_revalidate(self):
+        cache = LRUCache()
+        uri = self.uri("/count")
+        fetch = lambda: self.fetch([uri], cache=cache, cache_length=0.2,
+                                   stale_while_revalidate=60)
+        self.assertEqual(fetch(), {uri: "1"})
+        self.assertEqual(fetch(), {uri: "1"})
+        self.assertEqual(self.server.hits["/count"], 1)
+
+        # Stale now, so it is served as it is and refreshed behind it
+        eventlet.sleep(0.3)
+        self.assertEqual(fetch(), {uri: "1"})
+        eventlet.sleep(0.1)
+        self.assertEqual(self.server.hits["/count"], 2)
+        self.assertEqual(fetch(), {uri: "2"})
+
+    def test_single_flight(self):
+        flight = SingleFlight()
+        uri = self.uri("/slow")
+        fetches = [eventlet.spawn(self.fetch, [uri], single_flight=flight)
+                   for i in range(3)]
+        for fetch in fetches:
+            self.assertEqual(fetch.wait(), {uri: "ok"})
+        self.assertEqual(self.server.hits["/slow"], 1)
+
+    def test_circuit_breaker(self):
+        health = HostHealth(failure_threshold=2, reset_after=60)
+        uri = self.uri("/fail")
+        for i in range(2):
+            errors = {}
+            self.fetch([uri], host_health=health, errors=errors)
+            self.assertEqual(errors[uri].code, 503)
+
+        errors = {}
+        self.fetch([uri], host_health=health, errors=errors)
+        self.assertTrue(isinstance(errors[uri], CircuitOpen))
+        self.assertEqual(self.server.hits["/fail"], 2)
+
+    def test_retry_budget(self):
+        budget = RetryBudget(ratio=0, reserve=1)
+        uri = self.uri("/fail")
+        fetch = lambda: self.fetch([uri], retries=3, retry_backoff=0.01,
+                                   retry_budget=budget)
+        # One retry is all the budget has, then there are none
+        fetch()
+        self.assertEqual(self.server.hits["/fail"], 2)
+        fetch()
+        self.assertEqual(self.server.hits["/fail"], 3)
+
+    def test_dns_cache(self):
+        dns_cache = CountingDNSCache()
+        uris = [self.uri("/ok?{0}".format(i), host="localhost") for i in range(5)]
+        results = self.fetch(uris, dns_cache=dns_cache)
+        self.assertEqual(sorted(results), sorted(uris))
+        self.assertEqual(dns_cache.resolved, ["localhost"])
@@ -0,0 +1,65 @@
+# Thirdparty imports
+import eventlet
+import eventlet.event
+
+
+class SingleFlight(object):
+    """
+    Makes green threads that ask for the same key at the same time share
+    a single call. The first to arrive makes the call, the rest wait for
+    it and get its return value (or exception) too.
+
+    >>> flight = SingleFlight()
+    >>> calls = []
+    >>> def fetch(uri):
+    ...     calls.append(uri)
+    ...     eventlet.sleep(0.01)
+    ...     return uri.upper()
+    >>> pile = eventlet.GreenPile()
+    >>> for i in range(3):
+    ...     pile.spawn(flight.do, "a", fetch, "a")
+    >>> list(pile), calls
+    (['A', 'A', 'A'], ['a'])
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Call func(*args) unless a call for key is already in flight, in
+        which case wait for it. A waiter gives up with eventlet.Timeout
+        after timeout seconds (None to wait for as long as it takes), and
+        with wait=False returns None straight away instead.
+        """
+        wait = kwargs.pop("wait", True)
+        timeout = kwargs.pop("timeout", None)
+
+        event = self._calls.get(key)
+        if event is not None:
+            if not wait:
+                return None
+            with eventlet.Timeout(timeout):
+                return event.wait()
+
+        event = self._calls[key] = eventlet.event.Event()
+        try:
+            result = func(*args)
+        except BaseException, e:
+            del self._calls[key]
+            event.send_exception(e)
+            raise
+
+        del self._calls[key]
+        event.send(result)
+        return result
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    def __len__(self):
+        return len(self._calls)
+
+
+# The process wide SingleFlight shared by every call to event_network
+default_flight = SingleFlight()
@@ -69,6 +69,37 @@ ACCEPT_HEADER = "application/atom+xml,application/rdf+xml,application/rss+xml,ap
 # of pre-installed parsers until it finds one that supports everything we need.
 PREFERRED_XML_PARSERS = ["drv_libxml2"]
 
+# Engine used to drive the strict XML parser.  'sax' walks the document with
+# one of the SAX drivers above, 'lxml' uses lxml.etree.iterparse.  Most of
+# the time goes to the handlers both share, so lxml only parses feeds some
+# 5-10% faster (see bench_engines in feedparser_benchmark.py).  Both produce
+# identical results; if lxml is not installed 'sax' is used regardless.  Can
+# be overridden per call with the engine argument to parse().
+XML_ENGINE = 'sax'
+
+# Engine used to sanitize HTML content.  'sgmllib' runs it through
+# _HTMLSanitizer, 'lxml' has lxml.html parse it and filters the tree against
+# the same whitelists, which is several times faster.  Markup that lxml
+# repairs (unclosed tags and the like) comes out well formed rather than
+# as it was written, otherwise both give the same HTML.  If lxml is not
+# installed 'sgmllib' is used regardless.  Can be overridden per call with
+# the sanitizer argument to parse().
+HTML_SANITIZER = 'sgmllib'
+
+# Seconds allowed for downloading a feed before giving up on it.  Can be
+# overridden per call with the timeout argument to parse().
+FETCH_TIMEOUT = 15
+
+# How much of a document whose encoding can't be told otherwise is handed to
+# chardet to guess it.  chardet is slow, and a guess from the first 64K is
+# rarely different from one made on the whole document.  None for no limit.
+CHARDET_BYTES = 65536
+
+# Number of distinct date strings whose parsed value is remembered.  Feeds
+# tend to repeat the same few timestamps, and a crawl sees the same entries
+# over and over.
+DATE_CACHE_SIZE = 10000
+
 # If you want feedparser to automatically run HTML markup through HTML Tidy, set
 # this to 1.  Requires mxTidy <http://www.egenix.com/files/python/mxTidy.html>
 # or utidylib <http://utidylib.berlios.de/>.
@@ -86,6 +117,19 @@ RESOLVE_RELATIVE_URIS = 1
 # HTML content, set this to 1.
 SANITIZE_HTML = 1
 
+# If you want feedparser to keep embedded markup as it was written and only
+# resolve its relative URIs and sanitize it the first time the value is looked
+# up in the result, set this to 1.  Values that are never read then cost
+# nothing.  Can be overridden per call with the lazy_html argument to parse().
+LAZY_HTML = 0
+
+# If you want feedparser to look for microformats (vCards, rel-tag,
+# rel-enclosure and XFN) in HTML content, set this to 1.  It needs
+# BeautifulSoup and is slow on long content, so it is off unless asked for.
+# Can be overridden per call with the microformats argument to parse().  The
+# time it takes is added up in microformat_timing.
+PARSE_MICROFORMATS = 0
+
 # ---------- Python 3 modules (make it work if possible) ----------
 try:
     import rfc822
@@ -145,10 +189,15 @@ ACCEPTABLE_URI_SCHEMES = (
 #ACCEPTABLE_URI_SCHEMES = ()
 
 # ---------- required modules (should come with any Python distribution) ----------
-import sgmllib, re, sys, copy, urlparse, time, types, cgi, urllib, urllib2, datetime
+import sgmllib, re, sys, copy, urlparse, time, types, cgi, urllib, urllib2, datetime, codecs, calendar
 # Retickr patching
 import eventlet
 from eventlet.green import urllib2 as green_urllib2
+from retickrtools.connection_pool import KeepAliveHandler
+from retickrtools.caches import LRUCache
+from retickrtools.hosts import CircuitOpen
+from retickrtools.network import ResponseTooLarge, md5, read_body
+from retickrtools.stats import new_trace
 
 try:
     from io import BytesIO as _StringIO
@@ -232,6 +281,14 @@ try:
 except:
     BeautifulSoup = None
 
+# lxml is an optional, faster driver for the strict parser (see XML_ENGINE)
+# http://lxml.de/
+try:
+    from lxml import etree as _lxml_etree
+    from lxml import html as _lxml_html
+except:
+    _lxml_etree = _lxml_html = None
+
 # ---------- don't touch these ----------
 class ThingsNobodyCaresAboutButMe(Exception): pass
 class CharacterEncodingOverride(ThingsNobodyCaresAboutButMe): pass
@@ -293,7 +350,24 @@ except NameError:
             rc[k] = v
         return rc
 
+def _aliasTables(keymap):
+    '''The keys to try, in order, when each alias in keymap is read, and the
+    key it is stored under when it is written'''
+    readkeys, writekeys = {}, {}
+    for alias, keys in keymap.items():
+        if isinstance(keys, list):
+            readkeys[alias] = tuple(keys) + (alias,)
+            writekeys[alias] = keys[0]
+        else:
+            readkeys[alias] = (alias, keys)
+            writekeys[alias] = keys
+    return readkeys, writekeys
+
 class FeedParserDict(UserDict):
+    # Crawls keep millions of these around, so they don't carry an instance
+    # __dict__ (or weakref slot) on top of the dict they already are
+    __slots__ = ()
+
     keymap = {'channel': 'feed',
               'items': 'entries',
               'guid': 'id',
@@ -309,7 +383,16 @@ class FeedParserDict(UserDict):
               'copyright_detail': 'rights_detail',
               'tagline': 'subtitle',
               'tagline_detail': 'subtitle_detail'}
+    # keymap worked out ahead of time
+    readkeys, writekeys = _aliasTables(keymap)
+    # keys which are worked out from others when they are read
+    computed = frozenset(['category', 'enclosures', 'license', 'categories'])
+    special = frozenset(readkeys.keys()) | computed
+
     def __getitem__(self, key):
+        if key not in self.special:
+            # by far the most common case, a key stored as it is
+            return self._rendered(key)
         if key == 'category':
             return UserDict.__getitem__(self, 'tags')[0]['term']
         if key == 'enclosures':
@@ -321,24 +404,25 @@ class FeedParserDict(UserDict):
                     return link['href']
         if key == 'categories':
             return [(tag['scheme'], tag['term']) for tag in UserDict.__getitem__(self, 'tags')]
-        realkey = self.keymap.get(key, key)
-        if type(realkey) == types.ListType:
-            for k in realkey:
-                if UserDict.__contains__(self, k):
-                    return UserDict.__getitem__(self, k)
-        if UserDict.__contains__(self, key):
-            return UserDict.__getitem__(self, key)
-        return UserDict.__getitem__(self, realkey)
+        for k in self.readkeys.get(key, ()):
+            if UserDict.__contains__(self, k):
+                return self._rendered(k)
+        return self._rendered(key)
+
+    def _rendered(self, key):
+        # the value under key, with any markup left for later made final
+        value = UserDict.__getitem__(self, key)
+        if value.__class__ is _LazyHTML:
+            value = value.render()
+            UserDict.__setitem__(self, key, value)
+        return value
 
     def __setitem__(self, key, value):
-        for k in self.keymap.keys():
-            if key == k:
-                key = self.keymap[k]
-                if type(key) == types.ListType:
-                    key = key[0]
-        return UserDict.__setitem__(self, key, value)
+        return UserDict.__setitem__(self, self.writekeys.get(key, key), value)
 
     def get(self, key, default=None):
+        if key not in self.special and UserDict.__contains__(self, key):
+            return self._rendered(key)
         if self.has_key(key):
             return self[key]
         else:
@@ -351,7 +435,15 @@ class FeedParserDict(UserDict):
         
     def has_key(self, key):
         try:
-            return hasattr(self, key) or UserDict.__contains__(self, key)
+            # a plain key first, looking it up would render lazy markup
+            if UserDict.__contains__(self, key):
+                return True
+            if key in self.readkeys:
+                for k in self.readkeys[key]:
+                    if UserDict.__contains__(self, k):
+                        return True
+                return False
+            return hasattr(self, key)
         except AttributeError:
             return False
     # This alias prevents the 2to3 tool from changing the semantics of the
@@ -359,10 +451,7 @@ class FeedParserDict(UserDict):
     __has_key = has_key
         
     def __getattr__(self, key):
-        try:
-            return self.__dict__[key]
-        except KeyError:
-            pass
+        # only called for names that aren't attributes of the class
         try:
             assert not key.startswith('_')
             return self.__getitem__(key)
@@ -371,13 +460,70 @@ class FeedParserDict(UserDict):
 
     def __setattr__(self, key, value):
         if key.startswith('_') or key == 'data':
-            self.__dict__[key] = value
+            # there is no __dict__ for these to go in, this raises
+            UserDict.__setattr__(self, key, value)
         else:
             return self.__setitem__(key, value)
 
     def __contains__(self, key):
         return self.__has_key(key)
 
+    def items(self):
+        return [(key, self._rendered(key)) for key in self.keys()]
+
+    def values(self):
+        return [self._rendered(key) for key in self.keys()]
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self._rendered(key)
+
+    def itervalues(self):
+        for key in self.keys():
+            yield self._rendered(key)
+
+class _LazyHTML(object):
+    '''Embedded markup whose relative URIs are resolved and which is
+    sanitized when it is first rendered, see LAZY_HTML.  The rendered value
+    is kept, so markup saved under two keys is only rendered once.  Rendering
+    happens after parsing is over, when there is no bozo bit left to set, so
+    markup that can't be resolved or sanitized comes out escaped instead.'''
+    __slots__ = ('source', 'args', 'value')
+
+    def __init__(self, source, baseuri, encoding, _type, resolve, sanitize, sanitizer):
+        self.source = source
+        self.args = (baseuri, encoding, _type, resolve, sanitize, sanitizer)
+        self.value = None
+
+    def render(self):
+        if self.args is not None:
+            baseuri, encoding, _type, resolve, sanitize, sanitizer = self.args
+            output = self.source
+            try:
+                if resolve:
+                    output = _resolveRelativeURIs(output, baseuri, encoding, _type)
+                if sanitize:
+                    output = _sanitizeHTML(output, encoding, _type, sanitizer)
+            except Exception, e:
+                if _debug: sys.stderr.write('rendering markup raised %s\n' % repr(e))
+                output = _xmlescape(self.source)
+            self.value = _decodeOutput(output, encoding)
+            self.source = self.args = None
+        return self.value
+
+    def __nonzero__(self):
+        if self.args is None:
+            return bool(self.value)
+        return bool(self.source)
+
+    def __repr__(self):
+        return repr(self.render())
+
+    def __reduce__(self):
+        # pickled and copied as the plain string it renders to
+        value = self.render()
+        return value.__class__, (value,)
+
 def zopeCompatibilityHack():
     global FeedParserDict
     del FeedParserDict
@@ -443,6 +589,26 @@ _cp1252 = {
   unichr(159): unichr( 376)} # latin capital letter y with diaeresis
 
 _urifixer = re.compile('^([A-Za-z][A-Za-z0-9+-.]*://)(/*)(.*?)')
+def _decodeOutput(output, encoding):
+    if encoding and type(output) != type(u''):
+        try:
+            output = unicode(output, encoding)
+        except:
+            pass
+
+    # address common error where people take data that is already
+    # utf-8, presume that it is iso-8859-1, and re-encode it.
+    if encoding in ('utf-8', 'utf-8_INVALID_PYTHON_3') and type(output) == type(u''):
+        try:
+            output = unicode(output.encode('iso-8859-1'), 'utf-8')
+        except:
+            pass
+
+    # map win-1252 extensions to the proper code points
+    if type(output) == type(u''):
+        output = u''.join([c in _cp1252.keys() and _cp1252[c] or c for c in output])
+    return output
+
 def _urljoin(base, uri):
     uri = _urifixer.sub(r'\1\3', uri)
     try:
@@ -451,6 +617,75 @@ def _urljoin(base, uri):
         uri = urlparse.urlunparse([urllib.quote(part) for part in urlparse.urlparse(uri)])
         return urlparse.urljoin(base, uri)
 
+# The result keys filled in by each element with a handler, for parse()'s
+# fields argument.  An element none of whose keys were asked for is left
+# out along with everything inside it, except for those in
+# _shallow_elements, which can hold elements that fill in other keys.
+_element_fields = {}
+for _elements, _fields in (
+    (['author', 'managingeditor', 'dc_author', 'dc_creator', 'itunes_author'], ['author', 'author_detail', 'authors']),
+    (['contributor', 'dc_contributor'], ['contributors']),
+    (['dc_publisher', 'webmaster', 'itunes_owner'], ['publisher', 'publisher_detail']),
+    (['subtitle', 'tagline', 'itunes_subtitle'], ['subtitle', 'subtitle_detail']),
+    (['rights', 'dc_rights', 'copyright'], ['rights', 'rights_detail']),
+    (['language', 'dc_language'], ['language']),
+    (['published', 'dcterms_issued', 'issued'], ['published', 'published_parsed']),
+    (['updated', 'modified', 'dcterms_modified', 'pubdate', 'dc_date', 'lastbuilddate'], ['updated', 'updated_parsed']),
+    (['created', 'dcterms_created'], ['created', 'created_parsed']),
+    (['expirationdate'], ['expired', 'expired_parsed']),
+    (['cc_license', 'creativecommons_license'], ['links', 'license']),
+    (['category', 'dc_subject', 'keywords', 'media_category', 'itunes_category', 'itunes_keywords'], ['tags']),
+    (['cloud'], ['cloud']),
+    (['link', 'producturl'], ['link', 'links']),
+    (['guid'], ['id', 'guidislink', 'link']),
+    (['title', 'dc_title', 'media_title'], ['title', 'title_detail']),
+    (['description', 'dc_description', 'abstract'], ['summary', 'summary_detail', 'subtitle', 'subtitle_detail', 'content']),
+    (['summary', 'itunes_summary'], ['summary', 'summary_detail', 'content']),
+    (['info', 'feedburner_browserfriendly'], ['info', 'info_detail']),
+    (['generator', 'admin_generatoragent'], ['generator', 'generator_detail']),
+    (['admin_errorreportsto'], ['errorreportsto']),
+    (['enclosure'], ['links']),
+    (['source'], ['source']),
+    (['content', 'prodlink', 'body', 'xhtml_body', 'content_encoded', 'fullitem'], ['content', 'summary', 'summary_detail']),
+    (['image', 'itunes_image', 'itunes_link'], ['image']),
+    (['textinput'], ['textinput']),
+    (['itunes_block'], ['itunes_block']),
+    (['itunes_explicit'], ['itunes_explicit']),
+    (['media_content'], ['media_content']),
+    (['media_thumbnail'], ['media_thumbnail']),
+    (['media_player'], ['media_player']),
+    (['newlocation'], ['newlocation'])):
+    for _element in _elements:
+        _element_fields[_element] = frozenset(_fields)
+del _elements, _fields, _element
+_shallow_elements = frozenset(['media_content'])
+
+# Keys FeedParserDict works out from others
+_derived_fields = {'category': 'tags', 'categories': 'tags', 'enclosures': 'links', 'license': 'links'}
+
+# Keys microformats found in HTML content add to, when they are looked for
+# in the content, summary and description elements (those which can fill in
+# 'content')
+_microformat_fields = frozenset(['tags', 'links', 'xfn', 'vcard'])
+
+def _projection(fields, microformats=0):
+    '''The result keys to fill in and the elements to leave out for parse()'s
+    fields and microformats arguments, (None, None) to fill in everything'''
+    if fields is None:
+        return None, None
+    wanted = set()
+    for field in fields:
+        field = _derived_fields.get(field, field)
+        field = FeedParserDict.keymap.get(field, field)
+        if type(field) == types.ListType:
+            wanted.update(field)
+        else:
+            wanted.add(field)
+    skipped = [element for element, produces in _element_fields.items()
+               if wanted.isdisjoint(produces) and
+               not (microformats and 'content' in produces and not wanted.isdisjoint(_microformat_fields))]
+    return frozenset(wanted), frozenset(skipped)
+
 class _FeedParserMixin:
     namespaces = {'': '',
                   'http://backend.userland.com/rss': '',
@@ -522,6 +757,11 @@ class _FeedParserMixin:
     can_contain_relative_uris = ['content', 'title', 'summary', 'info', 'tagline', 'subtitle', 'copyright', 'rights', 'description']
     can_contain_dangerous_markup = ['content', 'title', 'summary', 'info', 'tagline', 'subtitle', 'copyright', 'rights', 'description']
     html_types = ['text/html', 'application/xhtml+xml']
+    sanitizer = None # HTML sanitizer engine, HTML_SANITIZER if None
+    lazy_html = 0 # leave markup to be rendered when it is looked at
+    microformats = 0 # look for microformats in HTML content
+    fields = None # result keys to fill in, all of them if None
+    skipped = frozenset() # elements to leave out, see _projection
     
     def __init__(self, baseuri=None, baselang=None, encoding='utf-8'):
         if _debug: sys.stderr.write('initializing FeedParser\n')
@@ -556,6 +796,8 @@ class _FeedParserMixin:
         self.lang = baselang or None
         self.svgOK = 0
         self.hasTitle = 0
+        self.skipping = None # element being left out
+        self.skipdepth = 0 # how many of it are open
         if baselang:
             self.feeddata['language'] = baselang.replace('_','-')
 
@@ -635,6 +877,19 @@ class _FeedParserMixin:
         if (not prefix) and tag not in ('title', 'link', 'description', 'url', 'href', 'width', 'height'):
             self.inimage = 0
         
+        # leave out elements which only fill in keys that weren't asked for,
+        # and what is inside them (up to the matching end tag, which is all
+        # the loose parser can be sure of)
+        if self.skipping:
+            if prefix + suffix == self.skipping:
+                self.skipdepth += 1
+            return
+        if prefix + suffix in self.skipped:
+            if prefix + suffix not in _shallow_elements:
+                self.push(prefix + suffix, 0)
+                self.skipping, self.skipdepth = prefix + suffix, 1
+            return
+
         # call special handler (if defined) or default handler
         methodname = '_start_' + prefix + suffix
         try:
@@ -643,10 +898,11 @@ class _FeedParserMixin:
         except AttributeError:
             # Since there's no handler or something has gone wrong we explicitly add the element and its attributes
             unknown_tag = prefix + suffix
+            wanted = self.fields is None or unknown_tag in self.fields
             if len(attrsD) == 0:
                 # No attributes so merge it into the encosing dictionary
-                return self.push(unknown_tag, 1)
-            else:
+                return self.push(unknown_tag, wanted)
+            elif wanted:
                 # Has attributes so create it in its own dictionary
                 context = self._getContext()
                 context[unknown_tag] = attrsD
@@ -665,12 +921,21 @@ class _FeedParserMixin:
 
         # call special handler (if defined) or default handler
         methodname = '_end_' + prefix + suffix
-        try:
-            if self.svgOK: raise AttributeError()
-            method = getattr(self, methodname)
-            method()
-        except AttributeError:
-            self.pop(prefix + suffix)
+        if self.skipping:
+            if prefix + suffix == self.skipping:
+                self.skipdepth -= 1
+                if not self.skipdepth:
+                    self.pop(self.skipping)
+                    self.skipping = None
+        elif prefix + suffix in self.skipped:
+            pass
+        else:
+            try:
+                if self.svgOK: raise AttributeError()
+                method = getattr(self, methodname)
+                method()
+            except AttributeError:
+                self.pop(prefix + suffix)
 
         # track inline content
         if self.incontent and self.contentparams.has_key('type') and not self.contentparams.get('type', 'xml').endswith('xml'):
@@ -869,16 +1134,23 @@ class _FeedParserMixin:
         except KeyError:
             pass
 
-        is_htmlish = self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types
-        # resolve relative URIs within embedded markup
-        if is_htmlish and RESOLVE_RELATIVE_URIS:
-            if element in self.can_contain_relative_uris:
-                output = _resolveRelativeURIs(output, self.baseuri, self.encoding, self.contentparams.get('type', 'text/html'))
+        _type = self.contentparams.get('type', 'text/html')
+        is_htmlish = self.mapContentType(_type) in self.html_types
+        resolve = is_htmlish and RESOLVE_RELATIVE_URIS and element in self.can_contain_relative_uris
+        sanitize = is_htmlish and SANITIZE_HTML and element in self.can_contain_dangerous_markup
+        microformats = self.microformats and is_htmlish and element in ['content', 'description', 'summary'] and \
+            (self.fields is None or not self.fields.isdisjoint(_microformat_fields))
+
+        # resolve relative URIs within embedded markup (lazily if asked, but
+        # microformats are found in markup whose URIs have been resolved)
+        if resolve and (not self.lazy_html or (microformats and BeautifulSoup)):
+            output = _resolveRelativeURIs(output, self.baseuri, self.encoding, _type)
+            resolve = 0
                 
         # parse microformats
         # (must do this before sanitizing because some microformats
         # rely on elements that we sanitize)
-        if is_htmlish and element in ['content', 'description', 'summary']:
+        if microformats:
             mfresults = _parseMicroformats(output, self.baseuri, self.encoding)
             if mfresults:
                 for tag in mfresults.get('tags', []):
@@ -891,28 +1163,14 @@ class _FeedParserMixin:
                 if vcard:
                     self._getContext()['vcard'] = vcard
         
-        # sanitize embedded markup
-        if is_htmlish and SANITIZE_HTML:
-            if element in self.can_contain_dangerous_markup:
-                output = _sanitizeHTML(output, self.encoding, self.contentparams.get('type', 'text/html'))
-
-        if self.encoding and type(output) != type(u''):
-            try:
-                output = unicode(output, self.encoding)
-            except:
-                pass
-
-        # address common error where people take data that is already
-        # utf-8, presume that it is iso-8859-1, and re-encode it.
-        if self.encoding in ('utf-8', 'utf-8_INVALID_PYTHON_3') and type(output) == type(u''):
-            try:
-                output = unicode(output.encode('iso-8859-1'), 'utf-8')
-            except:
-                pass
-
-        # map win-1252 extensions to the proper code points
-        if type(output) == type(u''):
-            output = u''.join([c in _cp1252.keys() and _cp1252[c] or c for c in output])
+        if self.lazy_html and (resolve or sanitize):
+            # leave the rest until the value is looked at
+            output = _LazyHTML(output, self.baseuri, self.encoding, _type, resolve, sanitize, self.sanitizer)
+        else:
+            # sanitize embedded markup
+            if sanitize:
+                output = _sanitizeHTML(output, self.encoding, _type, self.sanitizer)
+            output = _decodeOutput(output, self.encoding)
 
         # categories/tags/keywords/whatever are handled in _end_category
         if element == 'category':
@@ -941,7 +1199,7 @@ class _FeedParserMixin:
                 if element == 'description':
                     element = 'summary'
                 self.entries[-1][element] = output
-                if self.incontent:
+                if self.incontent and (self.fields is None or element + '_detail' in self.fields):
                     contentparams = copy.deepcopy(self.contentparams)
                     contentparams['value'] = output
                     self.entries[-1][element + '_detail'] = contentparams
@@ -955,7 +1213,7 @@ class _FeedParserMixin:
                 output = re.sub("&([A-Za-z0-9_]+);", "&\g<1>", output)
                 context[element] = output
                 context['links'][-1]['href'] = output
-            elif self.incontent:
+            elif self.incontent and (self.fields is None or element + '_detail' in self.fields):
                 contentparams = copy.deepcopy(self.contentparams)
                 contentparams['value'] = output
                 context[element + '_detail'] = contentparams
@@ -1038,10 +1296,9 @@ class _FeedParserMixin:
     
     def _save(self, key, value, overwrite=False):
         context = self._getContext()
-        if overwrite:
+        # not setdefault, which would look the value up and render lazy markup
+        if overwrite or not context.has_key(key):
             context[key] = value
-        else:
-            context.setdefault(key, value)
 
     def _start_rss(self, attrsD):
         versionmap = {'0.91': 'rss091u',
@@ -1815,6 +2072,57 @@ if _XML_AVAILABLE:
             self.error(exc)
             raise exc
 
+    def _lxml_iterparse(feedparser, stream):
+        '''Drive a _StrictFeedParser with lxml.etree.iterparse
+
+        iterparse events are translated into the same SAX callbacks the
+        expat driver makes, so the feedparser ends up with identical data.
+        This is a generator which yields the name of every element as it is
+        closed.  Elements are dropped from the tree as soon as their text
+        has been handed over, so memory use does not grow with the document.
+        '''
+        events = _lxml_etree.iterparse(stream, events=('start-ns', 'start', 'end'),
+                                       remove_comments=True, remove_pis=True,
+                                       huge_tree=True)
+        # the text following an event (elem.text after 'start', elem.tail
+        # after 'end') is only complete once the next event has been seen
+        pending = pending_attr = None
+        for event, elem in events:
+            if pending is not None:
+                text = getattr(pending, pending_attr)
+                if text:
+                    feedparser.characters(unicode(text))
+                if pending_attr == 'tail':
+                    parent = pending.getparent()
+                    if parent is not None:
+                        parent.remove(pending)
+                pending = None
+            if event == 'start-ns':
+                prefix, uri = elem
+                feedparser.startPrefixMapping(prefix or None, unicode(uri))
+                continue
+            tag = elem.tag
+            if tag[0] == '{':
+                namespace, localname = tag[1:].split('}', 1)
+            else:
+                namespace, localname = None, tag
+            if event == 'start':
+                attrs, qnames = {}, {}
+                for key, value in elem.attrib.items():
+                    if key[0] == '{':
+                        name = tuple(key[1:].split('}', 1))
+                    else:
+                        name = (None, key)
+                    attrs[name] = unicode(value)
+                    qnames[name] = name[1]
+                feedparser.startElementNS((namespace, localname), None,
+                                          xml.sax.xmlreader.AttributesNSImpl(attrs, qnames))
+                pending, pending_attr = elem, 'text'
+            else:
+                feedparser.endElementNS((namespace, localname), None)
+                pending, pending_attr = elem, 'tail'
+                yield localname
+
 class _BaseHTMLProcessor(sgmllib.SGMLParser):
     special = re.compile('''[<>'"]''')
     bare_ampersand = re.compile("&(?!#\d+;|#x[0-9a-fA-F]+;|\w+;)")
@@ -2427,20 +2735,29 @@ class _MicroformatsParser:
             if xfn_rels:
                 self.xfn.append({"relationships": xfn_rels, "href": elm.get('href', ''), "name": elm.string})
 
+# Calls to _parseMicroformats that had BeautifulSoup to work with, and the
+# seconds they took between them
+microformat_timing = {'calls': 0, 'seconds': 0.0}
+
 def _parseMicroformats(htmlSource, baseURI, encoding):
     if not BeautifulSoup: return
     if _debug: sys.stderr.write('entering _parseMicroformats\n')
+    start = time.time()
     try:
-        p = _MicroformatsParser(htmlSource, baseURI, encoding)
-    except UnicodeEncodeError:
-        # sgmllib throws this exception when performing lookups of tags
-        # with non-ASCII characters in them.
-        return
-    p.vcard = p.findVCards(p.document)
-    p.findTags()
-    p.findEnclosures()
-    p.findXFN()
-    return {"tags": p.tags, "enclosures": p.enclosures, "xfn": p.xfn, "vcard": p.vcard}
+        try:
+            p = _MicroformatsParser(htmlSource, baseURI, encoding)
+        except UnicodeEncodeError:
+            # sgmllib throws this exception when performing lookups of tags
+            # with non-ASCII characters in them.
+            return
+        p.vcard = p.findVCards(p.document)
+        p.findTags()
+        p.findEnclosures()
+        p.findXFN()
+        return {"tags": p.tags, "enclosures": p.enclosures, "xfn": p.xfn, "vcard": p.vcard}
+    finally:
+        microformat_timing['calls'] += 1
+        microformat_timing['seconds'] += time.time() - start
 
 class _RelativeURIResolver(_BaseHTMLProcessor):
     relative_uris = [('a', 'href'),
@@ -2759,12 +3076,166 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
         # unclosed comment; deliberately fail to handle_data()
         return len(self.rawdata)
 
+class _LxmlHTMLSanitizer:
+    '''Sanitizes HTML against the same whitelists as _HTMLSanitizer, with
+    lxml.html doing the parsing instead of sgmllib.  The tables are turned
+    into sets once, and the camel case SVG names mapped up front.'''
+    acceptable_elements = frozenset(_HTMLSanitizer.acceptable_elements)
+    acceptable_attributes = frozenset(_HTMLSanitizer.acceptable_attributes)
+    unacceptable_elements_with_end_tag = frozenset(_HTMLSanitizer.unacceptable_elements_with_end_tag)
+    mathml_elements = frozenset(_HTMLSanitizer.mathml_elements)
+    mathml_attributes = frozenset(_HTMLSanitizer.mathml_attributes)
+    svg_elements = frozenset([e.lower() for e in _HTMLSanitizer.svg_elements])
+    svg_attributes = frozenset([a.lower() for a in _HTMLSanitizer.svg_attributes])
+    svg_elem_map = dict([(e.lower(), e) for e in _HTMLSanitizer.svg_elements if e != e.lower()])
+    svg_attr_map = dict([(a.lower(), a) for a in _HTMLSanitizer.svg_attributes if a != a.lower()])
+    acceptable_css_properties = _HTMLSanitizer.acceptable_css_properties
+    acceptable_css_keywords = _HTMLSanitizer.acceptable_css_keywords
+    valid_css_values = _HTMLSanitizer.valid_css_values
+    acceptable_svg_properties = _HTMLSanitizer.acceptable_svg_properties
+    elements_no_end_tag = frozenset(_BaseHTMLProcessor.elements_no_end_tag)
+    sanitize_style = _HTMLSanitizer.__dict__['sanitize_style']
+
+    mathml_namespace = ('xmlns', 'http://www.w3.org/1998/Math/MathML')
+    svg_namespace = ('xmlns', 'http://www.w3.org/2000/svg')
+    xlink_namespace = ('xmlns:xlink', 'http://www.w3.org/1999/xlink')
+
+    def __init__(self, encoding, _type):
+        self.encoding = encoding
+        self._type = _type
+        self.pieces = []
+        self.mathmlOK = 0
+        self.svgOK = 0
+
+    def feed(self, data):
+        if type(data) != type(u''):
+            data = unicode(data, self.encoding or 'utf-8')
+        root = _lxml_html.fragment_fromstring(data, create_parent='div')
+        self.handle_data(root.text)
+        for child in root:
+            self.handle_element(child)
+
+    def output(self):
+        '''Return processed HTML as a single string'''
+        return u''.join(self.pieces)
+
+    def handle_data(self, text):
+        if text:
+            self.pieces.append(_xmlescape(text))
+
+    def handle_element(self, element):
+        tag = element.tag
+        if tag is _lxml_etree.Comment:
+            self.pieces.append(u'<!--%s-->' % element.text)
+        elif isinstance(tag, basestring):
+            self.handle_tag(element, tag.lower())
+        # processing instructions and entities are dropped, their tails kept
+        self.handle_data(element.tail)
+
+    def handle_tag(self, element, tag):
+        attrs = element.items()
+        acceptable_attributes = self.acceptable_attributes
+        keymap = {}
+        mathml = svg = 0
+        if not tag in self.acceptable_elements or self.svgOK:
+            if tag in self.unacceptable_elements_with_end_tag:
+                return
+
+            # add implicit namespaces to html5 inline svg/mathml
+            if self._type.endswith('html') and not element.get('xmlns'):
+                if tag == 'svg':
+                    attrs.append(self.svg_namespace)
+                if tag == 'math':
+                    attrs.append(self.mathml_namespace)
+
+            # not otherwise acceptable, perhaps it is MathML or SVG?
+            if tag == 'math' and self.mathml_namespace in attrs:
+                mathml = 1
+            if tag == 'svg' and self.svg_namespace in attrs:
+                svg = 1
+            self.mathmlOK += mathml
+            self.svgOK += svg
+
+            # chose acceptable attributes based on tag class, else keep only
+            # what is inside the element
+            if self.mathmlOK and tag in self.mathml_elements:
+                acceptable_attributes = self.mathml_attributes
+            elif self.svgOK and tag in self.svg_elements:
+                acceptable_attributes = self.svg_attributes
+                tag = self.svg_elem_map.get(tag, tag)
+                keymap = self.svg_attr_map
+            elif not tag in self.acceptable_elements:
+                self.handle_children(element)
+                self.mathmlOK -= mathml
+                self.svgOK -= svg
+                return
+
+        # declare xlink namespace, if needed
+        if self.mathmlOK or self.svgOK:
+            if [n for n, v in attrs if n.startswith('xlink:')]:
+                if not self.xlink_namespace in attrs:
+                    attrs.append(self.xlink_namespace)
+
+        strattrs = []
+        for key, value in self.normalize_attrs(attrs):
+            if key in acceptable_attributes:
+                key = keymap.get(key, key)
+                # make sure the uri uses an acceptable uri scheme
+                if key == u'href':
+                    value = _makeSafeAbsoluteURI(value)
+            elif key == 'style':
+                value = self.sanitize_style(value)
+                if not value:
+                    continue
+            else:
+                continue
+            strattrs.append(u' %s="%s"' % (key, _xmlescape(value, {'"': '&quot;'})))
+        strattrs = u''.join(strattrs)
 
-def _sanitizeHTML(htmlSource, encoding, _type):
-    p = _HTMLSanitizer(encoding, _type)
+        if tag in self.elements_no_end_tag:
+            self.pieces.append(u'<%s%s />' % (tag, strattrs))
+            self.handle_children(element)
+        else:
+            self.pieces.append(u'<%s%s>' % (tag, strattrs))
+            self.handle_children(element)
+            self.pieces.append(u'</%s>' % tag)
+        self.mathmlOK -= mathml
+        self.svgOK -= svg
+
+    def handle_children(self, element):
+        self.handle_data(element.text)
+        for child in element:
+            self.handle_element(child)
+
+    def normalize_attrs(self, attrs):
+        attrs = dict([(k.lower(), v) for k, v in attrs]).items()
+        attrs = [(k, k in ('rel', 'type') and v.lower() or v) for k, v in attrs]
+        attrs.sort()
+        return attrs
+
+# comments that sgmllib and libxml2 end in different places, and processing
+# instructions, which libxml2 turns into text; fragments with any of these
+# are left to sgmllib so that both engines agree on them
+_lxml_disagrees_re = re.compile(r'<!--->|<!-->|--!>|--\s+>|<\?')
+
+def _sanitizeHTML(htmlSource, encoding, _type, sanitizer=None):
+    if sanitizer is None:
+        sanitizer = HTML_SANITIZER
+    data = None
     htmlSource = htmlSource.replace('<![CDATA[', '&lt;![CDATA[')
-    p.feed(htmlSource)
-    data = p.output()
+    if sanitizer == 'lxml' and _lxml_html is not None and not _lxml_disagrees_re.search(htmlSource):
+        p = _LxmlHTMLSanitizer(encoding, _type)
+        try:
+            p.feed(htmlSource)
+            data = p.output()
+        except Exception, e:
+            # lxml won't take everything sgmllib does, such as an empty
+            # fragment or one with an encoding declaration
+            if _debug: sys.stderr.write('lxml sanitizer raised %s\n' % repr(e))
+    if data is None:
+        p = _HTMLSanitizer(encoding, _type)
+        p.feed(htmlSource)
+        data = p.output()
     if TIDY_MARKUP:
         # loop through list of preferred Tidy interfaces looking for one that's installed,
         # then set up a common _tidy function to wrap the interface-specific API.
@@ -2854,7 +3325,7 @@ class _FeedURLHandler(urllib2.HTTPDigestAuthHandler, urllib2.HTTPRedirectHandler
         except:
             return self.http_error_default(req, fp, code, msg, headers)
 
-def _open_resource(url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers):
+def _open_resource(url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers, trace=None):
     """URL, filename, or string --> stream
 
     This function lets you define parsers that take any input source
@@ -2922,7 +3393,8 @@ def _open_resource(url_file_stream_or_string, etag, modified, agent, referrer, h
 
         # try to open with urllib2 (to use optional headers)
         request = _build_urllib2_request(url_file_stream_or_string, agent, etag, modified, referrer, auth, request_headers)
-        opener = apply(green_urllib2.build_opener, tuple(handlers + [_FeedURLHandler()]))
+        request.trace = trace
+        opener = apply(green_urllib2.build_opener, tuple([KeepAliveHandler()] + handlers + [_FeedURLHandler()]))
         opener.addheaders = [] # RMK - must clear so we only send our custom User-Agent
         try:
             return opener.open(request)
@@ -2977,9 +3449,16 @@ def _build_urllib2_request(url, agent, etag, modified, referrer, auth, request_h
     return request
 
 _date_handlers = []
+_date_cache = {}
+_date_fast_path = False
 def registerDateHandler(func):
     '''Register a date handler function (takes string, returns 9-tuple date in GMT)'''
+    global _date_fast_path
     _date_handlers.insert(0, func)
+    # a handler registered from outside comes before the fast path, and may
+    # parse strings differently from the way they are remembered
+    _date_fast_path = False
+    _date_cache.clear()
     
 # ISO-8601 date parsing routines written by Fazal Majid.
 # The ISO 8601 standard is very convoluted and irregular - a full ISO 8601
@@ -3253,6 +3732,15 @@ registerDateHandler(_parse_date_hungarian)
 # Drake and licensed under the Python license.  Removed all range checking
 # for month, day, hour, minute, and second, since mktime will normalize
 # these later
+_w3dtf_date_re = ('(?P<year>\d\d\d\d)'
+                  '(?:(?P<dsep>-|)'
+                  '(?:(?P<month>\d\d)(?:(?P=dsep)(?P<day>\d\d))?'
+                  '|(?P<julian>\d\d\d)))?')
+_w3dtf_tzd_re = '(?P<tzd>[-+](?P<tzdhours>\d\d)(?::?(?P<tzdminutes>\d\d))|Z)'
+_w3dtf_time_re = ('(?P<hours>\d\d)(?P<tsep>:|)(?P<minutes>\d\d)'
+                  '(?:(?P=tsep)(?P<seconds>\d\d)(?:[.,]\d+)?)?'
+                  + _w3dtf_tzd_re)
+_w3dtf_datetime_re = re.compile('%s(?:T%s)?' % (_w3dtf_date_re, _w3dtf_time_re))
 def _parse_date_w3dtf(dateString):
     def __extract_date(m):
         year = int(m.group('year'))
@@ -3330,18 +3818,7 @@ def _parse_date_w3dtf(dateString):
             return -offset
         return offset
 
-    __date_re = ('(?P<year>\d\d\d\d)'
-                 '(?:(?P<dsep>-|)'
-                 '(?:(?P<month>\d\d)(?:(?P=dsep)(?P<day>\d\d))?'
-                 '|(?P<julian>\d\d\d)))?')
-    __tzd_re = '(?P<tzd>[-+](?P<tzdhours>\d\d)(?::?(?P<tzdminutes>\d\d))|Z)'
-    __tzd_rx = re.compile(__tzd_re)
-    __time_re = ('(?P<hours>\d\d)(?P<tsep>:|)(?P<minutes>\d\d)'
-                 '(?:(?P=tsep)(?P<seconds>\d\d)(?:[.,]\d+)?)?'
-                 + __tzd_re)
-    __datetime_re = '%s(?:T%s)?' % (__date_re, __time_re)
-    __datetime_rx = re.compile(__datetime_re)
-    m = __datetime_rx.match(dateString)
+    m = _w3dtf_datetime_re.match(dateString)
     if (m is None) or (m.group() != dateString): return
     gmt = __extract_date(m) + __extract_time(m) + (0, 0, 0)
     if gmt[0] == 0: return
@@ -3376,14 +3853,13 @@ _additional_timezones = {'AT': -400, 'ET': -500, 'CT': -600, 'MT': -700, 'PT': -
 rfc822._timezones.update(_additional_timezones)
 registerDateHandler(_parse_date_rfc822)    
 
+_perforce_date_re = re.compile( \
+	r'(\w{,3}), (\d{,4})/(\d{,2})/(\d{2}) (\d{,2}):(\d{2}):(\d{2}) (\w{,3})')
 def _parse_date_perforce(aDateString):
 	"""parse a date in yyyy/mm/dd hh:mm:ss TTT format"""
 	# Fri, 2006/09/15 08:19:53 EDT
-	_my_date_pattern = re.compile( \
-		r'(\w{,3}), (\d{,4})/(\d{,2})/(\d{2}) (\d{,2}):(\d{2}):(\d{2}) (\w{,3})')
-
 	dow, year, month, day, hour, minute, second, tz = \
-		_my_date_pattern.search(aDateString).groups()
+		_perforce_date_re.search(aDateString).groups()
 	months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
 	dateString = "%s, %s %s %s %s:%s:%s %s" % (dow, day, months[int(month) - 1], year, hour, minute, second, tz)
 	tm = rfc822.parsedate_tz(dateString)
@@ -3391,8 +3867,75 @@ def _parse_date_perforce(aDateString):
 		return time.gmtime(rfc822.mktime_tz(tm))
 registerDateHandler(_parse_date_perforce)
 
+# Nearly every feed dates its entries in RFC 822 or W3C-DTF.  These match
+# the usual shapes of the two, which _parse_date_fast turns into a date
+# without going through the handlers.  It gives the same answer the
+# handlers would: _parse_date_perforce needs a '/' and _parse_date_rfc822
+# turns down W3C-DTF dates, so for these strings the first handler to
+# succeed is always _parse_date_rfc822 or _parse_date_w3dtf.
+_rfc822_fast_re = re.compile(r'(?:[A-Za-z]{3},\s+)?(\d{1,2})\s+([A-Za-z]{3})\s+(\d{4})\s+'
+                             r'(\d\d):(\d\d)(?::(\d\d))?\s+([A-Za-z]{1,3}|[-+]\d{4})\s*$')
+_w3dtf_fast_re = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d)(?::(\d\d)(?:[.,]\d+)?)?'
+                            r'(?:Z|([-+])(\d\d):?(\d\d))$')
+_fast_months = dict((name, i + 1) for i, name in enumerate(rfc822._monthnames[:12]))
+_date_fast_path = True
+_date_cache_miss = object()
+
+def _parse_date_fast(dateString):
+    '''Parses the usual RFC 822 and W3C-DTF dates, returns None for anything else'''
+    m = _rfc822_fast_re.match(dateString)
+    if m:
+        day, month, year, hours, minutes, seconds, tz = m.groups()
+        month = _fast_months.get(month.lower())
+        tz = tz.upper()
+        if tz[0] in '+-':
+            tzoffset = int(tz)
+        else:
+            tzoffset = rfc822._timezones.get(tz)
+        if not month or tzoffset is None:
+            return None
+        offset = (abs(tzoffset) // 100) * 3600 + (abs(tzoffset) % 100) * 60
+        if tzoffset < 0:
+            offset = -offset
+    else:
+        m = _w3dtf_fast_re.match(dateString)
+        if not m:
+            return None
+        year, month, day, hours, minutes, seconds, sign, tzhours, tzminutes = m.groups()
+        offset = 0
+        if sign:
+            offset = (int(tzhours) * 60 + int(tzminutes)) * 60
+            if sign == '-':
+                offset = -offset
+    year, month = int(year), int(month)
+    # the date handlers return None for years before 1900, so must we
+    if year < 1900 or not 1 <= month <= 12:
+        return None
+    gmt = (year, month, int(day), int(hours), int(minutes), int(seconds or 0))
+    return time.gmtime(calendar.timegm(gmt) - offset)
+
 def _parse_date(dateString):
     '''Parses a variety of date formats into a 9-tuple in GMT'''
+    date9tuple = _date_cache.get(dateString, _date_cache_miss)
+    if date9tuple is not _date_cache_miss:
+        return date9tuple
+    date9tuple = None
+    if _date_fast_path:
+        try:
+            date9tuple = _parse_date_fast(dateString)
+        except Exception, e:
+            if _debug: sys.stderr.write('_parse_date_fast raised %s\n' % repr(e))
+    if not date9tuple:
+        date9tuple = _parse_date_handlers(dateString)
+    # forgetting everything when full, as the re module does with its cache,
+    # is much cheaper than keeping track of which dates were used last
+    if len(_date_cache) >= DATE_CACHE_SIZE:
+        _date_cache.clear()
+    _date_cache[dateString] = date9tuple
+    return date9tuple
+
+def _parse_date_handlers(dateString):
+    '''Parses a date with the first registered handler that understands it'''
     for handler in _date_handlers:
         try:
             date9tuple = handler(dateString)
@@ -3407,6 +3950,8 @@ def _parse_date(dateString):
             pass
     return None
 
+_xml_encoding_re = re.compile(_s2bytes('^<\?.*encoding=[\'"](.*?)[\'"].*\?>'))
+
 def _getCharacterEncoding(http_headers, xml_data):
     '''Get the character encoding of the XML document
 
@@ -3517,7 +4062,7 @@ def _getCharacterEncoding(http_headers, xml_data):
         else:
             # ASCII-compatible
             pass
-        xml_encoding_match = re.compile(_s2bytes('^<\?.*encoding=[\'"](.*?)[\'"].*\?>')).match(xml_data)
+        xml_encoding_match = _xml_encoding_re.match(xml_data)
     except:
         xml_encoding_match = None
     if xml_encoding_match:
@@ -3547,6 +4092,42 @@ def _getCharacterEncoding(http_headers, xml_data):
         true_encoding = 'gb18030'
     return true_encoding, http_encoding, xml_encoding, sniffed_xml_encoding, acceptable_content_type
     
+_xml_declaration_re = re.compile('^<\?xml[^>]*?>')
+_non_ascii_re = re.compile('[\x80-\xff]')
+_ascii_bytes = ''.join(map(chr, range(128)))
+_ascii_compatible = {}
+
+def _codecName(encoding):
+    '''The canonical name of the codec for encoding, None if there is none'''
+    try:
+        return codecs.lookup(encoding).name
+    except (LookupError, TypeError):
+        return None
+
+def _isASCIICompatible(encoding):
+    '''Whether ASCII bytes mean the same thing in encoding as in ASCII'''
+    if encoding not in _ascii_compatible:
+        try:
+            _ascii_compatible[encoding] = unicode(_ascii_bytes, encoding) == unicode(_ascii_bytes, 'ascii')
+        except Exception:
+            _ascii_compatible[encoding] = False
+    return _ascii_compatible[encoding]
+
+def _isUTF8(data, chunk_size=65536):
+    '''Whether data is valid utf-8, checked a chunk at a time so that the
+    document is never decoded in full'''
+    # a chunk must have room for the longest utf-8 sequence
+    chunk_size = max(chunk_size, 4)
+    start = 0
+    while start < len(data):
+        final = start + chunk_size >= len(data)
+        try:
+            decoded, consumed = codecs.utf_8_decode(buffer(data, start, chunk_size), 'strict', final)
+        except UnicodeDecodeError:
+            return False
+        start += consumed
+    return True
+
 def _toUTF8(data, encoding):
     '''Changes an XML data stream on the fly to specify a new encoding
 
@@ -3590,30 +4171,41 @@ def _toUTF8(data, encoding):
                 sys.stderr.write('trying utf-32le instead\n')
         encoding = 'utf-32le'
         data = data[4:]
+    newdecl = '''<?xml version='1.0' encoding='utf-8'?>'''
+    if _isASCIICompatible(encoding) and \
+       ((not _non_ascii_re.search(data)) or (_codecName(encoding) == 'utf-8' and _isUTF8(data))):
+        # decoding and re-encoding would give back the same bytes, so don't
+        if _debug: sys.stderr.write('%s data is already utf-8\n' % encoding)
+        if _xml_declaration_re.search(data):
+            return _xml_declaration_re.sub(newdecl, data)
+        return newdecl + '\n' + data
     newdata = unicode(data, encoding)
     if _debug: sys.stderr.write('successfully converted %s data to unicode\n' % encoding)
-    declmatch = re.compile('^<\?xml[^>]*?>')
-    newdecl = '''<?xml version='1.0' encoding='utf-8'?>'''
-    if declmatch.search(newdata):
-        newdata = declmatch.sub(newdecl, newdata)
+    if _xml_declaration_re.search(newdata):
+        newdata = _xml_declaration_re.sub(newdecl, newdata)
     else:
         newdata = newdecl + u'\n' + newdata
     return newdata.encode('utf-8')
 
+_first_tag_re = re.compile(_s2bytes('<\w'))
+_entity_re = re.compile(_s2bytes(r'^\s*<!ENTITY([^>]*?)>'), re.MULTILINE)
+_doctype_re = re.compile(_s2bytes(r'^\s*<!DOCTYPE([^>]*?)>'), re.MULTILINE)
+_safe_entity_re = re.compile(_s2bytes('\s+(\w+)\s+"(&#\w+;|[^&"]*)"'))
+
 def _stripDoctype(data):
     '''Strips DOCTYPE from XML document, returns (rss_version, stripped_data)
 
     rss_version may be 'rss091n' or None
     stripped_data is the same XML document, minus the DOCTYPE
     '''
-    start = re.search(_s2bytes('<\w'), data)
+    start = _first_tag_re.search(data)
     start = start and start.start() or -1
     head,data = data[:start+1], data[start+1:]
     
-    entity_pattern = re.compile(_s2bytes(r'^\s*<!ENTITY([^>]*?)>'), re.MULTILINE)
+    entity_pattern = _entity_re
     entity_results=entity_pattern.findall(head)
     head = entity_pattern.sub(_s2bytes(''), head)
-    doctype_pattern = re.compile(_s2bytes(r'^\s*<!DOCTYPE([^>]*?)>'), re.MULTILINE)
+    doctype_pattern = _doctype_re
     doctype_results = doctype_pattern.findall(head)
     doctype = doctype_results and doctype_results[0] or _s2bytes('')
     if doctype.lower().count(_s2bytes('netscape')):
@@ -3624,7 +4216,7 @@ def _stripDoctype(data):
     # only allow in 'safe' inline entity definitions
     replacement=_s2bytes('')
     if len(doctype_results)==1 and entity_results:
-       safe_pattern=re.compile(_s2bytes('\s+(\w+)\s+"(&#\w+;|[^&"]*)"'))
+       safe_pattern=_safe_entity_re
        safe_entities=filter(lambda e: safe_pattern.match(e),entity_results)
        if safe_entities:
            replacement=_s2bytes('<!DOCTYPE feed [\n  <!ENTITY') + _s2bytes('>\n  <!ENTITY ').join(safe_entities) + _s2bytes('>\n]>')
@@ -3632,11 +4224,30 @@ def _stripDoctype(data):
 
     return version, data, dict(replacement and [(k.decode('utf-8'), v.decode('utf-8')) for k, v in safe_pattern.findall(replacement)])
     
-def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[], request_headers={}, response_headers={}):
-    '''Parse a feed from a URL, file, stream, or string.
-    
-    request_headers, if given, is a dict from http header name to value to add
-    to the request; this overrides internally generated values.
+def fetch(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[], request_headers={}, response_headers={}, max_bytes=None, max_compressed_bytes=None, timeout=None, stats=None, host_health=None):
+    '''Fetch (and decompress) a feed without parsing it
+
+    Returns (result, data), where result holds the HTTP details of the
+    response; hand them to parse_fetched() to finish the job.  Both can be
+    pickled, so the parsing can happen in another process.  If data is None
+    the download failed and result is final.
+
+    A gzip or deflate encoded feed is decompressed as it is read.  If more
+    than max_compressed_bytes come over the wire, or the feed decompresses
+    to more than max_bytes, the download is abandoned and bozo_exception
+    is a retickrtools.network.ResponseTooLarge.
+
+    The download is abandoned after timeout seconds, FETCH_TIMEOUT by
+    default.
+
+    If stats is given, a retickrtools.stats.FetchStats or anything else with
+    a record method, a trace of the download with the time spent on each
+    phase, its size and status is handed to it.
+
+    If host_health is given, a retickrtools.hosts.HostHealth, the timeout is
+    fitted to how fast the feed's host usually answers (never longer than
+    timeout) and the outcome is recorded in it.  A host whose circuit breaker
+    is open is not fetched at all and bozo_exception is a CircuitOpen.
     '''
     result = FeedParserDict()
     result['feed'] = FeedParserDict()
@@ -3646,26 +4257,61 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
     if not isinstance(handlers, list):
         handlers = [handlers]
 
+    if timeout is None:
+        timeout = FETCH_TIMEOUT
+
+    is_url = isinstance(url_file_stream_or_string, basestring) and \
+        urlparse.urlparse(url_file_stream_or_string)[0] in ('http', 'https', 'feed')
+    trace = None
+    if stats is not None and is_url:
+        trace = new_trace(url_file_stream_or_string)
+
+    health = None
+    if host_health is not None and is_url:
+        health = host_health
+        if not health.available(url_file_stream_or_string):
+            result['bozo'] = 1
+            result['bozo_exception'] = CircuitOpen(url_file_stream_or_string)
+            _record_trace(stats, trace, result)
+            return result, None
+        timeout = health.timeout(url_file_stream_or_string, timeout)
+    start = time.time()
+
     # Timeout after some amount of time and suppress a timeout exception
     # outside of the with statement
-    with eventlet.Timeout(15, False):
+    with eventlet.Timeout(timeout, False):
         try:
-            f = _open_resource(url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers)
-            data = f.read()
+            f = _open_resource(url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers, trace)
+            try:
+                data = read_body(f, max_bytes, max_compressed_bytes, trace)
+            except zlib.error, e:
+                # Some feeds claim to be compressed but they're not, so
+                # we get garbage.  Ideally, we should re-request the
+                # feed without the 'Accept-encoding: gzip' header,
+                # but we don't.
+                result['bozo'] = 1
+                result['bozo_exception'] = e
+                data = ''
         except eventlet.Timeout, e:
             result['bozo'] = 1
             result['bozo_exception'] = e
             data = None
             f = None
 
-            return result
+            if health is not None:
+                health.record_failure(url_file_stream_or_string, timeout)
+            _record_trace(stats, trace, result)
+            return result, None
         except Exception, e:
             result['bozo'] = 1
             result['bozo_exception'] = e
             data = None
             f = None
 
-            return result
+            if health is not None and not isinstance(e, ResponseTooLarge):
+                health.record_failure(url_file_stream_or_string)
+            _record_trace(stats, trace, result)
+            return result, None
 
     if hasattr(f, 'headers'):
         result['headers'] = dict(f.headers)
@@ -3675,27 +4321,6 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
     elif response_headers:
         result['headers'] = copy.deepcopy(response_headers)
 
-    # if feed is gzip-compressed, decompress it
-    if f and data and 'headers' in result:
-        if gzip and result['headers'].get('content-encoding') == 'gzip':
-            try:
-                data = gzip.GzipFile(fileobj=_StringIO(data)).read()
-            except Exception, e:
-                # Some feeds claim to be gzipped but they're not, so
-                # we get garbage.  Ideally, we should re-request the
-                # feed without the 'Accept-encoding: gzip' header,
-                # but we don't.
-                result['bozo'] = 1
-                result['bozo_exception'] = e
-                data = ''
-        elif zlib and result['headers'].get('content-encoding') == 'deflate':
-            try:
-                data = zlib.decompress(data, -zlib.MAX_WBITS)
-            except Exception, e:
-                result['bozo'] = 1
-                result['bozo_exception'] = e
-                data = ''
-
     # save HTTP headers
     if 'headers' in result:
         if 'etag' in result['headers'] or 'ETag' in result['headers']:
@@ -3713,7 +4338,32 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
         result['status'] = f.status
     if hasattr(f, 'close'):
         f.close()
+    if health is not None:
+        # the host is up, but a server error may mean it is struggling
+        if result.get('status', 200) >= 500:
+            health.record_failure(url_file_stream_or_string)
+        else:
+            health.record_success(url_file_stream_or_string, time.time() - start)
+    _record_trace(stats, trace, result)
+    return result, data
 
+def _record_trace(stats, trace, result):
+    if trace is None:
+        return
+    exception = result.get('bozo_exception')
+    if exception is not None:
+        trace['error'] = exception.__class__.__name__
+        trace['timeout'] = isinstance(exception, eventlet.Timeout)
+    trace['total'] = time.time() - trace['start']
+    stats.record(trace)
+
+def _decode(result, data):
+    '''Convert fetched feed data to utf-8, ready to be handed to a parser
+
+    Returns (data, entities, baseuri, baselang, use_strict_parser).  If data
+    is None there is nothing to parse (the server sent a 304) and result is
+    final.
+    '''
     # there are four encodings to keep track of:
     # - http_encoding is the encoding declared in the Content-Type HTTP header
     # - xml_encoding is the encoding declared in the <?xml declaration
@@ -3745,11 +4395,11 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
         result['version'] = ''
         result['debug_message'] = 'The feed has not changed since you last checked, ' + \
             'so the server sent no data.  This is a feature, not a bug!'
-        return result
+        return None, None, None, None, 0
 
     # if there was a problem downloading, we're done
     if data is None:
-        return result
+        return None, None, None, None, 0
 
     # determine character encoding
     use_strict_parser = 0
@@ -3769,7 +4419,7 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
     # if no luck and we have auto-detection library, try that
     if (not known_encoding) and chardet:
         try:
-            proposed_encoding = chardet.detect(data)['encoding']
+            proposed_encoding = chardet.detect(data[:CHARDET_BYTES])['encoding']
             if proposed_encoding and (proposed_encoding not in tried_encodings):
                 tried_encodings.append(proposed_encoding)
                 data = _toUTF8(data, proposed_encoding)
@@ -3820,21 +4470,53 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
 
     if not _XML_AVAILABLE:
         use_strict_parser = 0
-    if use_strict_parser:
-        # initialize the SAX parser
-        feedparser = _StrictFeedParser(baseuri, baselang, 'utf-8')
-        saxparser = xml.sax.make_parser(PREFERRED_XML_PARSERS)
-        saxparser.setFeature(xml.sax.handler.feature_namespaces, 1)
-        saxparser.setContentHandler(feedparser)
-        saxparser.setErrorHandler(feedparser)
+    return data, entities, baseuri, baselang, use_strict_parser
+
+def _strict_parse(feedparser, data, engine):
+    '''Run a _StrictFeedParser over data, yielding as the document is consumed'''
+    if engine == 'lxml' and _lxml_etree is not None:
+        for element in _lxml_iterparse(feedparser, _StringIO(data)):
+            yield element
+        return
+    # initialize the SAX parser
+    saxparser = xml.sax.make_parser(PREFERRED_XML_PARSERS)
+    saxparser.setFeature(xml.sax.handler.feature_namespaces, 1)
+    saxparser.setContentHandler(feedparser)
+    saxparser.setErrorHandler(feedparser)
+    if hasattr(saxparser, '_ns_stack'):
+        # work around bug in built-in SAX parser (doesn't recognize xml: namespace)
+        # PyXML doesn't have this problem, and it doesn't have _ns_stack either
+        saxparser._ns_stack.append({'http://www.w3.org/XML/1998/namespace':'xml'})
+    if not isinstance(saxparser, xml.sax.xmlreader.IncrementalParser):
         source = xml.sax.xmlreader.InputSource()
         source.setByteStream(_StringIO(data))
-        if hasattr(saxparser, '_ns_stack'):
-            # work around bug in built-in SAX parser (doesn't recognize xml: namespace)
-            # PyXML doesn't have this problem, and it doesn't have _ns_stack either
-            saxparser._ns_stack.append({'http://www.w3.org/XML/1998/namespace':'xml'})
+        saxparser.parse(source)
+        yield None
+        return
+    for i in xrange(0, len(data), 65536):
+        saxparser.feed(data[i:i + 65536])
+        yield None
+    saxparser.close()
+
+def _run_parser(result, data, entities, baseuri, baselang, use_strict_parser, engine, sanitizer=None, lazy_html=0, fields=None, microformats=0):
+    '''Parse decoded feed data into result
+
+    This is a generator which yields the feedparser doing the work each time
+    it makes progress, so callers can pick completed entries off of it.  The
+    strict parser is tried first; if it fails the loose parser starts over
+    from the top of the document.
+    '''
+    fields, skipped = _projection(fields, microformats)
+    if use_strict_parser:
+        feedparser = _StrictFeedParser(baseuri, baselang, 'utf-8')
+        feedparser.sanitizer = sanitizer
+        feedparser.lazy_html = lazy_html
+        feedparser.microformats = microformats
+        if fields is not None:
+            feedparser.fields, feedparser.skipped = fields, skipped
         try:
-            saxparser.parse(source)
+            for element in _strict_parse(feedparser, data, engine):
+                yield feedparser
         except Exception, e:
             if _debug:
                 import traceback
@@ -3846,13 +4528,173 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
             use_strict_parser = 0
     if not use_strict_parser:
         feedparser = _LooseFeedParser(baseuri, baselang, 'utf-8', entities)
+        feedparser.sanitizer = sanitizer
+        feedparser.lazy_html = lazy_html
+        feedparser.microformats = microformats
+        if fields is not None:
+            feedparser.fields, feedparser.skipped = fields, skipped
         feedparser.feed(data.decode('utf-8', 'replace'))
     result['feed'] = feedparser.feeddata
     result['entries'] = feedparser.entries
     result['version'] = result['version'] or feedparser.version
     result['namespaces'] = feedparser.namespacesInUse
+    yield feedparser
+
+def _copy_result(obj):
+    '''Copy a parse result; much quicker than copy.deepcopy'''
+    if isinstance(obj, dict):
+        copied = obj.__class__.__new__(obj.__class__)
+        dict.update(copied, [(k, _copy_result(v)) for k, v in dict.iteritems(obj)])
+        return copied
+    if isinstance(obj, list):
+        return [_copy_result(v) for v in obj]
+    return obj
+
+class ParseCache:
+    '''Remembers parse results keyed on a digest of the feed body
+
+    Lots of feeds ignore ETag and Last-Modified and send the same bytes on
+    every crawl.  Pass one of these to parse() as parse_cache and a body
+    which has been parsed before is not parsed (or even decoded) again;
+    instead a copy of the earlier result is returned, with the HTTP details
+    (headers, etag, modified, href, status) of the current response.
+
+    Results are forgotten least recently used first once the bodies they
+    were parsed from add up to more than max_bytes.  hits and misses count
+    lookups.
+    '''
+    http_keys = ('headers', 'etag', 'modified', 'href', 'status')
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.results = LRUCache(max_entries=None, max_bytes=max_bytes,
+                                sizeof=lambda (size, result): size)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, result, data, *options):
+        # the same bytes served from elsewhere, or with other headers, can
+        # parse differently (relative URIs, declared encoding and language)
+        headers = dict([(k.lower(), v) for k, v in result.get('headers', {}).items()])
+        return md5(data, result.get('href', ''), headers.get('content-type', ''),
+                   headers.get('content-location', ''), headers.get('content-language', ''),
+                   *[str(option) for option in options])
+
+    def get(self, key, result):
+        '''Fill in result from the cache, returns whether key was found'''
+        cached = self.results.get(key)
+        if cached is None:
+            self.misses += 1
+            return False
+        self.hits += 1
+        for k, v in _copy_result(cached[1]).items():
+            if k not in self.http_keys:
+                result[k] = v
+        return True
+
+    def set(self, key, result, size):
+        self.results.set(key, (size, _copy_result(result)))
+
+def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[], request_headers={}, response_headers={}, engine=None, parse_cache=None, max_bytes=None, max_compressed_bytes=None, timeout=None, stats=None, sanitizer=None, lazy_html=None, fields=None, microformats=None, host_health=None):
+    '''Parse a feed from a URL, file, stream, or string.
+    
+    request_headers, if given, is a dict from http header name to value to add
+    to the request; this overrides internally generated values.
+
+    engine, if given, selects the XML engine ('sax' or 'lxml') used by the
+    strict parser; it defaults to XML_ENGINE.  sanitizer, if given, selects
+    the engine ('sgmllib' or 'lxml') used to sanitize HTML content; it
+    defaults to HTML_SANITIZER.  lazy_html, if true, leaves sanitizing HTML
+    content and resolving its relative URIs until each value is first looked
+    up; it defaults to LAZY_HTML.
+
+    fields, if given, lists the keys wanted in the feed and entries, e.g.
+    ['title', 'link', 'updated', 'content'].  Elements which would only fill
+    in other keys are skipped without running their handlers (along with
+    microformat parsing and the *_detail dicts unless those are asked for),
+    so the keys that are filled in are the wanted ones and a few that come
+    with them.
+
+    microformats, if true, looks for microformats in HTML content and adds
+    the tags, enclosures, XFN and vcard it finds; it defaults to
+    PARSE_MICROFORMATS.
+
+    parse_cache, if given, is a ParseCache which lets unchanged feed bodies
+    skip parsing altogether.
+
+    max_bytes and max_compressed_bytes, if given, limit the size of the feed
+    that will be downloaded, and timeout the time allowed for downloading
+    it.  stats, if given, is handed a trace of the download, and host_health
+    fits the timeout to the host and trips its circuit breaker.  See fetch().
+    '''
+    result, data = fetch(url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers, response_headers, max_bytes, max_compressed_bytes, timeout, stats, host_health)
+    return parse_fetched(result, data, engine, parse_cache, sanitizer, lazy_html, fields, microformats)
+
+def parse_fetched(result, data, engine=None, parse_cache=None, sanitizer=None, lazy_html=None, fields=None, microformats=None):
+    '''Parse a feed downloaded by fetch(), see parse() for the arguments'''
+    if engine is None:
+        engine = XML_ENGINE
+    if sanitizer is None:
+        sanitizer = HTML_SANITIZER
+    if lazy_html is None:
+        lazy_html = LAZY_HTML
+    if microformats is None:
+        microformats = PARSE_MICROFORMATS
+    if data is None:
+        return result
+    if parse_cache is not None and result.get('status') != 304:
+        size = len(data)
+        key = parse_cache.key(result, data, engine, sanitizer, int(bool(lazy_html)),
+                              fields is not None and sorted(fields) or None,
+                              int(bool(microformats)))
+        if parse_cache.get(key, result):
+            return result
+    data, entities, baseuri, baselang, use_strict_parser = _decode(result, data)
+    if data is None:
+        return result
+    for feedparser in _run_parser(result, data, entities, baseuri, baselang, use_strict_parser, engine, sanitizer, lazy_html, fields, microformats):
+        pass
+    if parse_cache is not None:
+        parse_cache.set(key, result, size)
     return result
 
+def iterparse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[], request_headers={}, response_headers={}, engine=None, max_bytes=None, max_compressed_bytes=None, timeout=None, stats=None, sanitizer=None, lazy_html=None, fields=None, microformats=None, host_health=None):
+    '''Parse a feed like parse(), but yield each entry as soon as it is closed
+
+    Entries are handed out and forgotten one at a time instead of being
+    collected into result['entries'], so memory use does not grow with the
+    number of entries in the feed.  Works best with engine='lxml', which
+    also discards the parsed document as it goes.
+    '''
+    if engine is None:
+        engine = XML_ENGINE
+    if lazy_html is None:
+        lazy_html = LAZY_HTML
+    if microformats is None:
+        microformats = PARSE_MICROFORMATS
+    result, data = fetch(url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers, response_headers, max_bytes, max_compressed_bytes, timeout, stats, host_health)
+    if data is None:
+        return
+    data, entities, baseuri, baselang, use_strict_parser = _decode(result, data)
+    if data is None:
+        return
+    current = None
+    skip = yielded = 0
+    for feedparser in _run_parser(result, data, entities, baseuri, baselang, use_strict_parser, engine, sanitizer, lazy_html, fields, microformats):
+        if feedparser is not current:
+            # the loose parser starts again from the top of the document,
+            # don't hand out the entries the strict parser already produced
+            current, skip = feedparser, yielded
+        done = len(feedparser.entries)
+        if feedparser.inentry:
+            done -= 1
+        for entry in feedparser.entries[:done]:
+            if skip:
+                skip -= 1
+                continue
+            yielded += 1
+            yield entry
+        del feedparser.entries[:done]
+
 class Serializer:
     def __init__(self, results):
         self.results = results
@@ -0,0 +1,413 @@
+"""
+feedparser_benchmark.py times the hot paths of feedparser against the way
+they used to be done, so that a change meant to speed one up can show that
+it does.
+
+Run it from this directory with:
+
+$ python feedparser_benchmark.py [feed url or file ...]
+
+Feeds given on the command line are used as the corpus where a benchmark
+needs entries, otherwise those saved in benchmark_feeds/ are, otherwise a
+made up one is. Numbers from the made up corpus flatter some changes, so
+save a corpus of real feeds to compare before and after with:
+
+$ python feedparser_benchmark.py --save <feed url> ...
+
+:author: Adam Haney
+:organization: Retickr, LLC
+:contact: adam.haney@retickr.com
+:license: Copyright (c) 2011 retickr, LLC
+"""
+
+import hashlib
+import os
+import sys
+import time
+import types
+
+import feedparser
+
+
+# Where --save keeps the real feeds used as the corpus
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_feeds")
+
+# A blog post of the usual sort, with the usual junk in it
+ENTRY = """<p>Posted by <a href="/author/%(i)d" rel="Author">Jane Doe</a> on
+<time datetime="2011-06-%(day)02d">June %(day)d</time></p>
+<div class="post" style="margin: 0 auto; font-family: 'Helvetica'; position: relative">
+<p><img src="http://cdn.example.com/img/%(i)d.jpg" width="600" height="400"
+ alt="Photo &quot;%(i)d&quot;" style="border: 1px solid #ccc; float: left" onload="track(%(i)d)"/>
+Lorem ipsum dolor sit amet, <b>consectetur</b> adipiscing elit. Sed do
+<em>eiusmod</em> tempor incididunt ut labore et dolore magna aliqua &amp; more
+&#8220;quoted&#8221; text &mdash; <a href="http://example.com/%(i)d?a=1&amp;b=2"
+ target="_blank" onclick="return go(this)">read more</a>.</p>
+<ul><li>First point</li><li>Second <code>point</code></li><li>Third</li></ul>
+<blockquote><p>Ut enim ad minim veniam, quis nostrud exercitation ullamco
+laboris nisi ut aliquip ex ea commodo consequat.</p></blockquote>
+<script type="text/javascript">var _gaq = _gaq || []; _gaq.push(['_trackPageview']);</script>
+<iframe src="http://www.youtube.com/embed/%(i)d" width="560" height="315" frameborder="0"></iframe>
+<table><tr><th>Year</th><th>Total</th></tr><tr><td>2010</td><td align="right">%(i)d</td></tr></table>
+<p class="share"><a href="http://twitter.com/share?url=http://example.com/%(i)d">Tweet</a> |
+<a href="http://www.facebook.com/sharer.php?u=http://example.com/%(i)d">Share</a></p>
+<img src="http://feeds.feedburner.com/~r/example/~4/%(i)d" height="1" width="1"/>
+</div>"""
+
+
+# A feed of them, each with a short description and the post in full
+FEED = """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/"
+     xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:media="http://search.yahoo.com/mrss/">
+<channel><title>Example</title><link>http://example.com/</link>
+<description>A &lt;b&gt;blog&lt;/b&gt;</description>
+%s
+</channel></rss>"""
+
+ITEM = """<item><title>Post %(i)d</title><link>http://example.com/%(i)d</link>
+<guid isPermaLink="false">post-%(i)d</guid><comments>http://example.com/%(i)d#comments</comments>
+<pubDate>Tue, %(day)02d Jun 2011 04:00:00 GMT</pubDate><dc:creator>Jane Doe</dc:creator>
+<category>News</category><category>Photos</category><category domain="http://example.com/t">misc</category>
+<enclosure url="http://cdn.example.com/%(i)d.mp3" length="1024" type="audio/mpeg"/>
+<media:thumbnail url="http://cdn.example.com/img/%(i)d_t.jpg" width="75" height="50"/>
+<description>&lt;p&gt;The first &lt;b&gt;paragraph&lt;/b&gt; of post %(i)d&lt;/p&gt;</description>
+<content:encoded><![CDATA[%(html)s]]></content:encoded></item>"""
+
+
+class LegacyFeedParserDict(dict):
+    """
+    FeedParserDict as it was, remapping aliases on every access
+    """
+    keymap = feedparser.FeedParserDict.keymap
+
+    def __getitem__(self, key):
+        if key == 'category':
+            return dict.__getitem__(self, 'tags')[0]['term']
+        if key == 'enclosures':
+            norel = lambda link: LegacyFeedParserDict([(name,value) for (name,value) in link.items() if name!='rel'])
+            return [norel(link) for link in dict.__getitem__(self, 'links') if link['rel']=='enclosure']
+        if key == 'license':
+            for link in dict.__getitem__(self, 'links'):
+                if link['rel']=='license' and link.has_key('href'):
+                    return link['href']
+        if key == 'categories':
+            return [(tag['scheme'], tag['term']) for tag in dict.__getitem__(self, 'tags')]
+        realkey = self.keymap.get(key, key)
+        if type(realkey) == types.ListType:
+            for k in realkey:
+                if dict.__contains__(self, k):
+                    return dict.__getitem__(self, k)
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        return dict.__getitem__(self, realkey)
+
+    def __setitem__(self, key, value):
+        for k in self.keymap.keys():
+            if key == k:
+                key = self.keymap[k]
+                if type(key) == types.ListType:
+                    key = key[0]
+        return dict.__setitem__(self, key, value)
+
+    def get(self, key, default=None):
+        if self.has_key(key):
+            return self[key]
+        else:
+            return default
+
+    def has_key(self, key):
+        try:
+            return hasattr(self, key) or dict.__contains__(self, key)
+        except AttributeError:
+            return False
+
+    def __getattr__(self, key):
+        try:
+            return self.__dict__[key]
+        except KeyError:
+            pass
+        try:
+            assert not key.startswith('_')
+            return self.__getitem__(key)
+        except:
+            raise AttributeError, "object has no attribute '%s'" % key
+
+    def __setattr__(self, key, value):
+        if key.startswith('_') or key == 'data':
+            self.__dict__[key] = value
+        else:
+            return self.__setitem__(key, value)
+
+    def __contains__(self, key):
+        return self.has_key(key)
+
+
+def corpus(feeds=None):
+    """
+    The feeds given, or else the feeds saved in CORPUS_DIR
+    """
+    if feeds or not os.path.isdir(CORPUS_DIR):
+        return feeds
+    return [os.path.join(CORPUS_DIR, name) for name in sorted(os.listdir(CORPUS_DIR))]
+
+
+def save_feeds(urls):
+    """
+    Download feeds into CORPUS_DIR, so that later runs time the same bytes
+    """
+    if not os.path.isdir(CORPUS_DIR):
+        os.makedirs(CORPUS_DIR)
+    for url in urls:
+        result, data = feedparser.fetch(url)
+        if not data:
+            print "  %s: %r" % (url, result.get("bozo_exception"))
+            continue
+        path = os.path.join(CORPUS_DIR, hashlib.md5(url).hexdigest() + ".xml")
+        with open(path, "wb") as f:
+            f.write(data)
+        print "  %s: %d bytes" % (url, len(data))
+
+
+def best_of(func, repeat=5):
+    """
+    The fastest of repeat calls to func, in seconds
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def bench_dates(entries=10000):
+    """
+    Per entry cost of parsing a date, going through every handler as
+    before, through the fast path alone and through the fast path with
+    the cache of recent dates. Feeds are dated a few ways, and a crawl
+    sees the same entries many times over, so the dates come from a pool
+    of a tenth as many distinct strings.
+    """
+    rfc822 = ['Tue, %02d Jun 2003 %02d:%02d:00 GMT' % (i % 28 + 1, i % 24, i % 60)
+              for i in range(entries / 20)]
+    w3dtf = ['2003-06-%02dT%02d:%02d:00Z' % (i % 28 + 1, i % 24, i % 60)
+             for i in range(entries / 20)]
+    dates = [(rfc822 + w3dtf)[i % (entries / 10)] for i in range(entries)]
+
+    def handlers():
+        for date in dates:
+            feedparser._parse_date_handlers(date)
+
+    def fast_path():
+        for date in dates:
+            feedparser._parse_date_fast(date)
+
+    def cached():
+        feedparser._date_cache.clear()
+        for date in dates:
+            feedparser._parse_date(date)
+
+    print "date parsing, per entry"
+    for name, func in (("every handler", handlers), ("fast path", fast_path),
+                       ("fast path+cache", cached)):
+        print "  %-16s %6.1fus" % (name, best_of(func) / entries * 1e6)
+
+
+def entry_html(feeds=None, entries=200):
+    """
+    The HTML content and summaries of the entries in feeds as they were
+    before sanitizing, or made up entries if no feeds are given
+    """
+    if not feeds:
+        return [ENTRY % {"i": i, "day": i % 28 + 1} for i in range(entries)]
+
+    html = []
+    sanitize, feedparser.SANITIZE_HTML = feedparser.SANITIZE_HTML, 0
+    try:
+        for feed in feeds:
+            for entry in feedparser.parse(feed)["entries"]:
+                html.extend(content["value"] for content in entry.get("content", []))
+                if "summary" in entry:
+                    html.append(entry["summary"])
+    finally:
+        feedparser.SANITIZE_HTML = sanitize
+    return html
+
+
+def bench_sanitizer(feeds=None):
+    """
+    Per entry cost of sanitizing HTML with each sanitizer engine
+    """
+    html = entry_html(feeds)
+    size = sum(len(h) for h in html) / max(len(html), 1)
+    print "sanitizing %d entries of %d characters on average, per entry" % (len(html), size)
+    for sanitizer in ("sgmllib", "lxml"):
+        seconds = best_of(lambda: [feedparser._sanitizeHTML(h, "utf-8", "text/html", sanitizer)
+                                   for h in html], repeat=3)
+        print "  %-16s %6.1fus" % (sanitizer, seconds / max(len(html), 1) * 1e6)
+
+
+def feed_documents(feeds=None, entries=50):
+    """
+    The bodies of feeds, or a made up feed if no feeds are given
+    """
+    if not feeds:
+        items = [ITEM % {"i": i, "day": i % 28 + 1,
+                         "html": ENTRY % {"i": i, "day": i % 28 + 1}}
+                 for i in range(entries)]
+        return [FEED % "\n".join(items)]
+    return [feedparser.fetch(feed)[1] for feed in feeds]
+
+
+def bench_engines(feeds=None):
+    """
+    Per entry cost of parsing feeds with each XML engine. HTML content is
+    neither sanitized nor has its relative URIs resolved, so that the time
+    the engines take isn't drowned out.
+    """
+    documents = feed_documents(feeds)
+    entries = sum(len(feedparser.parse(d)["entries"]) for d in documents) or 1
+    print "parsing %d entries with each XML engine, per entry" % entries
+    sanitize, resolve = feedparser.SANITIZE_HTML, feedparser.RESOLVE_RELATIVE_URIS
+    feedparser.SANITIZE_HTML = feedparser.RESOLVE_RELATIVE_URIS = 0
+    try:
+        for engine in ("sax", "lxml"):
+            seconds = best_of(lambda: [feedparser.parse(d, engine=engine)
+                                       for d in documents], repeat=3)
+            print "  %-16s %6.1fus" % (engine, seconds / entries * 1e6)
+    finally:
+        feedparser.SANITIZE_HTML, feedparser.RESOLVE_RELATIVE_URIS = sanitize, resolve
+
+
+def bench_lazy_html(feeds=None):
+    """
+    Per entry cost of parsing feeds with markup rendered as it is parsed,
+    against leaving it until it is read. A crawl reads the title, link and
+    date of every entry, and the longest of its content and summary.
+    """
+    documents = feed_documents(feeds)
+    entries = sum(len(feedparser.parse(d)["entries"]) for d in documents) or 1
+
+    def read(lazy_html, content):
+        for document in documents:
+            for entry in feedparser.parse(document, lazy_html=lazy_html)["entries"]:
+                entry.get("title"), entry.get("link"), entry.get("updated_parsed")
+                if content:
+                    [c["value"] for c in entry.get("content", [])], entry.get("summary")
+
+    print "parsing %d entries, per entry" % entries
+    for name, lazy_html, content in (("eager", 0, True), ("lazy, no content", 1, False),
+                                     ("lazy, content", 1, True)):
+        seconds = best_of(lambda: read(lazy_html, content), repeat=3)
+        print "  %-16s %6.1fus" % (name, seconds / entries * 1e6)
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    Bytes taken up by obj and everything it holds
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in dict.items(obj))
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_sizeof(v, seen) for v in obj)
+    return size
+
+
+def bench_fields(feeds=None):
+    """
+    Per entry cost, and the memory each parsed entry holds on to, of
+    filling in every field against only those a crawl reads. HTML is left
+    unrendered (lazy_html) so that sanitizing doesn't drown out the rest.
+    """
+    documents = feed_documents(feeds)
+    fields = ["title", "link", "updated", "id", "content", "summary"]
+
+    count = sum(len(feedparser.parse(d)["entries"]) for d in documents) or 1
+    print "parsing %d entries for some fields, per entry" % count
+    for name, wanted in (("every field", None), ("crawl fields", fields)):
+        entries = [e for d in documents for e in feedparser.parse(d, fields=wanted)["entries"]]
+        seconds = best_of(lambda: [feedparser.parse(d, lazy_html=1, fields=wanted)
+                                   for d in documents], repeat=3)
+        print "  %-16s %6.1fus %6d bytes" % (name, seconds / count * 1e6,
+                                             deep_sizeof(entries) / count)
+
+
+def converted(obj, cls):
+    """
+    A copy of a parse result with cls in place of FeedParserDict
+    """
+    if isinstance(obj, dict):
+        copy = cls()
+        dict.update(copy, [(k, converted(v, cls)) for k, v in obj.items()])
+        return copy
+    if isinstance(obj, list):
+        return [converted(v, cls) for v in obj]
+    return obj
+
+
+def bench_feedparserdict(feeds=None):
+    """
+    Memory held by each entry, and the cost of the reads and writes a parse
+    and a crawl make of it, with FeedParserDict as it was and as it is
+    """
+    entries = [e for d in feed_documents(feeds) for e in feedparser.parse(d)["entries"]]
+    count = len(entries) or 1
+
+    def access(entries, cls):
+        for entry in entries:
+            entry["title"], entry.link, entry.get("updated_parsed"), entry.get("comments")
+            entry["date"], entry.get("description"), "content" in entry, "nothing" in entry
+            detail = cls()
+            detail["type"], detail["language"], detail["value"] = "text/html", None, ""
+            detail["description"] = ""
+
+    print "FeedParserDict, per entry"
+    for name, cls in (("as it was", LegacyFeedParserDict), ("as it is", feedparser.FeedParserDict)):
+        copies = converted(entries, cls)
+        seconds = best_of(lambda: access(copies, cls))
+        print "  %-16s %6.1fus %6d bytes" % (name, seconds / count * 1e6,
+                                             deep_sizeof(copies) / count)
+
+
+def bench_microformats(feeds=None):
+    """
+    Per entry cost of parsing with and without looking for microformats,
+    and the part of it feedparser.microformat_timing puts down to them
+    """
+    if feedparser.BeautifulSoup is None:
+        print "microformats need BeautifulSoup, which is not installed"
+        return
+
+    documents = feed_documents(feeds)
+    count = sum(len(feedparser.parse(d)["entries"]) for d in documents) or 1
+    print "parsing %d entries for microformats, per entry" % count
+    for name, microformats in (("without", 0), ("with", 1)):
+        feedparser.microformat_timing.update(calls=0, seconds=0.0)
+        seconds = best_of(lambda: [feedparser.parse(d, microformats=microformats)
+                                   for d in documents], repeat=3)
+        print "  %-16s %6.1fus, %6.1fus of it in %d calls" % (
+            name, seconds / count * 1e6,
+            feedparser.microformat_timing["seconds"] / 3 / count * 1e6,
+            feedparser.microformat_timing["calls"] / 3)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--save"]:
+        save_feeds(sys.argv[2:])
+        sys.exit()
+    feeds = corpus(sys.argv[1:])
+    if feeds:
+        print "corpus: %d feeds" % len(feeds)
+    else:
+        print "corpus: made up entries, see --save"
+    bench_engines(feeds)
+    bench_dates()
+    bench_sanitizer(feeds)
+    bench_lazy_html(feeds)
+    bench_fields(feeds)
+    bench_feedparserdict(feeds)
+    bench_microformats(feeds)
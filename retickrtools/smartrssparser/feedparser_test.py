@@ -0,0 +1,551 @@
+"""
+feedparser_test.py checks that the XML engines available to feedparser.parse
+produce the same results, that feedparser.iterparse agrees with them, and
+that the shortcuts taken while converting documents to utf-8 and parsing
+dates don't change what comes out, that the HTML sanitizers agree, that
+markup left to be rendered when it is read comes out the same, that
+asking for some fields gets those fields as they would otherwise be, that
+microformats are only looked for when asked, and that FeedParserDict keeps
+its aliases.
+
+feedparser imports the rest of retickrtools, so run it from this directory
+with the top of the repository on the path:
+
+$ PYTHONPATH=../.. python -m unittest feedparser_test
+
+:author: Adam Haney
+:organization: Retickr, LLC
+:contact: adam.haney@retickr.com
+:license: Copyright (c) 2011 retickr, LLC
+"""
+
+import pickle
+import unittest
+
+import feedparser
+
+
+# A small corpus of documents that exercise the different paths through the
+# strict parser: the major feed formats, namespaces, inline xhtml, xml:base,
+# entities, CDATA, comments and documents that are not well formed
+CORPUS = {
+    "rss20": """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/"
+     xmlns:dc="http://purl.org/dc/elements/1.1/"
+     xmlns:media="http://search.yahoo.com/mrss/">
+  <channel>
+    <title>Example &amp; Co</title>
+    <link>http://example.com/</link>
+    <description>All the news</description>
+    <language>en-us</language>
+    <item>
+      <title>First <!-- a comment --> story</title>
+      <link>http://example.com/1?a=1&amp;b=2</link>
+      <guid isPermaLink="false">story-1</guid>
+      <pubDate>Tue, 10 Jun 2003 04:00:00 GMT</pubDate>
+      <description>&lt;p&gt;Hello &lt;b&gt;world&lt;/b&gt;&lt;/p&gt;</description>
+      <content:encoded><![CDATA[<p>Full <a href="/relative">text</a><script>alert(1)</script></p>]]></content:encoded>
+      <dc:creator>Jane Doe</dc:creator>
+      <category domain="http://example.com/tags">news</category>
+      <enclosure url="http://example.com/a.mp3" length="123" type="audio/mpeg"/>
+      <media:thumbnail url="http://example.com/t.jpg" width="75" height="50"/>
+    </item>
+    <item>
+      <title>Second story</title>
+      <link>http://example.com/2</link>
+      <dc:date>2003-06-10T04:00:00Z</dc:date>
+      <description>Plain &#8220;text&#8221; &#169;</description>
+    </item>
+  </channel>
+</rss>""",
+
+    "atom10": """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xml:base="http://example.org/"
+      xml:lang="en">
+  <title type="text">Atom example</title>
+  <subtitle type="html">&lt;em&gt;subtitle&lt;/em&gt;</subtitle>
+  <link rel="alternate" type="text/html" href="/"/>
+  <link rel="self" href="/feed.atom"/>
+  <updated>2003-12-13T18:30:02Z</updated>
+  <author><name>John Doe</name><email>john@example.org</email></author>
+  <id>urn:uuid:60a76c80-d399-11d9-b93C-0003939e0af6</id>
+  <entry xml:base="entries/">
+    <title type="xhtml"><div xmlns="http://www.w3.org/1999/xhtml">An <b>xhtml</b> title</div></title>
+    <link href="one"/>
+    <link rel="enclosure" href="one.mp3" length="10" type="audio/mpeg"/>
+    <id>urn:uuid:1225c695-cfb8-4ebb-aaaa-80da344efa6a</id>
+    <updated>2003-12-13T18:30:02+01:00</updated>
+    <published>2003-12-13T08:29:29-04:00</published>
+    <summary>Some text.</summary>
+    <content type="xhtml" xml:lang="fr">
+      <div xmlns="http://www.w3.org/1999/xhtml"><p>Du <a href="deux">texte</a></p><img src="i.png" onerror="x()"/></div>
+    </content>
+    <category term="tech" scheme="http://example.org/cats" label="Tech"/>
+    <contributor><name>Someone</name><uri>http://someone.example.org/</uri></contributor>
+  </entry>
+  <entry>
+    <title>Second</title>
+    <link href="http://example.org/2"/>
+    <id>tag:example.org,2003:2</id>
+    <updated>2003-12-14T18:30:02Z</updated>
+    <content type="html">&lt;p style="color: red; behavior: url(x)"&gt;styled&lt;/p&gt;</content>
+  </entry>
+</feed>""",
+
+    "rss10": """<?xml version="1.0"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+         xmlns="http://purl.org/rss/1.0/"
+         xmlns:dc="http://purl.org/dc/elements/1.1/">
+  <channel rdf:about="http://example.com/">
+    <title>RDF example</title>
+    <link>http://example.com/</link>
+    <description>An RSS 1.0 feed</description>
+  </channel>
+  <item rdf:about="http://example.com/a">
+    <title>RDF item</title>
+    <link>http://example.com/a</link>
+    <dc:date>2004-01-02T03:04:05-05:00</dc:date>
+    <dc:subject>rdf</dc:subject>
+  </item>
+</rdf:RDF>""",
+
+    "unknown_namespace": """<?xml version="1.0"?>
+<rss version="2.0" xmlns:foo="http://example.com/foo">
+  <channel>
+    <title>Namespaced</title>
+    <foo:bar baz="1">extension</foo:bar>
+    <item><title>x</title><foo:thing>y</foo:thing></item>
+  </channel>
+</rss>""",
+
+    "entities": """<?xml version="1.0"?>
+<!DOCTYPE rss [
+  <!ENTITY copy2 "&#169;">
+]>
+<rss version="2.0"><channel><title>Ents &copy2; &amp; &lt;b&gt;</title>
+<item><title>Item &#x263A;</title></item></channel></rss>""",
+
+    "latin1": """<?xml version="1.0" encoding="iso-8859-1"?>
+<rss version="2.0"><channel><title>Caf\xe9</title>
+<item><title>Cr\xe8me br\xfbl\xe9e</title></item></channel></rss>""",
+
+    "ill_formed": """<?xml version="1.0"?>
+<rss version="2.0"><channel><title>Broken &nbsp; feed</title>
+<item><title>Still <b>parsed</title><link>http://example.com/x</link></item>
+</channel>""",
+
+    "undeclared_prefix": """<?xml version="1.0"?>
+<rss version="2.0"><channel><title>t</title>
+<item><media:title>m</media:title></item></channel></rss>""",
+}
+
+
+def comparable(result):
+    """
+    Strip the parts of a parse result that legitimately differ between
+    engines (exception instances carry engine specific messages)
+    """
+    result = dict(result)
+    exc = result.pop('bozo_exception', None)
+    result['bozo_exception'] = exc.__class__.__name__ if exc else None
+    return result
+
+
+class EngineParityTest(unittest.TestCase):
+
+    def assertParity(self, name):
+        document = CORPUS[name]
+        sax = feedparser.parse(document, engine='sax')
+        lxml = feedparser.parse(document, engine='lxml')
+        self.assertEqual(sax['bozo'], lxml['bozo'], name)
+        self.assertEqual(comparable(sax)['feed'], comparable(lxml)['feed'], name)
+        self.assertEqual(sax['entries'], lxml['entries'], name)
+        self.assertEqual(sax['version'], lxml['version'], name)
+        self.assertEqual(sax['namespaces'], lxml['namespaces'], name)
+        self.assertEqual(sax['encoding'], lxml['encoding'], name)
+
+    def test_corpus(self):
+        for name in sorted(CORPUS):
+            self.assertParity(name)
+
+    def test_lxml_engine_is_used(self):
+        if feedparser._lxml_etree is None:
+            self.skipTest("lxml is not installed")
+        result = feedparser.parse(CORPUS["rss20"], engine='lxml')
+        self.assertEqual(0, result['bozo'])
+        self.assertEqual(2, len(result['entries']))
+
+    def test_default_engine(self):
+        default = feedparser.parse(CORPUS["atom10"])
+        lxml = feedparser.parse(CORPUS["atom10"], engine='lxml')
+        self.assertEqual(default['entries'], lxml['entries'])
+
+
+class IterparseTest(unittest.TestCase):
+
+    def assertSameEntries(self, name, engine):
+        document = CORPUS[name]
+        entries = list(feedparser.iterparse(document, engine=engine))
+        self.assertEqual(feedparser.parse(document, engine=engine)['entries'],
+                         entries, name)
+
+    def test_matches_parse(self):
+        for name in sorted(CORPUS):
+            self.assertSameEntries(name, 'sax')
+            self.assertSameEntries(name, 'lxml')
+
+    def test_entries_are_released(self):
+        items = "".join("<item><title>%d</title></item>" % i for i in range(500))
+        document = '<rss version="2.0"><channel>%s</channel></rss>' % items
+        entries = feedparser.iterparse(document, engine='lxml')
+        first = entries.next()
+        self.assertEqual(u'0', first['title'])
+        self.assertEqual(499, len(list(entries)))
+
+    def test_loose_fallback_does_not_repeat_entries(self):
+        document = ('<rss version="2.0"><channel>'
+                    '<item><title>one</title></item>'
+                    '<item><title>two &nbsp;</title></item>'
+                    '</channel></rss>')
+        titles = [e['title'] for e in feedparser.iterparse(document, engine='lxml')]
+        self.assertEqual(2, len(titles))
+        self.assertEqual(u'one', titles[0])
+
+
+def reference_utf8(data, encoding):
+    """
+    What feedparser._toUTF8 did before it learnt to leave utf-8 alone
+    """
+    newdata = unicode(data, encoding)
+    newdecl = u"<?xml version='1.0' encoding='utf-8'?>"
+    if feedparser._xml_declaration_re.search(newdata):
+        newdata = feedparser._xml_declaration_re.sub(newdecl, newdata)
+    else:
+        newdata = newdecl + u'\n' + newdata
+    return newdata.encode('utf-8')
+
+
+class EncodingTest(unittest.TestCase):
+
+    DOCUMENTS = dict(CORPUS, **{
+        "utf8": '<?xml version="1.0" encoding="utf-8"?>\n<rss version="2.0"><channel><title>Caf\xc3\xa9 \xe2\x98\xba</title></channel></rss>',
+        "no_declaration": '<rss><title>Caf\xc3\xa9</title></rss>',
+        "truncated_utf8": '<rss><title>Caf\xc3</title></rss>',
+        })
+
+    def test_same_as_reencoding(self):
+        for name, document in sorted(self.DOCUMENTS.items()):
+            for encoding in ('utf-8', 'us-ascii', 'windows-1252', 'iso-8859-1', 'utf-16le'):
+                try:
+                    expected = reference_utf8(document, encoding)
+                except UnicodeError, e:
+                    self.assertRaises(e.__class__, feedparser._toUTF8, document, encoding)
+                else:
+                    self.assertEqual(expected, feedparser._toUTF8(document, encoding), (name, encoding))
+
+    def test_utf8_validation(self):
+        self.assertTrue(feedparser._isUTF8('caf\xc3\xa9'))
+        self.assertFalse(feedparser._isUTF8('caf\xe9'))
+        # A character split across the chunks it is checked in
+        self.assertTrue(feedparser._isUTF8('a\xe2\x98\xba' * 10, chunk_size=6))
+        self.assertFalse(feedparser._isUTF8('a\xe2\x98\xba\xe2\x98', chunk_size=4))
+
+    def test_declared_encoding_is_kept(self):
+        result = feedparser.parse(self.DOCUMENTS["utf8"])
+        self.assertEqual('utf-8', result['encoding'])
+        self.assertEqual(u'Caf\xe9 \u263a', result['feed']['title'])
+        result = feedparser.parse(CORPUS["latin1"])
+        self.assertEqual('iso-8859-1', result['encoding'])
+        self.assertEqual(u'Caf\xe9', result['feed']['title'])
+
+
+# Dates in the formats feeds use, and some they shouldn't
+DATES = [
+    'Tue, 10 Jun 2003 04:00:00 GMT', 'Tue, 10 Jun 2003 04:00:00 +0200',
+    'Tue, 10 Jun 2003 04:00 EST', '10 Jun 2003 04:00:00 PT', 'Tue, 10 Jun 03 04:00:00 GMT',
+    'Tue, 10 Jun 2003', 'Tue, 10 Jun 2003 04:00:00 Etc/GMT', 'Tue 10 Jun 2003 04:00:00 -0400',
+    'Thu, 01 Jan 1970 00:00:00 +0000', 'Sun Jan  4 16:29:06 PST 2004',
+    '2003-12-13T18:30:02Z', '2003-12-13T18:30:02+01:00', '2003-12-13T18:30:02.25-05:00',
+    '2003-12-13T18:30Z', '2003-12-13', '2003-12', '2003', '20031213T183002Z', '2003-347',
+    '2003-12-13T18:30:02-0430', '2003-02-31T18:30:02Z', '2003-13-01T00:00:00Z',
+    '31 Feb 2003 25:61:61 EDT', '10 Jun 1955 04:00:00 -0430', '10 jun 2003 04:00:00 ut',
+    '10 Jun 2003 04:00:00 A', '10 Jun 0999 04:00:00 GMT', '0999-06-10T04:00:00Z',
+    'Sun, 31 Dec 1899 23:00:00 GMT', 'Sun, 31 Dec 1899 23:00:00 -0200', '1899-12-31T23:00:00Z',
+    '1899-12-31T23:00:00-02:00', '1900-01-01T00:30:00+01:00', '1000-01-01T00:00:00Z',
+    '03-12-13', '2004-02-28 13:45:00', u'2004-07-08 23:56:58', 'Fri, 2006/09/15 08:19:53 EDT',
+    u'\u039a\u03c5\u03c1, 11 \u0399\u03bf\u03cd\u03bb 2004 12:00:00 EST',
+    u'2004-j\u00falius-13T9:15-05:00', '', 'garbage', '2003-13-45',
+    ]
+
+
+class DateTest(unittest.TestCase):
+
+    def test_same_as_every_handler(self):
+        for date in DATES:
+            self.assertEqual(feedparser._parse_date_handlers(date), feedparser._parse_date(date), date)
+            # and again from the cache
+            self.assertEqual(feedparser._parse_date_handlers(date), feedparser._parse_date(date), date)
+
+    def test_no_dates_before_1900(self):
+        for date in ['Sun, 31 Dec 1899 23:00:00 -0200', '1899-12-31T23:00:00Z']:
+            self.assertEqual(None, feedparser._parse_date_fast(date), date)
+            self.assertEqual(None, feedparser._parse_date(date), date)
+
+    def test_registered_handler_comes_first(self):
+        handlers = list(feedparser._date_handlers)
+        try:
+            feedparser.registerDateHandler(lambda date: (2000, 1, 1, 0, 0, 0, 5, 1, 0))
+            self.assertEqual(2000, feedparser._parse_date(DATES[0])[0])
+        finally:
+            feedparser._date_handlers[:] = handlers
+            feedparser._date_cache.clear()
+            feedparser._date_fast_path = True
+
+
+# HTML of the sort found in feed entries, well formed so that both
+# sanitizers see the same document
+HTML = [
+    '<p>Plain <b>bold</b> <i>italic</i> &amp; <a href="http://example.com/a?b=1&amp;c=2">a link</a></p>',
+    '<p style="color: red; behavior: url(x)">styled</p><p style="margin: 0 auto; border: 1px solid #ccc">box</p>',
+    '<p style="background: url(http://evil/x.png); font-weight: bold">bg</p><span style="position: absolute">pos</span>',
+    '<div><script type="text/javascript">alert("x")</script>after</div><style>p { color: red }</style>',
+    '<a href="javascript:alert(1)" onclick="steal()">js</a><a href="/relative">rel</a><a href="mailto:a@b.c">mail</a>',
+    '<img src="http://example.com/i.png" alt="An &quot;image&quot;" width="100" onerror="x()"/><br/><hr/>',
+    '<iframe src="http://example.com/embed">frame</iframe><object data="x.swf"><param name="a" value="b"/></object>',
+    '<table border="1"><thead><tr><th>h</th></tr></thead><tbody><tr><td colspan="2">c</td></tr></tbody></table>',
+    '<ul><li>one</li><li>two <em>2</em></li></ul><ol start="3"><li>three</li></ol>',
+    '<blockquote cite="http://example.com/q"><p>Quoted</p></blockquote><pre><code>x &lt; y</code></pre>',
+    '<p>Caf\xc3\xa9 &#8220;quotes&#8221; &#169; &copy; &#x263A;</p>',
+    '<!-- a comment --><blink>blinking</blink><marquee>moving</marquee><font color="red" face="Arial">old</font>',
+    '<form action="http://example.com/" method="post"><input type="TEXT" name="q"/><button>Go</button></form>',
+    '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 10 10"><circle cx="5" cy="5" r="4" fill="red"></circle></svg>',
+    '<math xmlns="http://www.w3.org/1998/Math/MathML"><mi>x</mi><mo>+</mo><mn>1</mn></math>',
+    '<p class="Intro" id="top" data-x="y" lang="en" dir="ltr" title="t">attrs</p>',
+    'no markup at all',
+    '',
+    # markup the two parsers read differently unless feedparser steps in
+    '<![CDATA[<script>alert(1)</script>]]>', '<p><![CDATA[x]]></p>',
+    'a<!-- x --!>b<p>c</p>', 'a<!-->b', 'a<!--->b', 'x<!-- a -- > b -->y', 'x<? php ?>y',
+    ]
+
+
+def html_tree(html):
+    """
+    A comparable form of an HTML fragment, so that markup which means the
+    same (entities written out or not, attributes in another order) is equal
+    """
+    from lxml import html as lxml_html
+    if isinstance(html, str):
+        html = html.decode('utf-8')
+    if not html:
+        return None
+
+    def tree(element):
+        return (element.tag, sorted(element.items()), element.text,
+                [tree(child) for child in element], element.tail)
+    return tree(lxml_html.fragment_fromstring(html, create_parent='div'))
+
+
+class SanitizerParityTest(unittest.TestCase):
+
+    def setUp(self):
+        if feedparser._lxml_html is None:
+            self.skipTest("lxml is not installed")
+
+    def sanitize(self, html, sanitizer, _type='text/html'):
+        return feedparser._sanitizeHTML(html, 'utf-8', _type, sanitizer)
+
+    def test_fragments(self):
+        for html in HTML:
+            for _type in ('text/html', 'application/xhtml+xml'):
+                self.assertEqual(html_tree(self.sanitize(html, 'sgmllib', _type)),
+                                 html_tree(self.sanitize(html, 'lxml', _type)), html)
+
+    def test_nothing_dangerous_survives(self):
+        for html in HTML:
+            sanitized = self.sanitize(html, 'lxml').lower()
+            for dangerous in ('<script', '<style', '<iframe', 'javascript:', 'onclick', 'onerror', 'url('):
+                self.assertFalse(dangerous in sanitized, (dangerous, html))
+
+    def test_feeds(self):
+        for name in sorted(CORPUS):
+            sgmllib = feedparser.parse(CORPUS[name], sanitizer='sgmllib')
+            lxml = feedparser.parse(CORPUS[name], sanitizer='lxml')
+            self.assertEqual(len(sgmllib['entries']), len(lxml['entries']), name)
+            for sgmllib_entry, lxml_entry in zip(sgmllib['entries'], lxml['entries']):
+                self.assertEqual(html_tree(sgmllib_entry.get('summary')),
+                                 html_tree(lxml_entry.get('summary')), name)
+                self.assertEqual([html_tree(c['value']) for c in sgmllib_entry.get('content', [])],
+                                 [html_tree(c['value']) for c in lxml_entry.get('content', [])], name)
+                self.assertEqual(sgmllib_entry.get('link'), lxml_entry.get('link'), name)
+
+
+def rendered(obj):
+    """
+    A parse result as plain dicts and lists, with any markup left for later
+    rendered on the way
+    """
+    if isinstance(obj, dict):
+        return dict((key, rendered(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return [rendered(value) for value in obj]
+    return obj
+
+
+class LazyHTMLTest(unittest.TestCase):
+
+    def test_same_as_eager(self):
+        for name in sorted(CORPUS):
+            for engine in ('sax', 'lxml'):
+                eager = feedparser.parse(CORPUS[name], engine=engine)
+                lazy = feedparser.parse(CORPUS[name], engine=engine, lazy_html=1)
+                self.assertEqual(rendered(eager['feed']), rendered(lazy['feed']), name)
+                self.assertEqual(rendered(eager['entries']), rendered(lazy['entries']), name)
+
+    def test_iterparse(self):
+        eager = feedparser.parse(CORPUS["rss20"])['entries']
+        lazy = list(feedparser.iterparse(CORPUS["rss20"], lazy_html=1))
+        self.assertEqual(rendered(eager), rendered(lazy))
+
+    def test_rendered_when_read(self):
+        entry = feedparser.parse(CORPUS["rss20"], lazy_html=1)['entries'][0]
+        self.assertTrue(isinstance(dict.__getitem__(entry, 'summary'), feedparser._LazyHTML))
+        self.assertEqual(u'<p>Hello <b>world</b></p>', entry.summary)
+        self.assertEqual(u'<p>Hello <b>world</b></p>', dict.__getitem__(entry, 'summary'))
+        content = entry['content'][0]['value']
+        self.assertEqual(u'<p>Full <a href="/relative">text</a></p>', content)
+
+    def test_repr_as_text(self):
+        entry = feedparser.parse(CORPUS["rss20"], lazy_html=1)['entries'][0]
+        self.assertEqual(repr(u'<p>Hello <b>world</b></p>'), repr(dict.get(entry, 'summary')))
+
+    def test_render_errors_escape(self):
+        entry = feedparser.parse(CORPUS["rss20"], lazy_html=1)['entries'][0]
+        sanitize = feedparser._sanitizeHTML
+        def broken(*args):
+            raise ValueError('broken')
+        try:
+            feedparser._sanitizeHTML = broken
+            summary = entry.summary
+        finally:
+            feedparser._sanitizeHTML = sanitize
+        self.assertEqual(u'&lt;p&gt;Hello &lt;b&gt;world&lt;/b&gt;&lt;/p&gt;', summary)
+
+    def test_pickles_as_text(self):
+        eager = feedparser.parse(CORPUS["atom10"])['entries']
+        lazy = feedparser.parse(CORPUS["atom10"], lazy_html=1)['entries']
+        self.assertEqual(rendered(eager), rendered(pickle.loads(pickle.dumps(lazy))))
+
+
+# Sets of fields to ask parse for, the first being what a crawl reads
+PROJECTIONS = [
+    ['title', 'link', 'updated', 'content', 'summary', 'id'],
+    ['title'],
+    ['date', 'description', 'guid'],
+    ['tags', 'enclosures', 'license'],
+    ['author', 'author_detail', 'published_parsed'],
+    ['title_detail', 'media_thumbnail', 'comments'],
+]
+
+
+class FieldsTest(unittest.TestCase):
+
+    def assertSameFields(self, full, projected, fields, name):
+        for key in fields:
+            self.assertEqual(full.get(key), projected.get(key), (name, key))
+
+    def test_wanted_fields_match(self):
+        for name in sorted(CORPUS):
+            for engine in ('sax', 'lxml'):
+                full = feedparser.parse(CORPUS[name], engine=engine)
+                for fields in PROJECTIONS:
+                    projected = feedparser.parse(CORPUS[name], engine=engine, fields=fields)
+                    self.assertEqual(full['bozo'], projected['bozo'], name)
+                    self.assertEqual(full['version'], projected['version'], name)
+                    self.assertSameFields(full['feed'], projected['feed'], fields, name)
+                    self.assertEqual(len(full['entries']), len(projected['entries']), name)
+                    for full_entry, entry in zip(full['entries'], projected['entries']):
+                        self.assertSameFields(full_entry, entry, fields, name)
+
+    def test_other_fields_left_out(self):
+        entry = feedparser.parse(CORPUS["rss20"], fields=PROJECTIONS[0])['entries'][0]
+        for key in ('tags', 'author', 'media_thumbnail', 'title_detail', 'summary_detail'):
+            self.assertFalse(key in entry, key)
+        self.assertEqual([], entry['enclosures'])
+        self.assertEqual(u'First  story', entry['title'])
+
+    def test_iterparse(self):
+        full = feedparser.parse(CORPUS["atom10"])['entries']
+        entries = list(feedparser.iterparse(CORPUS["atom10"], fields=['title', 'link']))
+        self.assertEqual([e['title'] for e in full], [e['title'] for e in entries])
+        self.assertEqual([e['link'] for e in full], [e['link'] for e in entries])
+
+
+class MicroformatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parse_microformats = feedparser._parseMicroformats
+        self.calls = []
+        feedparser._parseMicroformats = lambda *args: self.calls.append(args)
+
+    def tearDown(self):
+        feedparser._parseMicroformats = self.parse_microformats
+
+    def test_off_by_default(self):
+        feedparser.parse(CORPUS["rss20"])
+        self.assertEqual([], self.calls)
+
+    def test_asked_for(self):
+        feedparser.parse(CORPUS["rss20"], microformats=1)
+        self.assertEqual(4, len(self.calls))
+        del self.calls[:]
+        feedparser.parse(CORPUS["rss20"], microformats=1, fields=['title', 'summary'])
+        self.assertEqual([], self.calls)
+        feedparser.parse(CORPUS["rss20"], microformats=1, fields=['vcard'])
+        self.assertEqual(4, len(self.calls))
+
+
+class FeedParserDictTest(unittest.TestCase):
+
+    def test_aliases(self):
+        d = feedparser.FeedParserDict()
+        d['description'] = u'summary'
+        d.date = u'updated'
+        d['channel'] = u'feed'
+        self.assertEqual({'summary': u'summary', 'updated': u'updated', 'feed': u'feed'}, dict(d))
+        self.assertEqual(u'summary', d['description'])
+        self.assertEqual(u'updated', d.modified)
+        self.assertEqual(u'feed', d.get('channel'))
+        self.assertTrue('issued' not in d)
+        self.assertTrue('tagline' not in d)
+        self.assertEqual(None, d.get('guid'))
+        self.assertRaises(KeyError, lambda: d['guid'])
+        self.assertRaises(AttributeError, lambda: d.guid)
+
+    def test_list_alias_prefers_first(self):
+        d = feedparser.FeedParserDict(subtitle=u'subtitle')
+        self.assertEqual(u'subtitle', d['description'])
+        dict.__setitem__(d, 'summary', u'summary')
+        self.assertEqual(u'summary', d['description'])
+
+    def test_computed(self):
+        d = feedparser.FeedParserDict(
+            tags=[feedparser.FeedParserDict(term=u't', scheme=u's')],
+            links=[feedparser.FeedParserDict(rel=u'enclosure', href=u'e'),
+                   feedparser.FeedParserDict(rel=u'license', href=u'l')])
+        self.assertEqual(u't', d.category)
+        self.assertEqual([(u's', u't')], d['categories'])
+        self.assertEqual([{'href': u'e'}], d.enclosures)
+        self.assertEqual(u'l', d.get('license'))
+        self.assertFalse('category' in feedparser.FeedParserDict(tags=[]))
+
+    def test_no_instance_dict(self):
+        d = feedparser.FeedParserDict(title=u'title')
+        self.assertFalse(hasattr(d, '__dict__'))
+        self.assertRaises(AttributeError, setattr, d, '_private', 1)
+        self.assertEqual(d, pickle.loads(pickle.dumps(d)))
+        self.assertEqual(d, pickle.loads(pickle.dumps(d, 2)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -21,6 +21,7 @@ __version__ = "0.2.1"
 
 # Import Retickr's special blend of feedparser
 import feedparser
+import sys
 import time
 import calendar
 import warnings
@@ -28,9 +29,13 @@ import copy
 import urllib
 from eventlet.green import urllib2 as urllib2
 import eventlet
+import eventlet.queue
 import socket
 import httplib
 import random
+import multiprocessing
+
+from retickrtools.connection_pool import build_opener
 
 
 class SmartFeedParserDict:
@@ -768,9 +773,45 @@ def smart_url_protocol_guesser(url):
     return url
 
 
+# The feedparser fields each of the keys SmartFeedParserDict normalizes is
+# worked out from
+SMART_FIELDS = {
+    "link": ["link", "links"],
+    "source_unescaped_html": ["link", "links"],
+    "story_content": ["content", "description", "summary"],
+    "update_time": ["update_time", "updated_parsed"],
+    "stories": [],
+    }
+
+
+def feed_fields(fields):
+    """
+    The feedparser fields to ask for to be able to read fields, which may
+    include the keys SmartFeedParserDict normalizes, from a smart_parse
+    result
+
+    >>> sorted(feed_fields(["title", "story_content"]))
+    ['content', 'description', 'summary', 'title']
+    >>> feed_fields(None) is None
+    True
+
+    @param fields: a list of keys, or None for all of them
+    """
+    if fields is None:
+        return None
+
+    wanted = set()
+    for field in fields:
+        wanted.update(SMART_FIELDS.get(field, [field]))
+    return list(wanted)
+
+
 def smart_parse(url, etag=None, modified=None, agent=None, referrer=None,
                 handlers=[], request_headers={}, response_headers={},
-                encoding_func=None):
+                encoding_func=None, engine=None, validators=None,
+                parse_cache=None, max_bytes=None, max_compressed_bytes=None,
+                timeout=None, stats=None, sanitizer=None, lazy_html=None,
+                fields=None, microformats=None, host_health=None):
     """
     This function takes the url and the general arguments accepted by
     feedparser.parse and then sanitizes the url that we accept to try to guess
@@ -781,10 +822,50 @@ def smart_parse(url, etag=None, modified=None, agent=None, referrer=None,
     @param url: The url of the resource we wish to crawl, attempts to make smart
         guesses about escaping and protocol
     @type url: string
+    @param engine: (optional) the XML engine feedparser should use, 'sax' or
+        'lxml'. Defaults to feedparser.XML_ENGINE
+    @param validators: (optional) a cache, such as
+        retickrtools.caches.LRUCache or ShelveCache, in which the ETag and
+        Last-Modified validators of every url we fetch are remembered. The
+        stored values are sent with the next request for that url, so a feed
+        that hasn't changed comes back as a 304 with nothing to download or
+        parse
+    @param parse_cache: (optional) a feedparser.ParseCache, feeds whose body
+        hasn't changed since it was last parsed are not parsed again
+    @param max_bytes: (optional) the most bytes a feed may decompress to,
+        larger feeds are abandoned with a ResponseTooLarge bozo_exception
+    @param max_compressed_bytes: (optional) the most bytes a feed may take
+        over the wire
+    @param timeout: (optional) seconds to allow for downloading the feed,
+        defaults to feedparser.FETCH_TIMEOUT
+    @param stats: (optional) a retickrtools.stats.FetchStats, or anything
+        else with a record method, which is handed a trace of the download
+    @param sanitizer: (optional) the engine feedparser should sanitize HTML
+        content with, 'sgmllib' or the faster 'lxml'. Defaults to
+        feedparser.HTML_SANITIZER
+    @param lazy_html: (optional) if true HTML content is only sanitized, and
+        its relative URIs resolved, when a story's value is first read, so
+        the fields we never look at cost nothing. Defaults to
+        feedparser.LAZY_HTML
+    @param fields: (optional) the keys we are going to read from the feed and
+        its stories, such as ["title", "link", "story_content",
+        "update_time"]. feedparser skips the work of filling in the rest, see
+        feed_fields
+    @param microformats: (optional) if true feedparser looks for vcards,
+        tags, enclosures and XFN in the HTML content of stories, which is
+        slow on long content. Defaults to feedparser.PARSE_MICROFORMATS
+    @param host_health: (optional) a retickrtools.hosts.HostHealth, which
+        fits the timeout to how fast the feed's host usually answers and
+        stops us fetching from a host that keeps failing for a while
     @return: a SmartFeedParserDict
 
     >>> type(smart_parse('http://reddit.com/.rss')) #doctest: +ELLIPSIS
     <type 'instance'>
+
+    >>> from retickrtools.caches import LRUCache
+    >>> validators = LRUCache()
+    >>> result = smart_parse('http://reddit.com/.rss', validators=validators)
+    >>> result = smart_parse('http://reddit.com/.rss', validators=validators)
     """
 
     #
@@ -797,12 +878,406 @@ def smart_parse(url, etag=None, modified=None, agent=None, referrer=None,
     # Escape the url to make sure we can encode it
     url = unicode(url).encode("utf-8", errors='replace')
 
+    # Send the validators we got the last time we fetched this url, unless
+    # the caller has supplied their own
+    if validators is not None:
+        stored_etag, stored_modified = validators.get(url, (None, None))
+        etag = etag or stored_etag
+        modified = modified or stored_modified
+
     # Runs the feedparser.parse method and then wraps the result in our new custom fascade
-    return make_smart_object(
-        feedparser.parse(url, etag=etag, modified=modified, agent=agent,
-                         referrer=referrer, handlers=handlers,
-                         request_headers=request_headers,
-                         response_headers=response_headers), encoding_func=encoding_func)
+    result = feedparser.parse(url, etag=etag, modified=modified, agent=agent,
+                              referrer=referrer, handlers=handlers,
+                              request_headers=request_headers,
+                              response_headers=response_headers,
+                              engine=engine, parse_cache=parse_cache,
+                              max_bytes=max_bytes,
+                              max_compressed_bytes=max_compressed_bytes,
+                              timeout=timeout, stats=stats,
+                              sanitizer=sanitizer, lazy_html=lazy_html,
+                              fields=feed_fields(fields),
+                              microformats=microformats,
+                              host_health=host_health)
+
+    if validators is not None:
+        remember_validators(validators, url, result, etag, modified)
+
+    return make_smart_object(result, encoding_func=encoding_func)
+
+
+def smart_parse_many(urls, concurrency=100, greenpool=None, timeout=15,
+                     **kwargs):
+    """
+    Fetch and parse many feeds concurrently with a pool of green threads,
+    yielding (url, SmartFeedParserDict) pairs as soon as each feed is done,
+    in whatever order they finish. Any other keyword arguments are handed to
+    smart_parse for every url.
+
+    A feed that fails or takes longer than timeout seconds doesn't stop the
+    rest of the batch, it is reported like any other feedparser error: its
+    result has bozo set and the exception in bozo_exception
+
+    >>> results = dict(smart_parse_many(['http://127.0.0.1:1/.rss']))
+    >>> results['http://127.0.0.1:1/.rss']['bozo']
+    1
+
+    @param urls: an iterable of feed urls, duplicates are only fetched once
+    @param concurrency: (optional) the size of the green pool to create
+    @param greenpool: (optional) an existing eventlet.GreenPool to share
+    @param timeout: (optional) seconds to allow for each feed
+    @return: a generator of (url, SmartFeedParserDict) tuples
+    """
+    def parse_one(url):
+        timer = eventlet.Timeout(timeout)
+        try:
+            result = smart_parse(url, **kwargs)
+        except Exception, e:
+            result = failed_parse(e)
+        except eventlet.Timeout, e:
+            if e is not timer:
+                raise
+            result = failed_parse(e)
+        finally:
+            timer.cancel()
+        return url, result
+
+    return each_as_done(set(urls), parse_one,
+                        greenpool or eventlet.GreenPool(concurrency))
+
+
+def each_as_done(items, work, greenpool):
+    """
+    Call work(item) for every item on a green pool, yielding what each call
+    returns as soon as it is done, in whatever order they finish. If a call
+    raises, the exception is raised from the generator. If the generator
+    is closed or raises before every call is done, the green threads still
+    running are killed.
+
+    >>> sorted(each_as_done([2, 1], lambda x: x * 10, eventlet.GreenPool()))
+    [10, 20]
+    >>> list(each_as_done([0], lambda x: 1 / x, eventlet.GreenPool()))
+    Traceback (most recent call last):
+    ...
+    ZeroDivisionError: integer division or modulo by zero
+
+    @param items: an iterable of the arguments to call work with
+    @param work: a function of one argument
+    @param greenpool: the eventlet.GreenPool to run the calls on
+    @return: a generator of whatever work returns
+    """
+    items = list(items)
+    finished = eventlet.queue.Queue()
+    threads = []
+
+    def run(item):
+        # Hand exceptions over too, otherwise the generator would wait
+        # forever for a result that is never coming
+        try:
+            finished.put((True, work(item)))
+        except Exception:
+            finished.put((False, sys.exc_info()))
+
+    def spawn_all():
+        for item in items:
+            threads.append(greenpool.spawn(run, item))
+
+    # Spawn from a separate green thread so that results can be handed out
+    # while the rest of the items are still waiting for room in the pool
+    spawner = eventlet.spawn(spawn_all)
+
+    try:
+        for ii in xrange(len(items)):
+            ok, result = finished.get()
+            if not ok:
+                raise result[0], result[1], result[2]
+            yield result
+    finally:
+        spawner.kill()
+        for thread in threads:
+            thread.kill()
+
+
+def smart_crawl(urls, processes=None, process_pool=None, concurrency=100,
+                greenpool=None, timeout=15, engine=None, validators=None,
+                agent=None, referrer=None, handlers=[], request_headers={},
+                max_bytes=None, max_compressed_bytes=None, stats=None,
+                sanitizer=None, fields=None, microformats=None,
+                host_health=None):
+    """
+    Like smart_parse_many, except that green threads only do the
+    downloading. Every body that arrives is handed to a pool of worker
+    processes to be parsed and normalized, so one crawler process can keep
+    all of the machine's cores busy instead of parsing on just one.
+
+    Results are yielded as (url, dict) pairs as each feed is done. The dicts
+    are made by plain_result so that they can cross the process boundary.
+    Failures are reported per url the same way smart_parse_many reports
+    them.
+
+    >>> results = dict(smart_crawl(['http://127.0.0.1:1/.rss'], processes=1))
+    >>> results['http://127.0.0.1:1/.rss']['bozo']
+    1
+
+    @param urls: an iterable of feed urls, duplicates are only fetched once
+    @param processes: (optional) the number of worker processes to start,
+        defaults to the number of cores
+    @param process_pool: (optional) an existing multiprocessing.Pool to use
+        instead of starting one
+    @param concurrency: (optional) the size of the green pool to create
+    @param greenpool: (optional) an existing eventlet.GreenPool to share
+    @param timeout: (optional) seconds to allow for downloading each feed,
+        and again for parsing it
+    @param engine: (optional) the XML engine the workers should use
+    @param sanitizer: (optional) the HTML sanitizer the workers should use
+    @param fields: (optional) the fields the workers should fill in, see
+        smart_parse. plain_result always reads the feed's 'title' and the
+        'title', 'link', 'story_content' and 'update_time' of every story
+    @param microformats: (optional) see smart_parse
+    @param validators: (optional) a validators cache, see smart_parse
+    @param max_bytes: (optional) see smart_parse
+    @param max_compressed_bytes: (optional) see smart_parse
+    @param stats: (optional) see smart_parse
+    @param host_health: (optional) see smart_parse
+    @return: a generator of (url, dict) tuples
+    """
+    if fields is not None:
+        fields = list(fields) + ["title", "link", "story_content", "update_time"]
+    parse_options = {"engine": engine, "sanitizer": sanitizer,
+                     "fields": feed_fields(fields),
+                     "microformats": microformats}
+
+    own_process_pool = process_pool is None
+    if own_process_pool:
+        process_pool = multiprocessing.Pool(processes)
+
+    def crawl_one(url):
+        feed_url = smart_url_protocol_guesser(url)
+        feed_url = unicode(feed_url).encode("utf-8", errors='replace')
+
+        timer = eventlet.Timeout(timeout)
+        try:
+            etag = modified = None
+            if validators is not None:
+                etag, modified = validators.get(feed_url, (None, None))
+
+            result, data = feedparser.fetch(feed_url, etag=etag,
+                                            modified=modified, agent=agent,
+                                            referrer=referrer,
+                                            handlers=handlers,
+                                            request_headers=request_headers,
+                                            max_bytes=max_bytes,
+                                            max_compressed_bytes=max_compressed_bytes,
+                                            timeout=timeout, stats=stats,
+                                            host_health=host_health)
+            timer.cancel()
+
+            if validators is not None:
+                remember_validators(validators, feed_url, result, etag,
+                                    modified)
+
+            # A worker that hangs or dies never gets the result ready, so
+            # parsing gets a timeout of its own
+            timer = eventlet.Timeout(timeout)
+
+            if data is None:
+                plain = plain_result(make_smart_object(result))
+            else:
+                parsing = process_pool.apply_async(
+                    parse_fetched_plain, ((result, data, parse_options),))
+                # Waiting on the AsyncResult would block every green
+                # thread, so poll it instead
+                while not parsing.ready():
+                    eventlet.sleep(0.005)
+                plain = parsing.get()
+        except Exception, e:
+            plain = plain_result(failed_parse(e))
+        except eventlet.Timeout, e:
+            if e is not timer:
+                raise
+            plain = plain_result(failed_parse(e))
+        finally:
+            timer.cancel()
+        return url, plain
+
+    crawling = each_as_done(set(urls), crawl_one,
+                            greenpool or eventlet.GreenPool(concurrency))
+    try:
+        for done in crawling:
+            yield done
+    finally:
+        crawling.close()
+        if own_process_pool:
+            process_pool.terminate()
+
+
+def parse_fetched_plain(args):
+    """
+    The work smart_crawl hands to its worker processes: parse the result of
+    feedparser.fetch and return it as a plain_result
+
+    @param args: a (result, data, options) tuple, options being a dict of
+        keyword arguments for feedparser.parse_fetched
+    """
+    result, data, options = args
+    return plain_result(
+        make_smart_object(feedparser.parse_fetched(result, data, **options)))
+
+
+def plain_object(obj_):
+    """
+    The opposite of make_smart_object, turns SmartFeedParserDicts (and
+    anything nested in them) back into plain dicts and lists of utf-8
+    strings. Exceptions are replaced with their repr, so the result can
+    always be pickled.
+
+    >>> plain_object(make_smart_object({'a': [{'b': u'B'}]}))
+    {'a': [{'b': 'B'}]}
+    """
+    if isinstance(obj_, SmartFeedParserDict):
+        return dict((key, plain_object(obj_[key]))
+                    for key in obj_.__feed_dict__.keys())
+
+    elif hasattr(obj_, 'keys'):
+        return dict((key, plain_object(obj_[key])) for key in obj_.keys())
+
+    elif type(obj_) == type(list()):
+        return [plain_object(elm) for elm in obj_]
+
+    elif isinstance(obj_, BaseException):
+        return repr(obj_)
+
+    return obj_
+
+
+def plain_result(smart_result):
+    """
+    Turn a smart_parse result into plain_objects. The values that
+    SmartFeedParserDict normalizes on demand are worked out up front: the
+    feed's 'title' and 'stories', and the 'title', 'link', 'story_content'
+    and 'update_time' of every story. 'entries' is dropped because
+    'stories' already holds the same items.
+
+    >>> plain = plain_result(failed_parse(ValueError("broken")))
+    >>> plain['bozo'], plain['bozo_exception'], plain['stories']
+    (1, "ValueError('broken',)", [])
+    """
+    plain = plain_object(smart_result)
+    plain.pop('entries', None)
+    plain['title'] = plain_object(smart_result.get('title', None))
+
+    plain['stories'] = []
+    for story in smart_result['stories']:
+        plain_story = plain_object(story)
+        for name in ('title', 'link', 'story_content', 'update_time'):
+            plain_story[name] = plain_object(story.get(name, None))
+        plain['stories'].append(plain_story)
+
+    return plain
+
+
+def failed_parse(exception):
+    """
+    A SmartFeedParserDict shaped like the result feedparser returns when it
+    can't fetch a feed
+
+    >>> result = failed_parse(ValueError("broken"))
+    >>> result['bozo'], result['stories']
+    (1, [])
+    """
+    result = feedparser.FeedParserDict()
+    result['feed'] = feedparser.FeedParserDict()
+    result['entries'] = []
+    result['bozo'] = 1
+    result['bozo_exception'] = exception
+    return make_smart_object(result)
+
+
+def remember_validators(validators, url, result, etag=None, modified=None):
+    """
+    Store the ETag and Last-Modified validators from a feedparser result so
+    they can be sent the next time url is fetched. A 304 response keeps the
+    validators we sent unless the server gave us new ones. Anything other
+    than a 2xx or 304 response, such as a fetch that failed before it got
+    a status, leaves what is stored alone.
+
+    >>> from retickrtools.caches import LRUCache
+    >>> validators = LRUCache()
+    >>> remember_validators(validators, 'http://a', {'etag': '"1"', 'status': 200})
+    >>> validators.get('http://a')
+    ('"1"', None)
+    >>> remember_validators(validators, 'http://a', {'status': 304}, '"1"')
+    >>> validators.get('http://a')
+    ('"1"', None)
+    >>> remember_validators(validators, 'http://a', {'bozo': 1})
+    >>> remember_validators(validators, 'http://a', {'status': 503})
+    >>> validators.get('http://a')
+    ('"1"', None)
+    >>> remember_validators(validators, 'http://a', {'status': 200})
+    >>> validators.get('http://a') is None
+    True
+
+    @param validators: the cache to store the validators in
+    @param url: the url that was fetched
+    @param result: the result of feedparser.parse for url
+    @param etag: the etag that was sent with the request
+    @param modified: the modified date that was sent with the request
+    """
+    status = result.get('status')
+    if status == 304:
+        etag = result.get('etag', etag)
+        modified = result.get('modified', modified)
+    elif isinstance(status, int) and 200 <= status < 300:
+        etag = result.get('etag')
+        modified = result.get('modified')
+    else:
+        return
+
+    if etag or modified:
+        validators.set(url, (etag, modified))
+    else:
+        validators.delete(url)
+
+
+def smart_iterparse(url_or_stream, etag=None, modified=None, agent=None,
+                    referrer=None, handlers=[], request_headers={},
+                    response_headers={}, engine='lxml', lazy_html=None,
+                    fields=None, microformats=None):
+    """
+    A generator which yields the stories of a feed one at a time, as soon as
+    the parser has closed each <item> or <entry>. Unlike
+    smart_parse(url)["stories"] the full list of stories is never built, so
+    memory use stays flat no matter how many items a feed has.
+
+    >>> from StringIO import StringIO
+    >>> rss = StringIO('<rss version="2.0"><channel>'
+    ...                '<item><title>Apple</title></item>'
+    ...                '<item><title>Grape</title></item>'
+    ...                '</channel></rss>')
+    >>> [story["title"] for story in smart_iterparse(rss)]
+    ['Apple', 'Grape']
+
+    @param url_or_stream: The url of the feed, or a file like object
+        containing it
+    @param engine: (optional) the XML engine feedparser should use. lxml (the
+        default) discards the parsed document as it goes
+    @param lazy_html: (optional) see smart_parse
+    @param fields: (optional) see smart_parse
+    @param microformats: (optional) see smart_parse
+    @return: a generator of SmartFeedParserDict stories
+    """
+    if not hasattr(url_or_stream, 'read'):
+        url_or_stream = smart_url_protocol_guesser(url_or_stream)
+        url_or_stream = unicode(url_or_stream).encode("utf-8", errors='replace')
+
+    for entry in feedparser.iterparse(url_or_stream, etag=etag,
+                                      modified=modified, agent=agent,
+                                      referrer=referrer, handlers=handlers,
+                                      request_headers=request_headers,
+                                      response_headers=response_headers,
+                                      engine=engine, lazy_html=lazy_html,
+                                      fields=feed_fields(fields),
+                                      microformats=microformats):
+        yield make_smart_object(entry)
 
 
 def smart_new_story_filter(stories_object, identifier, most_recent_identifier=""):
@@ -875,6 +1350,65 @@ def smart_new_story_filter(stories_object, identifier, most_recent_identifier=""
     return stories_object[0:pivot_identifier_index]
 
 
+def smart_parse_new_stories(url_or_stream, identifier,
+                            most_recent_identifier="", etag=None,
+                            modified=None, agent=None, referrer=None,
+                            handlers=[], request_headers={},
+                            response_headers={}, engine='lxml'):
+    """
+    Equivalent to running smart_new_story_filter over
+    smart_parse(url)["stories"], except that parsing stops as soon as the
+    story matching most_recent_identifier is reached. When re-crawling a feed
+    that has only a couple of new items at the top, the rest of the document
+    is never tokenized.
+
+    >>> from StringIO import StringIO
+    >>> rss = ('<rss version="2.0"><channel>'
+    ...        '<item><title>Apple</title></item>'
+    ...        '<item><title>Bannanna</title></item>'
+    ...        '<item><title>Grape</title></item>'
+    ...        '</channel></rss>')
+    >>> stories = smart_parse_new_stories(StringIO(rss), "title", "Bannanna")
+    >>> [story["title"] for story in stories]
+    ['Apple']
+
+    >>> stories = smart_parse_new_stories(StringIO(rss), "title", "honeydew")
+    >>> [story["title"] for story in stories]
+    ['Apple', 'Bannanna', 'Grape']
+
+    @param url_or_stream: The url of the feed, or a file like object
+        containing it
+    @param identifier: a reasonibly unique key of the stories, see
+        smart_new_story_filter
+    @param most_recent_identifier: the value of identifier for the newest
+        story we already have
+    @return: a list of the stories newer than most_recent_identifier
+    """
+    new_stories = []
+    all_none = True
+    stories = smart_iterparse(url_or_stream, etag=etag, modified=modified,
+                              agent=agent, referrer=referrer,
+                              handlers=handlers,
+                              request_headers=request_headers,
+                              response_headers=response_headers,
+                              engine=engine)
+    try:
+        for story in stories:
+            if identifier in story:
+                all_none = False
+                if story[identifier] == most_recent_identifier:
+                    break
+            new_stories.append(story)
+    finally:
+        # Stops the parser where it is
+        stories.close()
+
+    if all_none and new_stories:
+        warnings.warn("None of the stories_object elements had the key '%s'. The entire list will be returned unfiltered" % identifier)
+
+    return new_stories
+
+
 def smart_get_favicon_url(url):
     """
     This method tries various means to get a favicon (or better an apple-touch-icon)
@@ -900,7 +1434,15 @@ def smart_get_favicon_url(url):
 
     return favicon
 
-def smart_scrape_url(url):
+def smart_scrape_url(url, timeout=15, host_health=None):
+    """
+    Fetch the page at url and find its favicon, returns (favicon, html)
+
+    @param url: the url of the page
+    @param timeout: (optional) seconds to allow for fetching it
+    @param host_health: (optional) a retickrtools.hosts.HostHealth, see
+        smart_parse
+    """
     import BeautifulSoup
     from urlparse import urlparse, urljoin
 
@@ -911,21 +1453,37 @@ def smart_scrape_url(url):
     # A list of rels that are known to be icons
     icon_list = ["apple-touch-icon", "shortcut icon", "icon"]
 
+    if host_health is not None:
+        if not host_health.available(url):
+            return ("", "")
+        timeout = host_health.timeout(url, timeout)
+
     # Parse the url using Beautiful Soup
     try:
-        with eventlet.Timeout(15, False) as timeout:
+        with eventlet.Timeout(timeout, False) as timer:
+            start = time.time()
             try:
-                html = urllib2.urlopen(urllib2.Request(url)).read()
+                html = build_opener().open(urllib2.Request(url)).read()
             except eventlet.Timeout:
+                if host_health is not None:
+                    host_health.record_failure(url, timeout)
                 return ("", "")
-            except urllib2.URLError:
-                return ("", "")
-            except eventlet.green.httplib.BadStatusLine:
+            except urllib2.HTTPError, e:
+                if host_health is not None:
+                    if e.code >= 500:
+                        host_health.record_failure(url)
+                    else:
+                        host_health.record_success(url, time.time() - start)
                 return ("", "")
-            except httplib.BadStatusLine:
+            except (urllib2.URLError, eventlet.green.httplib.BadStatusLine,
+                    httplib.BadStatusLine):
+                if host_health is not None:
+                    host_health.record_failure(url)
                 return ("", "")
             finally:
-                timeout.cancel()
+                timer.cancel()
+            if host_health is not None:
+                host_health.record_success(url, time.time() - start)
         soup = BeautifulSoup.BeautifulSoup(html)
     except ValueError:
         return ("", "")
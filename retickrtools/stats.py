@@ -0,0 +1,137 @@
+# Universe imports
+import collections
+import math
+import time
+
+# Retickr imports
+from retickrtools.hosts import host_key
+
+
+# The phases of a request timed in a trace, in the order they happen
+PHASES = ("dns", "connect", "tls", "ttfb", "download", "decompress", "json", "total")
+
+
+def new_trace(uri):
+    """
+    A trace of one request for uri. It is a plain dict which the fetching
+    code fills in as it goes, any of these may be present:
+
+    - dns, connect, tls, ttfb, download, decompress, json, total: seconds
+      spent on each phase of the request (dns, connect and tls only when a
+      new connection had to be made)
+    - bytes, size: the size of the body on the wire and decompressed
+    - status: the HTTP status code
+    - reused: whether the connection came from the keep-alive pool
+    - cache: "hit", "stale" or "miss" when a cache was consulted
+    - shared: True when the response was fetched by another caller
+    - attempts: the number of attempts made, more than one on retries
+    - error: the name of the exception if the request failed
+    - timeout: True if it failed by timing out
+
+    >>> trace = new_trace("http://example.com/a")
+    >>> trace["host"]
+    'http://example.com'
+    """
+    return {
+        "uri": uri,
+        "host": "{0}://{1}".format(*host_key(uri)),
+        "start": time.time(),
+        }
+
+
+def _percentile(values, percent):
+    # values must be sorted
+    index = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(0, index)]
+
+
+class FetchStats(object):
+    """
+    Collects the traces of requests handed to its record method and
+    summarises them per host. Anything else with a record(trace) method,
+    such as something which passes them on to statsd, can be used in its
+    place wherever a stats argument is taken. At most max_traces recent
+    traces are kept.
+
+    >>> stats = FetchStats()
+    >>> stats.record({"uri": "http://a/1", "host": "http://a", "total": 0.5,
+    ...               "bytes": 100, "status": 200})
+    >>> stats.record({"uri": "http://a/2", "host": "http://a", "total": 1.5,
+    ...               "error": "Timeout", "timeout": True})
+    >>> summary = stats.summary()["http://a"]
+    >>> summary["requests"], summary["timeouts"], summary["bytes"]
+    (2, 1, 100)
+    >>> summary["total"]["p95"]
+    1.5
+    """
+
+    def __init__(self, max_traces=10000):
+        self.traces = collections.deque(maxlen=max_traces)
+
+    def record(self, trace):
+        self.traces.append(trace)
+
+    def clear(self):
+        self.traces.clear()
+
+    def summary(self, by="host"):
+        """
+        A dict of figures for the traces grouped by the trace field by
+        (each host by default). Each holds the number of requests, errors,
+        timeouts, cache hits and shared responses, the bytes downloaded,
+        a count of each status code and, for every phase that was timed,
+        its count, mean, p50, p95 and max
+        """
+        groups = collections.defaultdict(list)
+        for trace in self.traces:
+            groups[trace.get(by)].append(trace)
+
+        summary = {}
+        for group, traces in groups.items():
+            figures = {
+                "requests": len(traces),
+                "errors": sum(1 for t in traces if t.get("error")),
+                "timeouts": sum(1 for t in traces if t.get("timeout")),
+                "cache_hits": sum(1 for t in traces if t.get("cache") in ("hit", "stale")),
+                "shared": sum(1 for t in traces if t.get("shared")),
+                "bytes": sum(t.get("bytes", 0) for t in traces),
+                "status": dict(collections.Counter(
+                    t["status"] for t in traces if "status" in t)),
+                }
+            for phase in PHASES:
+                values = sorted(t[phase] for t in traces if phase in t)
+                if values:
+                    figures[phase] = {
+                        "count": len(values),
+                        "mean": sum(values) / len(values),
+                        "p50": _percentile(values, 50),
+                        "p95": _percentile(values, 95),
+                        "max": values[-1],
+                        }
+            summary[group] = figures
+        return summary
+
+    def report(self, by="host", limit=20):
+        """
+        The summary as a table of text, the limit groups that took the
+        most time in total first
+        """
+        summary = self.summary(by)
+        groups = sorted(
+            summary.items(),
+            key=lambda (group, figures): -figures.get("total", {}).get("mean", 0) * figures["requests"]
+            )[:limit]
+
+        columns = ["requests", "errors", "timeouts", "cache_hits", "bytes"]
+        header = "{0:40} ".format(by) + " ".join("{0:>10}".format(c) for c in columns)
+        header += " " + " ".join("{0:>10}".format(p + " p95") for p in PHASES)
+        lines = [header]
+        for group, figures in groups:
+            line = "{0:40} ".format(str(group)[:40])
+            line += " ".join("{0:>10}".format(figures[c]) for c in columns)
+            line += " " + " ".join(
+                "{0:>10.3f}".format(figures[p]["p95"]) if p in figures else "{0:>10}".format("-")
+                for p in PHASES
+                )
+            lines.append(line)
+        return "\n".join(lines)
@@ -47,5 +47,8 @@ setup(
     install_requires=[
         "eventlet==0.9.17"
         ],
+    extras_require={
+        "asyncio": ["trollius==2.2.1"],
+        },
     zip_safe=True,
 )